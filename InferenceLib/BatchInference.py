@@ -0,0 +1,211 @@
+"""
+Batch inference over many inputs.
+
+A batch job splits its inputs into batches sized for one model call (one GPU batch), prepares each batch on
+the main thread (loading or exporting volumes), runs it in the background and writes every result to a
+ResultStore. The batches are pipelined, so preparing the next batch overlaps with running the current one. A failing input or batch is recorded in the store and the job goes on with the next batch,
+so that an overnight run over a whole worklist is not stopped by one bad series.
+"""
+
+import functools
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from .InferenceJob import InferenceJob, JobCancelled, Stage
+from .Pipeline import Pipeline, PipelineCancelled, PipelineStage
+from .ResultStore import ResultStore
+
+#
+# BatchItem
+#
+
+
+@dataclass
+class BatchItem:
+    """
+    One input of a batch job.
+
+    key - identifies the input in the result store (file path, series instance UID, ...).
+    source - what the module needs to prepare the input: volume node, file path, DICOM series UID, ...
+    metadata - stored together with the result.
+    request - inference request filled by the prepare function.
+    volume - (array, ijkToRas) when the voxels are sent directly to the inference server.
+    cacheKey - result cache key, set by the prepare function when the input can be cached.
+    cached - the result was found in the result cache by the prepare function, the input is not run again.
+    """
+
+    key: str
+    source: object = None
+    metadata: dict = field(default_factory=dict)
+    request: dict = field(default_factory=dict)
+    volume: Optional[tuple] = None
+    result: object = None
+    error: Optional[str] = None
+    cacheKey: Optional[str] = None
+    cached: bool = False
+
+
+def splitBatches(items: list, batchSize: int) -> list:
+    batchSize = max(int(batchSize), 1)
+    return [items[start:start + batchSize] for start in range(0, len(items), batchSize)]
+
+
+def createBatchJob(name: str, model: str, items: list, store: ResultStore, batchSize: int,
+                   prepare: Callable, infer: Callable, setupStages: Optional[list] = None,
+                   skipExisting: bool = True, cache=None, transfer: Optional[Callable] = None,
+                   transferWorkers: int = 2, prefetchBatches: int = 1, inferWorkers: int = 1) -> InferenceJob:
+    """
+    Create a job running `model` on all `items` (list of BatchItem).
+
+    The batches go through a Pipeline: prepare (main thread) -> transfer -> infer -> store. While batch N is
+    on the GPU, batch N+1 is prepared and transferred and the results of batch N-1 are written.
+
+    :param prepare: prepare(job, context, batch), called on the main thread. Fills item.request / item.volume
+      or sets item.error for inputs that cannot be used, and item.result for inputs found in the result cache.
+    :param infer: infer(job, context, batch), called in the background. Sets item.result for every item of
+      the batch that has neither an error nor a result yet, typically with one model call for the whole batch.
+    :param setupStages: stages run before the first batch, e.g. acquiring the container.
+    :param skipExisting: do not run inputs that already have a successful result in the store.
+    :param cache: ResultCache receiving the new results of items with a cacheKey.
+    :param transfer: optional transfer(job, context, batch), called in the background between prepare and
+      infer for the items still to be run, e.g. to copy their files to the container, by `transferWorkers` threads.
+    :param prefetchBatches: batches waiting in front of each stage. Bounds the memory used by prepared volumes.
+    :param inferWorkers: batches inferred at the same time. Each `infer` call leases its own container, so the
+      scheduler and the container pool of the model must allow as many concurrent runs to gain anything.
+    The job result is a summary {"done": n, "failed": n, "skipped": n, "store": path}.
+    """
+    summary = {"done": 0, "failed": 0, "skipped": 0, "store": store.path}
+    if skipExisting:
+        doneKeys = {record["key"] for record in store.records(model, status="done")}
+        remaining = [item for item in items if item.key not in doneKeys]
+        summary["skipped"] = len(items) - len(remaining)
+        items = remaining
+
+    batches = splitBatches(items, batchSize)
+    stages = list(setupStages or [])
+    if batches:
+        run = functools.partial(_runBatches, batches, prepare, transfer, infer, model, store, cache, summary,
+                                transferWorkers, prefetchBatches, inferWorkers)
+        stages.append(Stage(f"Running {len(batches)} batches", run, weight=5.0 * len(batches)))
+    context = {"items": items, "store": store, "result": summary}
+    return InferenceJob(name, stages, context)
+
+
+def _runBatches(batches, prepare, transfer, infer, model, store, cache, summary, transferWorkers, prefetchBatches,
+                inferWorkers, job, context):
+    def stage(function):
+        return lambda batch: function(job, context, batch) or batch
+
+    pipelineStages = [PipelineStage("prepare", stage(functools.partial(_prepareBatch, prepare)), mainThread=True,
+                                    queueSize=prefetchBatches)]
+    if transfer is not None:
+        pipelineStages.append(PipelineStage("transfer", stage(functools.partial(_transferBatch, transfer)),
+                                            workers=transferWorkers, queueSize=prefetchBatches))
+    pipelineStages.append(PipelineStage("infer", stage(functools.partial(_inferBatch, infer)), workers=inferWorkers,
+                                        queueSize=max(prefetchBatches, inferWorkers)))
+    pipelineStages.append(PipelineStage("store", stage(functools.partial(_storeBatch, model, store, cache, summary)),
+                                        queueSize=prefetchBatches))
+
+    finished = []
+
+    def onBatchFinished(batch, stageName=None, error=None):
+        if isinstance(error, JobCancelled):
+            return
+        if error is not None:
+            # Only unexpected errors get here, the stage functions record input errors on the items
+            _storeBatch(model, store, cache, summary, job, context, batch, f"{type(error).__name__}: {error}")
+        finished.append(batch)
+        job.reportProgress(len(finished) / len(batches), f"Finished batch {len(finished)}/{len(batches)}")
+
+    pipeline = Pipeline(pipelineStages, job.callInMainThread, job._cancelEvent)
+    try:
+        pipeline.run(batches, onBatchFinished, onBatchFinished)
+    except PipelineCancelled:
+        job.checkCancelled()
+
+
+def _prepareBatch(prepare, job, context, batch):
+    try:
+        prepare(job, context, batch)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logging.exception("Preparing a batch failed")
+        for item in batch:
+            if item.error is None:
+                item.error = f"{type(e).__name__}: {e}"
+
+
+def _transferBatch(transfer, job, context, batch):
+    pending = [item for item in batch if item.error is None and item.result is None]
+    if pending:
+        try:
+            transfer(job, context, pending)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logging.exception("Transferring a batch failed")
+            for item in pending:
+                if item.error is None:
+                    item.error = f"{type(e).__name__}: {e}"
+
+
+def _inferBatch(infer, job, context, batch):
+    pending = [item for item in batch if item.error is None and item.result is None]
+    if pending:
+        try:
+            infer(job, context, pending)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logging.exception("Batch inference failed")
+            for item in batch:
+                if item.error is None and item.result is None:
+                    item.error = f"{type(e).__name__}: {e}"
+
+
+def _storeBatch(model, store, cache, summary, job, context, batch, error=None):
+    for item in batch:
+        if item.error is None and item.result is None:
+            item.error = error or "No result returned"
+        if item.error is not None:
+            store.putError(model, item.key, item.error, item.metadata)
+            summary["failed"] += 1
+        else:
+            store.put(model, item.key, item.result, item.metadata)
+            summary["done"] += 1
+            if cache is not None and item.cacheKey is not None and not item.cached:
+                cache.put(item.cacheKey, item.result)
+        # Do not keep the voxels of finished batches in memory
+        item.volume = None
+
+
+def findDicomSeries(database, modalities: Optional[list] = None, studyDate: Optional[str] = None,
+                    patientID: Optional[str] = None) -> list:
+    """
+    Query a Slicer DICOM database (e.g. slicer.dicomDatabase) for the series of a worklist.
+
+    :param modalities: keep only these modalities, e.g. ["CT"] or ["CR", "DX"]
+    :param studyDate: keep only studies of this date, DICOM format YYYYMMDD
+    :param patientID: keep only this patient
+    :return: list of dict with studyInstanceUID, seriesInstanceUID, modality, patientID, studyDate and files
+    """
+    series = []
+    for patient in database.patients():
+        for study in database.studiesForPatient(patient):
+            for seriesUID in database.seriesForStudy(study):
+                files = database.filesForSeries(seriesUID)
+                if not files:
+                    continue
+                values = {name: database.fileValue(files[0], tag) for name, tag in (
+                    ("studyInstanceUID", "0020,000D"), ("modality", "0008,0060"),
+                    ("patientID", "0010,0020"), ("studyDate", "0008,0020"))}
+                if modalities and values["modality"] not in modalities:
+                    continue
+                if studyDate and values["studyDate"] != studyDate:
+                    continue
+                if patientID and values["patientID"] != patientID:
+                    continue
+                series.append(dict(values, seriesInstanceUID=seriesUID, files=list(files)))
+    return series
@@ -0,0 +1,480 @@
+"""
+Offline benchmark of the inference paths of both modules.
+
+Runs the chest X-ray and PE pipelines (cache lookup, scheduling, export or DICOM staging, inference through
+exec_run or the inference server, result handling) outside of Slicer, against FakeDockerClient and the
+stand-in models, on synthetic NRRD images and DICOM series. For every scenario it measures the end-to-end
+latency, the time per stage (from the timing spans), the peak Python memory and the throughput, and it can
+save the numbers as a baseline and flag regressions against a saved baseline:
+
+    python -m InferenceLib.Benchmark --save-baseline baseline.json
+    python -m InferenceLib.Benchmark --baseline baseline.json       # exit code 1 on regression
+
+The GUI specific steps (loading nodes, drawing markups) are not part of the benchmark, the detections are
+only converted to RAS corners as the modules do before drawing them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+from . import DetectionGeometry
+from .BatchInference import BatchItem, createBatchJob
+from .ContainerPool import ContainerPool, ContainerSpec
+from .DicomStaging import stageFiles
+from .FakeDocker import FakeDockerClient, freePort
+from .InferenceJob import InferenceJob, Stage
+from .InferenceScheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, InferenceScheduler
+from .ModelRegistry import INPUT_ARRAY, INPUT_DICOM, INPUT_NRRD, INPUT_SHARED_MEMORY, ModelRegistry, ModelSpec
+from .ResultCache import ResultCache, cacheKey, hashVolume, seriesIdentity
+from .ResultChannel import execResultChannel
+from .ResultStore import ResultStore
+from .SyntheticData import syntheticImage, writeDicomSeries, writeNrrd
+from .Timing import sharedSpanRecorder, span
+
+CONFIDENCE_FLOOR = 0.05
+RESULT_TIMEOUT = 120
+
+#
+# BenchmarkOptions
+#
+
+
+@dataclass
+class BenchmarkOptions:
+    """
+    runs - timed repetitions of the single input scenarios.
+    batchItems, batchSize - inputs of the batch scenarios and inputs per model call.
+    imageSize - width and height of the synthetic chest X-ray images.
+    slices, sliceSize - size of the synthetic CT series.
+    modelLatency - simulated inference time of one model call in seconds.
+    modelLoadTime - simulated weight loading time of every exec_run.
+    measureMemory - run every scenario once more under tracemalloc for the peak memory.
+    """
+
+    runs: int = 5
+    batchItems: int = 16
+    batchSize: int = 8
+    imageSize: int = 1024
+    slices: int = 64
+    sliceSize: int = 256
+    modelLatency: float = 0.05
+    modelLoadTime: float = 0.5
+    measureMemory: bool = True
+
+
+#
+# BenchmarkEnvironment
+#
+
+
+class BenchmarkEnvironment:
+    """Temporary folders, fake Docker backend, container pool, scheduler and result cache of one benchmark run."""
+
+    def __init__(self, options: BenchmarkOptions) -> None:
+        self.options = options
+        self.folder = tempfile.mkdtemp(prefix="inference_benchmark_")
+        serverCommand = "python /workfolder/InferenceServer.py --handler main:InferenceHandler --host 0.0.0.0 --port 8000"
+        self.chestModel = ModelSpec(
+            name="chestyolov5",
+            container=ContainerSpec("chestyolov5", serverPort=freePort(), serverCommand=serverCommand,
+                                    serverStartupTimeout=10.0),
+            inputFormats=[INPUT_ARRAY, INPUT_SHARED_MEMORY, INPUT_NRRD],
+            inputFolder=self._makeFolder("chest", "nrrd"), resultFolder=self._makeFolder("chest", "result"))
+        self.peModel = ModelSpec(
+            name="pedetect_v1",
+            container=ContainerSpec("pedetect_v1", serverPort=freePort(), serverCommand=serverCommand,
+                                    serverStartupTimeout=10.0),
+            inputFormats=[INPUT_DICOM],
+            inputFolder=self._makeFolder("pe", "input"), resultFolder=self._makeFolder("pe", "result"))
+        self.registry = ModelRegistry()
+        self.registry.register(self.chestModel)
+        self.registry.register(self.peModel)
+        self.docker = FakeDockerClient([self.chestModel, self.peModel], options.modelLatency, options.modelLoadTime)
+        self.pool = ContainerPool(clientFactory=lambda: self.docker, idleTimeout=None)
+        self.scheduler = InferenceScheduler(self.registry, self.pool)
+        self.cache = ResultCache(os.path.join(self.folder, "cache.sqlite"))
+        self._seed = 0
+
+    def nextSeed(self) -> int:
+        self._seed += 1
+        return self._seed
+
+    def close(self) -> None:
+        self.pool.shutdown()
+        self.docker.close()
+        self.cache.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _makeFolder(self, *names) -> str:
+        path = os.path.join(self.folder, *names)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+#
+# Single input jobs, same stages as the module jobs
+#
+
+
+def _skipIfCached(function):
+    def stage(job, context):
+        if not context.get("cached"):
+            function(job, context)
+    return stage
+
+
+def chestJob(env: BenchmarkEnvironment, array, transport: str, useCache: bool = True) -> InferenceJob:
+    """
+    Job of ChestXrayNodulesLogic.createInferenceJob. `transport` is "array" (volume frame), "shm" (shared
+    memory) or "nrrd" (NRRD file in the shared folder) through the server, or "exec" (NRRD file and exec_run).
+    """
+    model = env.chestModel
+    context = {"array": array, "ijkToRas": np.eye(4)}
+
+    def checkCache(job, context):
+        context["cacheKey"] = cacheKey(model.name, model.modelVersion, hashVolume(array, context["ijkToRas"]),
+                                       {"confidence": CONFIDENCE_FLOOR})
+        context["result"] = env.cache.get(context["cacheKey"]) if useCache else None
+        context["cached"] = context["result"] is not None
+
+    def acquire(job, context):
+        context["lease"] = env.scheduler.leaseForJob(job, model.name, PRIORITY_INTERACTIVE)
+
+    def export(job, context):
+        if transport in ("exec", "nrrd"):
+            context["basename"] = f"{env.nextSeed():05d}.nrrd"
+            with span("saveNode"):
+                writeNrrd(os.path.join(model.inputFolder, context["basename"]), array)
+
+    def infer(job, context):
+        lease = context["lease"]
+        if transport == "exec":
+            command = f"python /workfolder/main.py --run-type inference --input {context['basename']} --confidence {CONFIDENCE_FLOOR}"
+            resultPath = os.path.join(model.resultFolder, context["basename"] + "_result.json")
+            context["result"] = job.waitFor(execResultChannel(lease.container, command, resultPath, RESULT_TIMEOUT).future)
+        elif transport == "nrrd":
+            context["result"] = lease.serverClient.infer(model.name, {"input": context["basename"],
+                                                                      "confidence": CONFIDENCE_FLOOR})
+        elif transport == "shm":
+            context["result"], _ = lease.serverClient.inferShared(model.name, array, context["ijkToRas"],
+                                                                  {"confidence": CONFIDENCE_FLOOR})
+        else:
+            context["result"], _ = lease.serverClient.inferVolume(model.name, array, context["ijkToRas"],
+                                                                  {"confidence": CONFIDENCE_FLOOR})
+        env.cache.put(context["cacheKey"], context["result"])
+
+    def draw(job, context):
+        DetectionGeometry.detectionCorners(context["result"]["bounding_boxes"], context["ijkToRas"])
+
+    return InferenceJob("chestyolov5 inference", [
+        Stage("Checking result cache", checkCache),
+        Stage("Starting container", _skipIfCached(acquire)),
+        Stage("Exporting volume", _skipIfCached(export)),
+        Stage("Running inference", _skipIfCached(infer), weight=5.0),
+        Stage("Drawing bounding boxes", draw),
+    ], context)
+
+
+def peJob(env: BenchmarkEnvironment, series: dict, transport: str) -> InferenceJob:
+    """Job of PE_DetectLogic.createInferenceJob, `transport` is "server" or "exec"."""
+    model = env.peModel
+    basename = series["studyInstanceUID"] + "_" + series["seriesInstanceUID"]
+
+    def copyFiles(job, context):
+        stageFiles(series["files"], os.path.join(model.inputFolder, series["studyInstanceUID"], series["seriesInstanceUID"]))
+
+    def acquire(job, context):
+        context["lease"] = env.scheduler.leaseForJob(job, model.name, PRIORITY_INTERACTIVE)
+
+    def infer(job, context):
+        lease = context["lease"]
+        if transport == "exec":
+            command = f"python /workfolder/main.py --run-type inference --input {basename}"
+            resultPath = os.path.join(model.resultFolder, basename + "_result.json")
+            context["result"] = job.waitFor(execResultChannel(lease.container, command, resultPath, RESULT_TIMEOUT).future)
+        else:
+            context["result"] = lease.serverClient.infer(model.name, {"input": basename, "instanceUIDs": series["instanceUIDs"]})
+
+    return InferenceJob("pedetect_v1 inference", [
+        Stage("Copying DICOM files", copyFiles, weight=2.0),
+        Stage("Starting container", acquire),
+        Stage("Running inference", infer, weight=10.0),
+    ])
+
+
+#
+# Scenarios, each returns a list of (seconds, items) per timed run
+#
+
+
+def _chestImages(env, count):
+    size = env.options.imageSize
+    return [syntheticImage((1, size, size), env.nextSeed()) for _ in range(count)]
+
+
+def _peSeries(env, count):
+    options = env.options
+    return [writeDicomSeries(os.path.join(env.folder, "dicom", f"series{env.nextSeed()}"), options.slices,
+                             options.sliceSize, options.sliceSize, seed=env.nextSeed()) for _ in range(count)]
+
+
+def _timeJobs(jobs):
+    timings = []
+    for job, items in jobs:
+        startTime = time.perf_counter()
+        job.runSynchronously()
+        timings.append((time.perf_counter() - startTime, items))
+    return timings
+
+
+def scenarioChestSingle(transport):
+    def run(env, count):
+        return _timeJobs([(chestJob(env, image, transport), 1) for image in _chestImages(env, count)])
+    return run
+
+
+def scenarioChestRepeat(env, count):
+    """The same image again and again: the warm up run fills the result cache, the timed runs are cache hits."""
+    size = env.options.imageSize
+    image = syntheticImage((1, size, size), seed=0)
+    return _timeJobs([(chestJob(env, image, "array"), 1) for _ in range(count)])
+
+
+def scenarioPESingle(transport):
+    def run(env, count):
+        return _timeJobs([(peJob(env, series, transport), 1) for series in _peSeries(env, count)])
+    return run
+
+
+def scenarioChestBatch(env, count):
+    options = env.options
+    model = env.chestModel
+    timings = []
+    for _ in range(count):
+        items = [BatchItem(key=f"image{env.nextSeed()}", source=image) for image in _chestImages(env, options.batchItems)]
+
+        def prepare(job, context, batch):
+            for item in batch:
+                item.cacheKey = cacheKey(model.name, model.modelVersion, hashVolume(item.source, np.eye(4)),
+                                         {"confidence": CONFIDENCE_FLOOR})
+                item.request = {"confidence": CONFIDENCE_FLOOR}
+                item.volume = (item.source, np.eye(4))
+
+        def infer(job, context, batch):
+            with env.scheduler.lease(model.name, PRIORITY_BATCH) as lease:
+                results, _ = lease.serverClient.inferVolumeBatch(model.name, [item.volume for item in batch],
+                                                                 [item.request for item in batch])
+            for item, result in zip(batch, results):
+                item.result = result
+
+        timings.extend(_timeBatchJob(env, model, items, prepare, infer))
+    return timings
+
+
+def scenarioPEBatch(env, count):
+    options = env.options
+    model = env.peModel
+    timings = []
+    for _ in range(count):
+        items = [BatchItem(key=series["studyInstanceUID"] + "_" + series["seriesInstanceUID"], source=series)
+                 for series in _peSeries(env, options.batchItems)]
+
+        def prepare(job, context, batch):
+            for item in batch:
+                series = item.source
+                item.cacheKey = cacheKey(model.name, model.modelVersion, seriesIdentity(
+                    series["studyInstanceUID"], series["seriesInstanceUID"], len(series["files"])))
+                item.request = {"input": item.key, "instanceUIDs": series["instanceUIDs"]}
+
+        def transfer(job, context, batch):
+            for item in batch:
+                series = item.source
+                stageFiles(series["files"], os.path.join(model.inputFolder, series["studyInstanceUID"],
+                                                         series["seriesInstanceUID"]))
+
+        def infer(job, context, batch):
+            with env.scheduler.lease(model.name, PRIORITY_BATCH) as lease:
+                results = lease.serverClient.inferBatch(model.name, [item.request for item in batch])
+            for item, result in zip(batch, results):
+                item.result = result
+
+        timings.extend(_timeBatchJob(env, model, items, prepare, infer, transfer))
+    return timings
+
+
+def _timeBatchJob(env, model, items, prepare, infer, transfer=None):
+    store = ResultStore(os.path.join(env.folder, f"store{env.nextSeed()}.sqlite"))
+    try:
+        job = createBatchJob(f"{model.name} batch inference", model.name, items, store, env.options.batchSize,
+                             prepare, infer, skipExisting=False, cache=env.cache, transfer=transfer)
+        timing = _timeJobs([(job, len(items))])
+        if job.result["failed"]:
+            raise RuntimeError(f"{job.result['failed']} inputs of the {model.name} batch failed")
+        return timing
+    finally:
+        store.close()
+
+
+SCENARIOS = {
+    "chest-single-exec": scenarioChestSingle("exec"),
+    "chest-single-array": scenarioChestSingle("array"),
+    "chest-single-nrrd": scenarioChestSingle("nrrd"),
+    "chest-single-shm": scenarioChestSingle("shm"),
+    "chest-repeat-cached": scenarioChestRepeat,
+    "chest-batch": scenarioChestBatch,
+    "pe-single-exec": scenarioPESingle("exec"),
+    "pe-single-server": scenarioPESingle("server"),
+    "pe-batch": scenarioPEBatch,
+}
+# Batch scenarios run all their inputs in one timed job instead of `runs` timed jobs
+_BATCH_SCENARIOS = {"chest-batch", "pe-batch"}
+
+
+#
+# Measurement
+#
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def runScenario(env: BenchmarkEnvironment, name: str) -> dict:
+    """Warm up, time the scenario and measure its peak memory. Returns the metrics of the scenario."""
+    scenario = SCENARIOS[name]
+    runs = 1 if name in _BATCH_SCENARIOS else max(env.options.runs, 1)
+    scenario(env, 1)  # warm up: start the servers, fill the file system caches
+
+    recorder = sharedSpanRecorder()
+    recorder.clear()
+    timings = scenario(env, runs)
+    stages = {row["name"]: row["mean"] for row in recorder.summary()}
+
+    peakMemory = None
+    if env.options.measureMemory:
+        tracemalloc.start()
+        try:
+            scenario(env, 1)
+            peakMemory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    latencies = [seconds for seconds, _ in timings]
+    items = sum(count for _, count in timings)
+    return {
+        "runs": len(timings),
+        "items": items,
+        "latency": {"mean": statistics.mean(latencies), "p50": _percentile(latencies, 0.5),
+                    "p95": _percentile(latencies, 0.95), "min": min(latencies), "max": max(latencies)},
+        "throughput": items / sum(latencies) if sum(latencies) > 0 else 0.0,
+        "peakMemoryMB": peakMemory,
+        "stages": stages,
+    }
+
+
+def runBenchmarks(options: BenchmarkOptions, scenarioNames=None, log=print) -> dict:
+    results = {"options": asdict(options), "platform": platform.platform(), "python": platform.python_version(),
+               "scenarios": {}}
+    env = BenchmarkEnvironment(options)
+    try:
+        for name in scenarioNames or list(SCENARIOS):
+            log(f"Running {name}...")
+            results["scenarios"][name] = runScenario(env, name)
+    finally:
+        env.close()
+    return results
+
+
+def compareWithBaseline(results: dict, baseline: dict, tolerance: float = 0.25, minimumSeconds: float = 0.005) -> list:
+    """
+    Regressions of `results` against `baseline`, as human readable strings.
+    Latencies and memory may grow and throughput may drop by `tolerance` (relative) before being flagged;
+    changes of the mean latency below `minimumSeconds` are ignored as noise.
+    """
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("mean", "p95"):
+            old, new = previous["latency"][metric], current["latency"][metric]
+            if new > old * (1 + tolerance) and new - old > minimumSeconds:
+                regressions.append(f"{name}: latency {metric} {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+        slower = current["latency"]["mean"] - previous["latency"]["mean"] > minimumSeconds
+        if slower and current["throughput"] < previous["throughput"] / (1 + tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput']:.2f} -> {current['throughput']:.2f} items/s")
+        if previous.get("peakMemoryMB") and current.get("peakMemoryMB") and \
+                current["peakMemoryMB"] > previous["peakMemoryMB"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {previous['peakMemoryMB']:.1f} MB -> {current['peakMemoryMB']:.1f} MB")
+    return regressions
+
+
+def formatResults(results: dict, stageCount: int = 4) -> str:
+    lines = [f"{'Scenario':<22}{'Runs':>5}{'Mean ms':>10}{'p95 ms':>10}{'Items/s':>10}{'Peak MB':>10}  Slowest stages (mean ms)"]
+    for name, metrics in results["scenarios"].items():
+        stages = sorted(metrics["stages"].items(), key=lambda stage: stage[1], reverse=True)[:stageCount]
+        memory = f"{metrics['peakMemoryMB']:.1f}" if metrics["peakMemoryMB"] is not None else "-"
+        lines.append(f"{name:<22}{metrics['runs']:>5}{metrics['latency']['mean'] * 1000:>10.1f}"
+                     f"{metrics['latency']['p95'] * 1000:>10.1f}{metrics['throughput']:>10.2f}{memory:>10}  "
+                     + ", ".join(f"{stage} {seconds * 1000:.1f}" for stage, seconds in stages))
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    defaults = BenchmarkOptions()
+    parser = argparse.ArgumentParser(description="Offline benchmark of the chest X-ray and PE inference paths.")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="scenario to run, can be repeated (default: all)")
+    parser.add_argument("--runs", type=int, default=defaults.runs)
+    parser.add_argument("--batch-items", type=int, default=defaults.batchItems)
+    parser.add_argument("--batch-size", type=int, default=defaults.batchSize)
+    parser.add_argument("--image-size", type=int, default=defaults.imageSize)
+    parser.add_argument("--slices", type=int, default=defaults.slices)
+    parser.add_argument("--slice-size", type=int, default=defaults.sliceSize)
+    parser.add_argument("--model-latency", type=float, default=defaults.modelLatency)
+    parser.add_argument("--model-load-time", type=float, default=defaults.modelLoadTime)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run of every scenario")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline")
+    parser.add_argument("--baseline", help="compare with a baseline, the exit code is 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change flagged as regression")
+    args = parser.parse_args(argv)
+
+    options = BenchmarkOptions(runs=args.runs, batchItems=args.batch_items, batchSize=args.batch_size,
+                               imageSize=args.image_size, slices=args.slices, sliceSize=args.slice_size,
+                               modelLatency=args.model_latency, modelLoadTime=args.model_load_time,
+                               measureMemory=not args.no_memory)
+    results = runBenchmarks(options, args.scenario)
+    print(formatResults(results))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("options") != results["options"]:
+            print("Warning: the baseline was recorded with different options")
+        regressions = compareWithBaseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regression against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Memory-bounded export of large volumes to the folder shared with a model container.
+
+`slicer.util.saveNode` and the array transfer both hold a second full-size buffer of the volume (the
+writer's or a copy of the voxels). For very large series, and several jobs exporting at once, the volume
+is instead written slab by slab from a zero-copy NumPy view of the vtkImageData scalars:
+
+- a slab that is contiguous and little endian is written straight from the view, nothing is allocated;
+- a slab that has to be converted (byte order, layout) or gzip compressed allocates at most one slab at a
+  time, and only after reserving its bytes from a MemoryBudget shared by all exports of the process.
+
+The peak memory of all concurrent exports is therefore bounded by the budget limit, whatever the size or
+number of the volumes. The file is written under a temporary name and renamed when complete, so the
+model never reads a partial volume.
+"""
+
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from .Timing import span
+from .VolumeTransfer import TransferStats
+
+# Bytes of one slab, the unit of writing and of the memory reservations
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+# Default limit of the memory shared by the exports of the process
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+_NRRD_TYPES = {
+    np.dtype(np.int8): "signed char", np.dtype(np.uint8): "uchar",
+    np.dtype(np.int16): "short", np.dtype(np.uint16): "ushort",
+    np.dtype(np.int32): "int", np.dtype(np.uint32): "uint",
+    np.dtype(np.int64): "longlong", np.dtype(np.uint64): "ulonglong",
+    np.dtype(np.float32): "float", np.dtype(np.float64): "double",
+}
+
+_COMPRESSIONS = (None, "gzip")
+
+#
+# MemoryBudget
+#
+
+
+class MemoryBudget:
+    """Bytes that the exports may allocate at the same time. Reservations wait until enough bytes are free."""
+
+    def __init__(self, limit: int = DEFAULT_MEMORY_LIMIT) -> None:
+        self.limit = limit
+        self.inUse = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def setLimit(self, limit: int) -> None:
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int, timeout: Optional[float] = None):
+        """
+        Hold `nbytes` of the budget for the duration of the block. A reservation larger than the limit
+        waits until it is the only one, so that it cannot wait forever.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.inUse and self.inUse + nbytes > self.limit:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"{nbytes} bytes could not be reserved within the memory budget")
+                self._condition.wait(remaining)
+            self.inUse += nbytes
+            self.peak = max(self.peak, self.inUse)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.inUse -= nbytes
+                self._condition.notify_all()
+
+
+_sharedBudget = None
+
+
+def sharedMemoryBudget() -> MemoryBudget:
+    """Budget of the process: concurrent exports of any module together stay below its limit."""
+    global _sharedBudget
+    if _sharedBudget is None:
+        _sharedBudget = MemoryBudget()
+    return _sharedBudget
+
+
+def volumeArrayView(volumeNode):
+    """
+    Zero-copy (K, J, I) view (with a last component axis for vector volumes) of the voxels of `volumeNode`.
+    The view shares the memory of the vtkImageData: keep the image data unchanged while the view is used.
+    """
+    from vtk.util import numpy_support
+
+    imageData = volumeNode.GetImageData()
+    scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    shape = tuple(reversed(imageData.GetDimensions()))
+    components = imageData.GetNumberOfScalarComponents()
+    return scalars.reshape(shape + ((components,) if components > 1 else ()))
+
+
+def slabs(array, chunkBytes: int = DEFAULT_CHUNK_BYTES):
+    """Yield (start, stop, array[start:stop]) views of whole slices along the first axis, about `chunkBytes` each."""
+    sliceBytes = max(array[:1].nbytes, 1)
+    step = max(chunkBytes // sliceBytes, 1)
+    for start in range(0, array.shape[0], step):
+        stop = min(start + step, array.shape[0])
+        yield start, stop, array[start:stop]
+
+
+def nrrdHeader(array, ijkToRas, compression: Optional[str] = None) -> bytes:
+    """NRRD header of a (K, J, I[, C]) array in the LPS space used by Slicer, with a blank line at the end."""
+    array = np.asarray(array)
+    if array.dtype.newbyteorder("=") not in _NRRD_TYPES:
+        raise ValueError(f"Unsupported voxel type {array.dtype}")
+    vector = array.ndim == 4
+    spatialShape = array.shape[:3]
+    rasToLps = np.diag([-1.0, -1.0, 1.0, 1.0])
+    ijkToLps = rasToLps @ np.asarray(ijkToRas, dtype=float).reshape(4, 4)
+    directions = " ".join("(" + ",".join(repr(float(value)) for value in ijkToLps[:3, axis]) + ")" for axis in range(3))
+    origin = "(" + ",".join(repr(float(value)) for value in ijkToLps[:3, 3]) + ")"
+    sizes = ([array.shape[3]] if vector else []) + list(reversed(spatialShape))
+    lines = [
+        "NRRD0004",
+        f"type: {_NRRD_TYPES[array.dtype.newbyteorder('=')]}",
+        f"dimension: {len(sizes)}",
+        "space: left-posterior-superior",
+        "sizes: " + " ".join(str(size) for size in sizes),
+        "space directions: " + ("none " if vector else "") + directions,
+        "kinds: " + ("vector " if vector else "") + "domain domain domain",
+        "endian: little",
+        "encoding: " + ("gzip" if compression == "gzip" else "raw"),
+        "space origin: " + origin,
+    ]
+    return ("\n".join(lines) + "\n\n").encode("ascii")
+
+
+def writeNrrd(path: str, array, ijkToRas, compression: Optional[str] = None,
+              chunkBytes: int = DEFAULT_CHUNK_BYTES, budget: Optional[MemoryBudget] = None) -> TransferStats:
+    """
+    Write a (K, J, I[, C]) array as an NRRD file, slab by slab.
+    :param compression: None (raw) or "gzip"
+    :param budget: memory budget of the slab buffers, default: the shared budget
+    :return: TransferStats of mode "nrrd" (encodeSeconds is the time spent writing)
+    """
+    if compression not in _COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression}")
+    budget = budget or sharedMemoryBudget()
+    startTime = time.perf_counter()
+    littleEndian = array.dtype.newbyteorder("<")
+    stats = TransferStats("nrrd", rawBytes=array.nbytes)
+    partPath = path + ".part"
+    with span("writeNrrd", path=path, bytes=array.nbytes), open(partPath, "wb") as f:
+        try:
+            f.write(nrrdHeader(array, ijkToRas, compression))
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 31) if compression == "gzip" else None
+            for _, _, slab in slabs(array, chunkBytes):
+                zeroCopy = slab.flags.c_contiguous and slab.dtype == littleEndian
+                if zeroCopy and compressor is None:
+                    f.write(memoryview(slab).cast("B"))
+                    continue
+                # converted slab and compressed output, at most one slab each
+                with budget.reserve(slab.nbytes * (1 if zeroCopy or compressor is None else 2)):
+                    data = memoryview(slab if zeroCopy else np.ascontiguousarray(slab, dtype=littleEndian)).cast("B")
+                    f.write(compressor.compress(data) if compressor is not None else data)
+                    del data
+            if compressor is not None:
+                f.write(compressor.flush())
+        except BaseException:
+            f.close()
+            os.remove(partPath)
+            raise
+    os.replace(partPath, path)
+    stats.wireBytes = os.path.getsize(path)
+    stats.encodeSeconds = time.perf_counter() - startTime
+    return stats
+
+
+def exportVolume(volumeNode, path: str, compression: Optional[str] = None, chunkBytes: int = DEFAULT_CHUNK_BYTES,
+                 budget: Optional[MemoryBudget] = None) -> TransferStats:
+    """Write the voxels of `volumeNode` to `path` with writeNrrd, from a zero-copy view of its image data."""
+    import slicer
+    import vtk
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    return writeNrrd(path, volumeArrayView(volumeNode), slicer.util.arrayFromVTKMatrix(ijkToRas), compression,
+                     chunkBytes, budget)
@@ -0,0 +1,309 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from .InferenceClient import InferenceClient
+from .Timing import span
+
+SERVER_CONTAINER_PORT = 8000
+
+#
+# ContainerSpec
+#
+
+
+@dataclass
+class ContainerSpec:
+    """
+    Describes how to create the inference container for one model image.
+
+    image - Docker image name, e.g. "chestyolov5".
+    volumes - host path -> {'bind': ..., 'mode': ...} mapping passed to `containers.run`.
+    gpuDeviceIds - GPU devices requested for the container, empty list for CPU only.
+    poolSize - maximum number of warm containers kept for this image.
+    serverPort - host port of the resident InferenceServer of the first container, None if the image has no server.
+    serverCommand - command starting the InferenceServer inside the container on SERVER_CONTAINER_PORT.
+    serverStartupTimeout - seconds to wait for the server to load its models before falling back to exec_run.
+    modelVersion - part of the result cache keys, change it when the image is rebuilt with new weights.
+    ipcMode - IPC namespace of the container, "host" to share the host's shared memory with the inference server
+      (needed by the shared memory volume transfer).
+    """
+
+    image: str
+    volumes: dict = field(default_factory=dict)
+    gpuDeviceIds: list = field(default_factory=lambda: ["0"])
+    poolSize: int = 1
+    serverPort: Optional[int] = None
+    serverCommand: Optional[str] = None
+    serverStartupTimeout: float = 60.0
+    modelVersion: str = "1"
+    ipcMode: Optional[str] = None
+
+    @property
+    def containerName(self) -> str:
+        return self.image + "_container"
+
+    def serverPortAt(self, index: int) -> Optional[int]:
+        return None if self.serverPort is None else self.serverPort + index
+
+    def serverUrlAt(self, index: int = 0) -> Optional[str]:
+        port = self.serverPortAt(index)
+        return None if port is None else f"http://127.0.0.1:{port}"
+
+    def containerNameAt(self, index: int) -> str:
+        """The first container keeps the historical "<image>_container" name so existing containers are reused."""
+        return self.containerName if index == 0 else f"{self.containerName}_{index}"
+
+
+class _PoolEntry:
+    def __init__(self, spec, index, container):
+        self.spec = spec
+        self.index = index
+        self.container = container
+        self.server = None
+        self.serverFailed = False
+        self.busy = False
+        self.lastUsed = time.monotonic()
+
+
+#
+# ContainerPool
+#
+
+
+class ContainerPool:
+    """
+    Keeps inference containers warm between requests.
+
+    A single Docker client is created lazily and reused for every request. Containers are looked up by
+    name (no listing of every container on the host), started once, health-checked when leased and
+    stopped by a background reaper after `idleTimeout` seconds without use.
+    """
+
+    def __init__(self, clientFactory: Optional[Callable] = None, idleTimeout: Optional[float] = 600.0, reapInterval: float = 30.0) -> None:
+        """
+        :param clientFactory: callable returning a docker client, defaults to `docker.from_env`
+        :param idleTimeout: seconds a container may stay unused before it is stopped, None disables stopping
+        :param reapInterval: seconds between two idle checks
+        """
+        self._clientFactory = clientFactory
+        self._client = None
+        self._clientLock = threading.Lock()
+        self._condition = threading.Condition()
+        self._entries = {}  # container name -> _PoolEntry
+        self.idleTimeout = idleTimeout
+        self.reapInterval = reapInterval
+        self._reaperStop = threading.Event()
+        self._reaperThread = None
+
+    @property
+    def client(self):
+        with self._clientLock:
+            if self._client is None:
+                if self._clientFactory is None:
+                    import docker
+                    self._clientFactory = docker.from_env
+                with span("docker.from_env"):
+                    self._client = self._clientFactory()
+        return self._client
+
+    def acquire(self, spec: ContainerSpec, timeout: Optional[float] = None):
+        """
+        Return a running container for `spec`, marked busy until `release` is called.
+        Blocks while all `spec.poolSize` containers are busy.
+        """
+        entry = self._reserve(spec, timeout)
+        # Docker calls and the server startup (up to serverStartupTimeout) run without the lock, the reserved
+        # entry is busy so no other caller takes it and the reaper leaves it alone
+        try:
+            if entry.container is None:
+                entry.container = self._findOrCreateContainer(spec, entry.index)
+            elif not self._ensureRunning(entry):
+                entry.container = self._findOrCreateContainer(spec, entry.index)
+            self._ensureServer(entry)
+        except BaseException:
+            with self._condition:
+                if entry.container is None:
+                    self._entries.pop(spec.containerNameAt(entry.index), None)
+                entry.busy = False
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            entry.lastUsed = time.monotonic()
+            self._condition.notify_all()
+        return entry.container
+
+    def _reserve(self, spec: ContainerSpec, timeout: Optional[float]) -> _PoolEntry:
+        """Mark a free slot of `spec` busy, a new slot has no container yet."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._startReaper()
+            while True:
+                for index in range(max(spec.poolSize, 1)):
+                    name = spec.containerNameAt(index)
+                    entry = self._entries.get(name)
+                    if entry is not None and entry.busy:
+                        continue
+                    if entry is None:
+                        entry = _PoolEntry(spec, index, None)
+                        self._entries[name] = entry
+                    entry.busy = True
+                    return entry
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No {spec.image} container became available")
+                self._condition.wait(remaining)
+
+    def release(self, container) -> None:
+        with self._condition:
+            entry = self._entries.get(container.name)
+            if entry is not None:
+                entry.busy = False
+                entry.lastUsed = time.monotonic()
+            self._condition.notify_all()
+
+    def serverClient(self, container) -> Optional[InferenceClient]:
+        """Client of the InferenceServer of a leased container, None if the container has no running server."""
+        with self._condition:
+            entry = self._entries.get(container.name)
+        return None if entry is None else entry.server
+
+    @contextmanager
+    def lease(self, spec: ContainerSpec, timeout: Optional[float] = None):
+        container = self.acquire(spec, timeout)
+        try:
+            yield container
+        finally:
+            self.release(container)
+
+    def isHealthy(self, container) -> bool:
+        try:
+            with span("container.reload", container=container.name):
+                container.reload()
+        except Exception:
+            return False
+        return container.status == "running"
+
+    def stopIdle(self, now: Optional[float] = None) -> list:
+        """Stop containers that have not been used for `idleTimeout` seconds. Returns the stopped names."""
+        if self.idleTimeout is None:
+            return []
+        now = time.monotonic() if now is None else now
+        with self._condition:
+            idle = [name for name, entry in self._entries.items()
+                    if not entry.busy and now - entry.lastUsed >= self.idleTimeout]
+            entries = [self._entries.pop(name) for name in idle]
+        for entry in entries:
+            self._stopContainer(entry.container)
+        return idle
+
+    def shutdown(self, stopContainers: bool = True) -> None:
+        """Stop the idle reaper and, optionally, all containers that are not in use."""
+        self._reaperStop.set()
+        with self._condition:
+            entries = [entry for entry in self._entries.values() if not entry.busy]
+            self._entries = {name: entry for name, entry in self._entries.items() if entry.busy}
+        if stopContainers:
+            for entry in entries:
+                self._stopContainer(entry.container)
+
+    def _ensureRunning(self, entry) -> bool:
+        if self.isHealthy(entry.container):
+            return True
+        try:
+            entry.container.start()
+            return self.isHealthy(entry.container)
+        except Exception:
+            logging.warning(f"Container {entry.container.name} could not be restarted, it will be recreated")
+            return False
+
+    def _ensureServer(self, entry) -> None:
+        """Start the resident InferenceServer in the container unless it already answers."""
+        spec = entry.spec
+        entry.server = None
+        if spec.serverPort is None:
+            return
+        client = InferenceClient(spec.serverUrlAt(entry.index))
+        if not client.isAvailable(spec.image, timeout=0.5):
+            # Do not retry on every lease once the image proved to have no working server
+            if not spec.serverCommand or entry.serverFailed:
+                return
+            logging.info(f"Starting inference server in {entry.container.name}")
+            entry.container.exec_run(cmd=spec.serverCommand, detach=True)
+            with span("inference server startup", image=spec.image):
+                started = client.waitUntilAvailable(spec.image, timeout=spec.serverStartupTimeout)
+            if not started:
+                logging.warning(f"Inference server of {entry.container.name} did not start, falling back to exec_run")
+                entry.serverFailed = True
+                return
+        entry.server = client
+
+    def _findOrCreateContainer(self, spec, index):
+        name = spec.containerNameAt(index)
+        with span("containers.list", container=name):
+            matching = [container for container in self.client.containers.list(all=True, filters={"name": name})
+                        if container.name == name]
+        if matching:
+            container = matching[0]
+            if container.status != "running":
+                container.start()
+            logging.info(f"Reusing container {name}")
+            return container
+
+        logging.info(f"Creating container {name}")
+        deviceRequests = []
+        if spec.gpuDeviceIds:
+            import docker
+            deviceRequests.append(docker.types.DeviceRequest(device_ids=list(spec.gpuDeviceIds), capabilities=[["gpu"]]))
+        ports = {}
+        if spec.serverPort is not None:
+            ports[f"{SERVER_CONTAINER_PORT}/tcp"] = ("127.0.0.1", spec.serverPortAt(index))
+        options = {"ipc_mode": spec.ipcMode} if spec.ipcMode else {}
+        with span("containers.run", image=spec.image):
+            return self.client.containers.run(spec.image, detach=True, name=name, volumes=spec.volumes, ports=ports,
+                                              auto_remove=False, device_requests=deviceRequests, **options)
+
+    def _stopContainer(self, container) -> None:
+        try:
+            container.stop()
+            logging.info(f"Stopped idle container {container.name}")
+        except Exception as e:
+            logging.warning(f"Failed to stop container {container.name}: {e}")
+
+    def _startReaper(self) -> None:
+        if self._reaperThread is not None and self._reaperThread.is_alive():
+            return
+        self._reaperStop.clear()
+        self._reaperThread = threading.Thread(target=self._reapLoop, name="ContainerPoolReaper", daemon=True)
+        self._reaperThread.start()
+
+    def _reapLoop(self) -> None:
+        while not self._reaperStop.wait(self.reapInterval):
+            self.stopIdle()
+
+
+_sharedPool = None
+
+
+def sharedContainerPool() -> ContainerPool:
+    """
+    Pool of the process, so that a container started for one job is still warm for the next one.
+    Every module uses it: in Slicer it is shut down once when the application quits, never by a module.
+    """
+    global _sharedPool
+    if _sharedPool is None:
+        _sharedPool = ContainerPool()
+        _shutdownOnQuit(_sharedPool)
+    return _sharedPool
+
+
+def _shutdownOnQuit(pool: ContainerPool) -> None:
+    try:
+        import slicer
+    except ImportError:
+        return  # scripts and the benchmark shut their pools down themselves
+    if getattr(slicer, "app", None) is not None:
+        slicer.app.connect("aboutToQuit()", pool.shutdown)
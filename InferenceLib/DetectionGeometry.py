@@ -0,0 +1,60 @@
+"""
+Geometry of bounding box detections.
+
+Converts the "bounding_boxes" list of a detection result into homogeneous IJK corner coordinates in one
+(N, 4, 4) array and transforms all of them to RAS with a single matrix product, ready to be passed to
+DetectionOverlay.
+"""
+
+import numpy as np
+
+# Drawing order of the box corners: bottom left, top left, top right, bottom right
+_CORNER_KEYS = [("left", "bottom"), ("left", "top"), ("right", "top"), ("right", "bottom")]
+
+
+def boxesToIjkCorners(boundingBoxes: list, sliceIndex: int = 0):
+    """
+    Homogeneous IJK coordinates of the box corners.
+    :param boundingBoxes: list of {"left", "bottom", "right", "top"[, "slice"]} in pixel coordinates
+    :param sliceIndex: K coordinate of boxes without their own "slice" (frame) index
+    :return: (N, 4, 4) array, corners in drawing order, each (i, j, k, 1)
+    """
+    boxCount = len(boundingBoxes)
+    corners = np.ones((boxCount, 4, 4))
+    if boxCount == 0:
+        return corners
+    extents = np.array([[box["left"], box["bottom"], box["right"], box["top"]] for box in boundingBoxes], dtype=float)
+    columns = {"left": 0, "bottom": 1, "right": 2, "top": 3}
+    for cornerIndex, (iKey, jKey) in enumerate(_CORNER_KEYS):
+        corners[:, cornerIndex, 0] = extents[:, columns[iKey]]
+        corners[:, cornerIndex, 1] = extents[:, columns[jKey]]
+    corners[:, :, 2] = np.array([box.get("slice", sliceIndex) for box in boundingBoxes], dtype=float)[:, None]
+    return corners
+
+
+def ijkToRasCorners(ijkCorners, ijkToRas):
+    """Transform (N, 4, 4) homogeneous IJK corners with a 4x4 matrix, returns (N, 4, 3) RAS corners."""
+    matrix = np.asarray(ijkToRas, dtype=float).reshape(4, 4)
+    return (np.asarray(ijkCorners, dtype=float) @ matrix.T)[..., :3]
+
+
+def detectionCorners(boundingBoxes: list, ijkToRas, sliceIndex: int = 0):
+    """RAS corners (N, 4, 3) of all boxes of a detection result."""
+    return ijkToRasCorners(boxesToIjkCorners(boundingBoxes, sliceIndex), ijkToRas)
+
+
+def boxEdges(rasCorners):
+    """Line segments of the box outlines, (N, 4, 2, 3): corner c to corner c + 1 (the last one closes the box)."""
+    rasCorners = np.asarray(rasCorners, dtype=float)
+    return np.stack([rasCorners, np.roll(rasCorners, -1, axis=1)], axis=2)
+
+
+def boxRois(rasCorners):
+    """Center (N, 3) and axis aligned size (N, 3) of the boxes, e.g. for ROI markups."""
+    rasCorners = np.asarray(rasCorners, dtype=float)
+    lower, upper = rasCorners.min(axis=1), rasCorners.max(axis=1)
+    return (lower + upper) / 2.0, upper - lower
+
+
+def confidences(boundingBoxes: list, default: float = 1.0):
+    return np.array([box.get("confidence", default) for box in boundingBoxes], dtype=float)
@@ -0,0 +1,148 @@
+"""
+Rendering of bounding box detections.
+
+All boxes of one detection set (one inference result) are drawn by a single model node whose polydata
+holds one closed polyline per box, instead of four markups line nodes per box. Box outlines are built
+from an (N, 4, 3) array of RAS corners without Python loops, the scene is updated in batch processing
+state, and single boxes are hidden by flagging their cell as hidden instead of removing nodes.
+"""
+
+import numpy as np
+
+from .Timing import timed
+
+# Attribute marking the model nodes created by DetectionOverlay
+DETECTION_SET_ATTRIBUTE = "InferenceLib.DetectionSet"
+
+
+def outlinePolyData(rasCorners, confidences=None):
+    """
+    Build a vtkPolyData with one closed polyline per box.
+    :param rasCorners: (N, 4, 3) array of box corners in RAS, in drawing order
+    :param confidences: optional (N,) array stored as "Confidence" cell data
+    Cell i is box i; the "BoxId" cell array holds the box index.
+    """
+    import vtk
+    from vtk.util import numpy_support
+
+    rasCorners = np.asarray(rasCorners, dtype=float).reshape(-1, 4, 3)
+    boxCount = len(rasCorners)
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(rasCorners.reshape(-1, 3), deep=True))
+
+    # Each box is the polyline 0-1-2-3-0 of its own four points
+    connectivity = (np.arange(boxCount)[:, None] * 4 + np.array([0, 1, 2, 3, 0])[None, :]).ravel()
+    offsets = np.arange(0, 5 * boxCount + 1, 5)
+    lines = vtk.vtkCellArray()
+    lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets.astype(np.int64), deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(connectivity.astype(np.int64), deep=True))
+
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    polyData.SetLines(lines)
+
+    boxIds = numpy_support.numpy_to_vtk(np.arange(boxCount, dtype=np.int32), deep=True)
+    boxIds.SetName("BoxId")
+    polyData.GetCellData().AddArray(boxIds)
+    if confidences is not None:
+        confidenceArray = numpy_support.numpy_to_vtk(np.asarray(confidences, dtype=float), deep=True)
+        confidenceArray.SetName("Confidence")
+        polyData.GetCellData().AddArray(confidenceArray)
+
+    # Cells flagged as hidden are skipped by the mappers, used to hide single boxes
+    ghostArray = vtk.vtkUnsignedCharArray()
+    ghostArray.SetName(vtk.vtkDataSetAttributes.GhostArrayName())
+    ghostArray.SetNumberOfTuples(boxCount)
+    ghostArray.Fill(0)
+    polyData.GetCellData().AddArray(ghostArray)
+    return polyData
+
+
+#
+# DetectionOverlay
+#
+
+
+class DetectionOverlay:
+    """Creates and updates the model nodes showing detection sets in the slice views."""
+
+    def __init__(self, namePrefix: str = "Detections", color=(1.0, 0.0, 0.0), lineWidth: float = 4.0) -> None:
+        self.namePrefix = namePrefix
+        self.color = color
+        self.lineWidth = lineWidth
+
+    @timed("DetectionOverlay.addDetectionSet")
+    def addDetectionSet(self, rasCorners, confidences=None, name=None):
+        """Show all boxes of one result as a single model node and return the node."""
+        import slicer
+
+        scene = slicer.mrmlScene
+        scene.StartState(scene.BatchProcessState)
+        try:
+            modelNode = scene.AddNewNodeByClass("vtkMRMLModelNode", name or scene.GenerateUniqueName(self.namePrefix))
+            modelNode.SetAttribute(DETECTION_SET_ATTRIBUTE, self.namePrefix)
+            modelNode.SetAndObservePolyData(outlinePolyData(rasCorners, confidences))
+            modelNode.CreateDefaultDisplayNodes()
+            displayNode = modelNode.GetDisplayNode()
+            displayNode.SetColor(*self.color)
+            displayNode.SetLineWidth(self.lineWidth)
+            displayNode.SetVisibility2D(True)
+            # The boxes lie in the image plane, project them instead of intersecting them with the slice
+            displayNode.SetSliceDisplayModeToProjection()
+            displayNode.SetSliceIntersectionThickness(int(self.lineWidth))
+        finally:
+            scene.EndState(scene.BatchProcessState)
+        return modelNode
+
+    def detectionSetNodes(self) -> list:
+        import slicer
+
+        return [node for node in slicer.util.getNodesByClass("vtkMRMLModelNode")
+                if node.GetAttribute(DETECTION_SET_ATTRIBUTE) == self.namePrefix]
+
+    def boxCount(self, modelNode) -> int:
+        polyData = modelNode.GetPolyData()
+        return polyData.GetNumberOfCells() if polyData else 0
+
+    def setBoxVisible(self, modelNode, boxIndex: int, visible: bool) -> None:
+        """Hide or show one box of a detection set, without touching the other boxes."""
+        import vtk
+
+        polyData = modelNode.GetPolyData()
+        if polyData is None or not 0 <= boxIndex < polyData.GetNumberOfCells():
+            return
+        ghostArray = polyData.GetCellData().GetArray(vtk.vtkDataSetAttributes.GhostArrayName())
+        ghostArray.SetValue(boxIndex, 0 if visible else vtk.vtkDataSetAttributes.HIDDENCELL)
+        ghostArray.Modified()
+        polyData.Modified()
+
+    def setBoxesVisible(self, modelNode, visible) -> None:
+        """Set the visibility of all boxes of a detection set at once from a boolean (N,) array."""
+        import vtk
+        from vtk.util import numpy_support
+
+        polyData = modelNode.GetPolyData()
+        if polyData is None:
+            return
+        ghostArray = polyData.GetCellData().GetArray(vtk.vtkDataSetAttributes.GhostArrayName())
+        ghostValues = numpy_support.vtk_to_numpy(ghostArray)
+        ghostValues[:] = np.where(np.asarray(visible, dtype=bool), 0, vtk.vtkDataSetAttributes.HIDDENCELL)
+        ghostArray.Modified()
+        polyData.Modified()
+
+    def removeDetectionSet(self, modelNode) -> None:
+        import slicer
+
+        slicer.mrmlScene.RemoveNode(modelNode)
+
+    def clear(self) -> None:
+        import slicer
+
+        scene = slicer.mrmlScene
+        scene.StartState(scene.BatchProcessState)
+        try:
+            for modelNode in self.detectionSetNodes():
+                scene.RemoveNode(modelNode)
+        finally:
+            scene.EndState(scene.BatchProcessState)
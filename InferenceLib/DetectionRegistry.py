@@ -0,0 +1,156 @@
+"""
+Registry of the detection sets shown by a DetectionOverlay.
+
+Every inference run gets a run id mapped to the ID of its model node, and every box of the run is
+addressed by its index in that node. Clearing, hiding or showing a box is a dictionary lookup plus one
+cell flag, whatever the number of markups in the scene, and filtering by confidence updates a whole run
+with one array operation. The registry is serialized to JSON so that it can be kept in the module
+parameter node and restored with the scene.
+"""
+
+import json
+from typing import Callable, Optional
+
+import numpy as np
+
+#
+# DetectionRun
+#
+
+
+class DetectionRun:
+    """Boxes of one inference run: confidence, visibility and cleared state per box index."""
+
+    def __init__(self, runId: str, nodeID: str, confidences, visible=None, cleared=None, minimumConfidence: float = 0.0) -> None:
+        self.runId = runId
+        self.nodeID = nodeID
+        self.confidences = np.asarray(confidences, dtype=float)
+        boxCount = len(self.confidences)
+        self.visible = np.ones(boxCount, dtype=bool) if visible is None else np.asarray(visible, dtype=bool)
+        self.cleared = np.zeros(boxCount, dtype=bool) if cleared is None else np.asarray(cleared, dtype=bool)
+        self.minimumConfidence = minimumConfidence
+
+    @property
+    def boxCount(self) -> int:
+        return len(self.confidences)
+
+    def shownBoxes(self):
+        """Boxes drawn in the views: not cleared, not hidden and above the confidence filter."""
+        return self.visible & ~self.cleared & (self.confidences >= self.minimumConfidence)
+
+    def toDict(self) -> dict:
+        return {"nodeID": self.nodeID, "confidences": self.confidences.tolist(), "visible": self.visible.tolist(),
+                "cleared": self.cleared.tolist(), "minimumConfidence": self.minimumConfidence}
+
+    @classmethod
+    def fromDict(cls, runId: str, values: dict) -> "DetectionRun":
+        return cls(runId, values["nodeID"], values["confidences"], values.get("visible"), values.get("cleared"),
+                   values.get("minimumConfidence", 0.0))
+
+
+#
+# DetectionRegistry
+#
+
+
+class DetectionRegistry:
+    """
+    Maps run ids and box indices to the model nodes of a DetectionOverlay.
+    `onChanged(registry)` is called after every operation, e.g. to store `toJson()` in the parameter node.
+    `getNodeByID(nodeID)` finds the model nodes, slicer.mrmlScene.GetNodeByID by default.
+    """
+
+    def __init__(self, overlay, onChanged: Optional[Callable] = None, getNodeByID: Optional[Callable] = None) -> None:
+        self.overlay = overlay
+        self.onChanged = onChanged
+        self.getNodeByID = getNodeByID
+        self.runs = {}
+        self._nextRunNumber = 1
+
+    def addRun(self, modelNode, confidences) -> str:
+        runId = f"run{self._nextRunNumber}"
+        self._nextRunNumber += 1
+        self.runs[runId] = DetectionRun(runId, modelNode.GetID(), confidences)
+        self._changed()
+        return runId
+
+    def runIds(self) -> list:
+        return list(self.runs)
+
+    @property
+    def latestRunId(self) -> Optional[str]:
+        return next(reversed(self.runs), None)
+
+    def modelNode(self, runId: str):
+        run = self.runs.get(runId)
+        return self._nodeByID(run.nodeID) if run is not None else None
+
+    def setBoxVisible(self, runId: str, boxIndex: int, visible: bool) -> bool:
+        """Hide or show one box. Returns False if the run or box does not exist."""
+        run = self.runs.get(runId)
+        if run is None or not 0 <= boxIndex < run.boxCount:
+            return False
+        run.visible[boxIndex] = visible
+        self._updateBox(run, boxIndex)
+        self._changed()
+        return True
+
+    def clearBox(self, runId: str, boxIndex: int) -> bool:
+        """Remove one box from the views. Returns False if the run or box does not exist."""
+        run = self.runs.get(runId)
+        if run is None or not 0 <= boxIndex < run.boxCount:
+            return False
+        run.cleared[boxIndex] = True
+        self._updateBox(run, boxIndex)
+        self._changed()
+        return True
+
+    def filterByConfidence(self, minimumConfidence: float, runId: Optional[str] = None) -> None:
+        """Show only the boxes with a confidence of at least `minimumConfidence`, in one run or in all runs."""
+        for run in ([self.runs[runId]] if runId is not None else self.runs.values()):
+            run.minimumConfidence = minimumConfidence
+            modelNode = self.modelNode(run.runId)
+            if modelNode is not None:
+                self.overlay.setBoxesVisible(modelNode, run.shownBoxes())
+        self._changed()
+
+    def clearRun(self, runId: str) -> None:
+        """Remove all boxes of one run, together with its model node."""
+        modelNode = self.modelNode(runId)
+        if modelNode is not None:
+            self.overlay.removeDetectionSet(modelNode)
+        self.runs.pop(runId, None)
+        self._changed()
+
+    def clearAll(self) -> None:
+        self.overlay.clear()
+        self.runs.clear()
+        self._changed()
+
+    def toJson(self) -> str:
+        return json.dumps({"nextRunNumber": self._nextRunNumber,
+                           "runs": {runId: run.toDict() for runId, run in self.runs.items()}})
+
+    def loadJson(self, text: str) -> None:
+        """Restore the registry, e.g. from the parameter node of a loaded scene. Runs without node are dropped."""
+        values = json.loads(text) if text else {}
+        self._nextRunNumber = values.get("nextRunNumber", 1)
+        self.runs = {runId: DetectionRun.fromDict(runId, run) for runId, run in values.get("runs", {}).items()
+                     if self._nodeByID(run["nodeID"]) is not None}
+
+    def _nodeByID(self, nodeID: str):
+        if self.getNodeByID is not None:
+            return self.getNodeByID(nodeID)
+        import slicer
+
+        return slicer.mrmlScene.GetNodeByID(nodeID)
+
+    def _updateBox(self, run, boxIndex) -> None:
+        modelNode = self.modelNode(run.runId)
+        if modelNode is not None:
+            shown = run.visible[boxIndex] and not run.cleared[boxIndex] and run.confidences[boxIndex] >= run.minimumConfidence
+            self.overlay.setBoxVisible(modelNode, boxIndex, bool(shown))
+
+    def _changed(self) -> None:
+        if self.onChanged is not None:
+            self.onChanged(self)
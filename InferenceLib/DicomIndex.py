@@ -0,0 +1,177 @@
+"""
+Per-series DICOM metadata index built from the Slicer DICOM database.
+
+The DICOM database already keeps the tags of every imported file, so the UIDs, file paths and slice
+positions of a series are read from there once and kept in a SeriesIndex. Staging, result routing and
+the slice to probability lookup use the index instead of parsing DICOM headers from disk again.
+"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .Timing import timed
+
+STUDY_INSTANCE_UID_TAG = "0020,000D"
+SERIES_INSTANCE_UID_TAG = "0020,000E"
+MODALITY_TAG = "0008,0060"
+PATIENT_ID_TAG = "0010,0020"
+STUDY_DATE_TAG = "0008,0020"
+IMAGE_POSITION_TAG = "0020,0032"
+IMAGE_ORIENTATION_TAG = "0020,0037"
+
+INDEX_TAGS = [STUDY_INSTANCE_UID_TAG, SERIES_INSTANCE_UID_TAG, MODALITY_TAG, PATIENT_ID_TAG, STUDY_DATE_TAG,
+              IMAGE_POSITION_TAG, IMAGE_ORIENTATION_TAG]
+
+
+def _parseNumbers(value: str) -> list:
+    try:
+        return [float(number) for number in value.split("\\")] if value else []
+    except ValueError:
+        return []
+
+
+def slicePosition(position: list, orientation: list) -> Optional[float]:
+    """Distance of a slice along the slice normal, from ImagePositionPatient and ImageOrientationPatient."""
+    if len(position) != 3 or len(orientation) != 6:
+        return None
+    row, column = orientation[:3], orientation[3:]
+    normal = [row[1] * column[2] - row[2] * column[1],
+              row[2] * column[0] - row[0] * column[2],
+              row[0] * column[1] - row[1] * column[0]]
+    return sum(p * n for p, n in zip(position, normal))
+
+
+#
+# SeriesIndex
+#
+
+
+@dataclass
+class SeriesIndex:
+    """
+    Metadata of one series, instances in the order of the loaded volume slices.
+
+    slicePositions - distance of each instance along the slice normal, None where the tags are missing.
+    """
+
+    studyInstanceUID: str
+    seriesInstanceUID: str
+    instanceUIDs: list
+    files: list
+    slicePositions: list = field(default_factory=list)
+    modality: str = ""
+    patientID: str = ""
+    studyDate: str = ""
+
+    def __post_init__(self) -> None:
+        self._instanceIndex = {uid: index for index, uid in enumerate(self.instanceUIDs)}
+
+    @property
+    def basename(self) -> str:
+        """Name of the series in the model input and result folders."""
+        return self.studyInstanceUID + "_" + self.seriesInstanceUID
+
+    def sliceIndex(self, instanceUID: str) -> Optional[int]:
+        return self._instanceIndex.get(instanceUID)
+
+    def toDict(self) -> dict:
+        return {"studyInstanceUID": self.studyInstanceUID, "seriesInstanceUID": self.seriesInstanceUID,
+                "instanceUIDs": list(self.instanceUIDs), "files": list(self.files), "modality": self.modality,
+                "patientID": self.patientID, "studyDate": self.studyDate}
+
+    @classmethod
+    def fromDatabase(cls, database, instanceUIDs: list) -> "SeriesIndex":
+        """Build the index of the series made of `instanceUIDs` (in slice order) from the database tag cache."""
+        files = [database.fileForInstance(uid) for uid in instanceUIDs]
+        if not files or not all(files):
+            raise ValueError("Could not retrieve the file path for the given instance UID.")
+        firstFile = files[0]
+        orientation = _parseNumbers(database.fileValue(firstFile, IMAGE_ORIENTATION_TAG))
+        positions = [slicePosition(_parseNumbers(database.fileValue(path, IMAGE_POSITION_TAG)), orientation)
+                     for path in files]
+        return cls(
+            studyInstanceUID=database.fileValue(firstFile, STUDY_INSTANCE_UID_TAG),
+            seriesInstanceUID=database.fileValue(firstFile, SERIES_INSTANCE_UID_TAG),
+            instanceUIDs=list(instanceUIDs),
+            files=files,
+            slicePositions=positions,
+            modality=database.fileValue(firstFile, MODALITY_TAG),
+            patientID=database.fileValue(firstFile, PATIENT_ID_TAG),
+            studyDate=database.fileValue(firstFile, STUDY_DATE_TAG),
+        )
+
+
+#
+# DicomIndex
+#
+
+
+class DicomIndex:
+    """Cache of SeriesIndex objects, so that the tags of a series are read once per session."""
+
+    def __init__(self, database, maxSeries: int = 64) -> None:
+        self.database = database
+        self.maxSeries = maxSeries
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self._precacheTags()
+
+    @timed("DicomIndex.seriesForInstances")
+    def seriesForInstances(self, instanceUIDs: list) -> SeriesIndex:
+        """Index of the series made of `instanceUIDs`, e.g. the DICOM.instanceUIDs attribute of a volume node."""
+        key = tuple(instanceUIDs)
+        with self._lock:
+            if key in self._series:
+                self._series.move_to_end(key)
+                return self._series[key]
+        series = SeriesIndex.fromDatabase(self.database, instanceUIDs)
+        with self._lock:
+            self._series[key] = series
+            while len(self._series) > self.maxSeries:
+                self._series.popitem(last=False)
+        return series
+
+    def seriesForVolume(self, volumeNode) -> SeriesIndex:
+        instanceUIDs = (volumeNode.GetAttribute("DICOM.instanceUIDs") or "").split()
+        if not instanceUIDs:
+            raise ValueError("Volume node does not have associated DICOM instance UIDs.")
+        return self.seriesForInstances(instanceUIDs)
+
+    def seriesForSeriesUID(self, seriesInstanceUID: str) -> SeriesIndex:
+        """Index of a series of the database, instances sorted by slice position when it is known."""
+        instanceUIDs = [self.database.instanceForFile(path) for path in self.database.filesForSeries(seriesInstanceUID)]
+        series = SeriesIndex.fromDatabase(self.database, instanceUIDs)
+        if all(position is not None for position in series.slicePositions):
+            order = sorted(range(len(instanceUIDs)), key=lambda index: series.slicePositions[index])
+            instanceUIDs = [instanceUIDs[index] for index in order]
+        return self.seriesForInstances(instanceUIDs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def _precacheTags(self) -> None:
+        # Tags in the precache list are read from the database instead of the file headers
+        try:
+            tags = list(self.database.tagsToPrecache)
+            missing = [tag for tag in INDEX_TAGS if tag not in tags]
+            if missing:
+                self.database.tagsToPrecache = tags + missing
+        except AttributeError:
+            pass
+
+
+_sharedIndex = None
+
+
+def sharedDicomIndex(database=None) -> DicomIndex:
+    """DicomIndex of the application DICOM database (slicer.dicomDatabase by default)."""
+    global _sharedIndex
+    if database is None:
+        import slicer
+        database = slicer.dicomDatabase
+    if _sharedIndex is None or _sharedIndex.database is not database:
+        _sharedIndex = DicomIndex(database)
+    return _sharedIndex
@@ -0,0 +1,144 @@
+"""
+Staging of DICOM files into the input folder shared with a model container.
+
+Files that are already staged (a hard link to the source, or a copy with the same size and modification
+time) are skipped, new files are hard linked when source and destination are on the same volume and copied
+otherwise, in parallel. Re-running a series that was staged before therefore only costs a few `stat` calls.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .Timing import timed
+
+# Tags read from the header when the DICOM database cannot be used
+UID_TAGS = ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+
+#
+# StagingStats
+#
+
+
+@dataclass
+class StagingStats:
+    """Outcome of one staging run."""
+
+    files: int = 0
+    skipped: int = 0
+    linked: int = 0
+    copied: int = 0
+    removed: int = 0
+    seconds: float = 0.0
+
+    def summary(self) -> str:
+        return (f"{self.files} files staged in {self.seconds * 1000:.1f} ms: {self.skipped} up to date, "
+                f"{self.linked} linked, {self.copied} copied, {self.removed} stale removed")
+
+
+def stagedFileName(path: str) -> str:
+    """Name of the staged copy. The model reads *.dcm files, DICOM database files have no extension."""
+    name = os.path.basename(path)
+    return name if name.lower().endswith(".dcm") else name + ".dcm"
+
+
+def stagedFileNames(files: list) -> dict:
+    """
+    Staged name -> source path. Files with the same name in different folders (e.g. IM0001 of several
+    exports) get a suffix derived from their full path, so none of them is dropped and the names stay the
+    same from one run to the next.
+    """
+    paths = {}
+    for path in files:
+        paths.setdefault(stagedFileName(path), []).append(path)
+    destinations = {}
+    for name, sources in paths.items():
+        sources = sorted(set(sources))
+        if len(sources) == 1:
+            destinations[name] = sources[0]
+            continue
+        stem = name[:-len(".dcm")]
+        for source in sources:
+            digest = hashlib.sha1(os.path.normcase(os.path.abspath(source)).encode("utf-8")).hexdigest()[:10]
+            destinations[f"{stem}_{digest}.dcm"] = source
+    return destinations
+
+
+def isUpToDate(source: str, destination: str, useLinks: bool = True) -> bool:
+    """
+    Whether `destination` is a staged copy of the current `source`. A destination on the same volume is a
+    hard link and must be the source file itself: a link to a source that was since replaced (e.g. by a
+    re-import of the series) keeps the old content with the same size and, often, modification time.
+    """
+    try:
+        sourceStat = os.stat(source)
+        destinationStat = os.stat(destination)
+    except OSError:
+        return False
+    if os.path.samestat(sourceStat, destinationStat):
+        return True
+    if useLinks and sourceStat.st_dev == destinationStat.st_dev:
+        return False
+    return (sourceStat.st_size == destinationStat.st_size
+            and int(sourceStat.st_mtime) == int(destinationStat.st_mtime))
+
+
+def _stageFile(source: str, destination: str, useLinks: bool) -> str:
+    if isUpToDate(source, destination, useLinks):
+        return "skipped"
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if useLinks:
+        try:
+            os.link(source, destination)
+            return "linked"
+        except OSError:
+            pass  # other volume or file system without hard links
+    # copy2 keeps the modification time, so the next run recognizes the file as up to date
+    shutil.copy2(source, destination)
+    return "copied"
+
+
+@timed("stageFiles")
+def stageFiles(files: list, destinationFolder: str, maxWorkers: int = 8, useLinks: bool = True,
+               prune: bool = True, onProgress: Optional[Callable] = None) -> StagingStats:
+    """
+    Make `destinationFolder` contain exactly the given files.
+
+    :param files: source file paths, e.g. the instance files of one series from the DICOM database
+    :param maxWorkers: number of files staged in parallel
+    :param useLinks: hard link instead of copying where possible
+    :param prune: remove files of `destinationFolder` that are not part of `files` (e.g. from an earlier,
+      larger version of the series), so that the model only sees this series
+    :param onProgress: called as onProgress(stagedCount, totalCount)
+    """
+    startTime = time.perf_counter()
+    os.makedirs(destinationFolder, exist_ok=True)
+    destinations = stagedFileNames(files)
+    stats = StagingStats(files=len(destinations))
+
+    if prune:
+        for name in os.listdir(destinationFolder):
+            if name not in destinations:
+                stalePath = os.path.join(destinationFolder, name)
+                if os.path.isfile(stalePath):
+                    os.remove(stalePath)
+                    stats.removed += 1
+
+    with ThreadPoolExecutor(max_workers=max(1, maxWorkers), thread_name_prefix="DicomStaging") as executor:
+        futures = [executor.submit(_stageFile, source, os.path.join(destinationFolder, name), useLinks)
+                   for name, source in destinations.items()]
+        for index, future in enumerate(futures):
+            outcome = future.result()
+            setattr(stats, outcome, getattr(stats, outcome) + 1)
+            if onProgress is not None:
+                onProgress(index + 1, len(futures))
+
+    stats.seconds = time.perf_counter() - startTime
+    logging.info(f"DICOM staging to {destinationFolder}: {stats.summary()}")
+    return stats
@@ -0,0 +1,225 @@
+"""
+In-process stand-in for the Docker SDK.
+
+FakeDockerClient implements the part of the `docker` client API used by ContainerPool
+(`containers.list`, `containers.run`, and `reload`, `start`, `stop`, `exec_run` of a container), so the
+inference code paths can be exercised on a machine without Docker or a GPU:
+
+- `exec_run` of `main.py --input <name>` writes the result JSON of a stand-in model to the result folder of
+  the model after a simulated model latency, like the real containers do;
+- `exec_run` of the server command starts an InferenceServer with the stand-in models on the host port
+  the container publishes.
+
+    client = FakeDockerClient([CHEST_MODEL, PE_MODEL], modelLatency=0.2)
+    pool = ContainerPool(clientFactory=lambda: client)
+"""
+
+import json
+import logging
+import os
+import shlex
+import socket
+import threading
+import time
+
+from .InferenceServer import InferenceServer, ModelHandler
+from .StandInModels import StandInChestModel, StandInPEModel
+
+
+def freePort() -> int:
+    """A TCP port of the loopback interface that is currently unused."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+#
+# SlowHandler
+#
+
+
+class SlowHandler(ModelHandler):
+    """
+    Wraps a model handler and adds a simulated model latency per call.
+    A batch of n inputs takes latency * (1 + batchCost * (n - 1)), i.e. batching is cheaper than n calls.
+    """
+
+    def __init__(self, handler: ModelHandler, latency: float = 0.0, batchCost: float = 0.25) -> None:
+        self.handler = handler
+        self.name = handler.name
+        self.latency = latency
+        self.batchCost = batchCost
+
+    def load(self) -> None:
+        self.handler.load()
+
+    def infer(self, request: dict):
+        self._sleep(1)
+        return self.handler.infer(request)
+
+    def inferVolume(self, request: dict, array, ijkToRas):
+        self._sleep(1)
+        return self.handler.inferVolume(request, array, ijkToRas)
+
+    def inferBatch(self, requests: list) -> list:
+        self._sleep(len(requests))
+        return [self.handler.infer(request) for request in requests]
+
+    def inferVolumeBatch(self, requests: list, volumes: list) -> list:
+        self._sleep(len(requests))
+        return [self.handler.inferVolume(request, array, ijkToRas)
+                for request, (array, ijkToRas) in zip(requests, volumes)]
+
+    def inferStream(self, request: dict):
+        # The latency of one call is spread over the parts, the first part comes after its share only. Models
+        # that know their number of parts are read part by part, so a focus moved meanwhile still applies.
+        if hasattr(self.handler, "streamPartCount"):
+            partCount, parts = self.handler.streamPartCount(request), self.handler.inferStream(request)
+        else:
+            parts = list(self.handler.inferStream(request))
+            partCount = len(parts)
+        parts = iter(parts)
+        try:
+            for _ in range(partCount):
+                if self.latency > 0:
+                    time.sleep(self.latency / partCount)
+                part = next(parts, None)
+                if part is None:
+                    return
+                yield part
+        finally:
+            if hasattr(parts, "close"):
+                parts.close()
+
+    def setStreamFocus(self, streamId: str, sliceIndex: int) -> bool:
+        return self.handler.setStreamFocus(streamId, sliceIndex)
+
+    def _sleep(self, count: int) -> None:
+        if self.latency > 0 and count > 0:
+            time.sleep(self.latency * (1.0 + self.batchCost * (count - 1)))
+
+
+def standInHandlerFor(model, latency: float = 0.0) -> ModelHandler:
+    """Stand-in model answering like `model` (a ModelSpec), reading its inputs from model.inputFolder."""
+    handlers = {StandInChestModel.name: StandInChestModel, StandInPEModel.name: StandInPEModel}
+    handler = handlers[model.name](model.inputFolder or "")
+    return SlowHandler(handler, latency)
+
+
+#
+# FakeContainer
+#
+
+
+class FakeContainer:
+    def __init__(self, client, name: str, model, hostPort=None) -> None:
+        self.client = client
+        self.name = name
+        self.model = model
+        self.hostPort = hostPort
+        self.status = "running"
+        self.execCount = 0
+        self._server = None
+
+    def reload(self) -> None:
+        pass
+
+    def start(self) -> None:
+        self.status = "running"
+
+    def stop(self) -> None:
+        self.status = "exited"
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def exec_run(self, cmd, detach: bool = False):
+        self.execCount += 1
+        arguments = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        if any("InferenceServer" in argument for argument in arguments):
+            self._startServer()
+            return (None, None) if detach else (0, b"")
+        if "--input" not in arguments:
+            return 1, f"Unknown command {cmd!r}".encode("utf-8")
+
+        inputName = arguments[arguments.index("--input") + 1]
+        request = {"input": inputName}
+        if "--confidence" in arguments:
+            request["confidence"] = float(arguments[arguments.index("--confidence") + 1])
+        # Like main.py: load the model for every command, then write <input>_result.json
+        handler = standInHandlerFor(self.model, self.client.modelLatency + self.client.modelLoadTime)
+        try:
+            result = handler.infer(request)
+        except Exception as e:
+            return 1, str(e).encode("utf-8")
+        resultPath = os.path.join(self.model.resultFolder, inputName + "_result.json")
+        temporaryPath = resultPath + ".tmp"
+        with open(temporaryPath, "w") as f:
+            json.dump(result, f)
+        os.replace(temporaryPath, resultPath)
+        return 0, b""
+
+    def _startServer(self) -> None:
+        if self._server is not None or self.hostPort is None:
+            return
+        self._server = InferenceServer([standInHandlerFor(self.model, self.client.modelLatency)], port=self.hostPort)
+        self._server.start()
+        logging.info(f"Fake container {self.name} serves {self.model.name} on {self._server.url}")
+
+
+class _FakeContainerCollection:
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def list(self, all: bool = False, filters=None):
+        name = (filters or {}).get("name")
+        with self.client._lock:
+            containers = list(self.client._containers.values())
+        return [container for container in containers
+                if (all or container.status == "running") and (name is None or name in container.name)]
+
+    def run(self, image, detach=True, name=None, ports=None, **kwargs):
+        model = self.client.modelForImage(image)
+        hostPort = None
+        for binding in (ports or {}).values():
+            hostPort = binding[1] if isinstance(binding, tuple) else binding
+        container = FakeContainer(self.client, name or f"{image}_{len(self.client._containers)}", model, hostPort)
+        with self.client._lock:
+            self.client._containers[container.name] = container
+        return container
+
+
+#
+# FakeDockerClient
+#
+
+
+class FakeDockerClient:
+    """
+    Docker client whose containers run the stand-in models of the given ModelSpecs.
+    The containers of every model are created up front (like after a first run), so ContainerPool finds them
+    with `containers.list` and never needs the real `docker.types` of `containers.run` with GPUs.
+
+    :param modelLatency: simulated inference time per call in seconds
+    :param modelLoadTime: additional time of every exec_run, which loads the weights again
+    """
+
+    def __init__(self, models: list, modelLatency: float = 0.0, modelLoadTime: float = 0.0) -> None:
+        self.models = {model.container.image: model for model in models}
+        self.modelLatency = modelLatency
+        self.modelLoadTime = modelLoadTime
+        self._containers = {}
+        self._lock = threading.Lock()
+        self.containers = _FakeContainerCollection(self)
+        for model in models:
+            spec = model.container
+            for index in range(max(spec.poolSize, 1)):
+                name = spec.containerNameAt(index)
+                self._containers[name] = FakeContainer(self, name, model, spec.serverPortAt(index))
+
+    def modelForImage(self, image: str):
+        return self.models[image]
+
+    def close(self) -> None:
+        for container in list(self._containers.values()):
+            container.stop()
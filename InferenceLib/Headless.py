@@ -0,0 +1,113 @@
+"""
+Command line batch runs of the inference modules, without a GUI session.
+
+Each module file runs its batch job from the command line when it is executed as a script, e.g. for nightly
+runs on a headless server:
+
+    Slicer --no-main-window --python-script chestXrayNodules/ChestXrayNodules.py --input /data/xrays --output chest.json
+    Slicer --no-main-window --python-script PE_Detect/PE_Detect.py --study-date 20240131 --workers 2 --output pe.json
+
+Inputs are image files or folders (`--input`), Series Instance UIDs of the DICOM database (`--series-uid`)
+or a query of the DICOM database (`--modality`, `--study-date`, `--patient-id`). The run summary and the
+result or error of every input are written to `--output` as JSON; the exit code is 0 when all inputs
+succeeded, 1 when some failed and 2 when the run itself failed.
+"""
+
+import argparse
+import json
+import logging
+import time
+
+from .ChunkedExport import sharedMemoryBudget
+from .InferenceScheduler import PRIORITY_BATCH
+from .ResultStore import ResultStore
+
+
+def argumentParser(description: str, batchSize: int, modalities) -> argparse.ArgumentParser:
+    """Options shared by the modules, a module adds its own model options to the returned parser."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--input", action="append", default=[], help="image file or folder, can be repeated")
+    parser.add_argument("--series-uid", action="append", default=[],
+                        help="Series Instance UID of the DICOM database, can be repeated")
+    parser.add_argument("--modality", action="append",
+                        help=f"run the series of the DICOM database with this modality (default: {', '.join(modalities)})")
+    parser.add_argument("--study-date", help="run the series of the DICOM database of this study date (YYYYMMDD)")
+    parser.add_argument("--patient-id", help="run the series of the DICOM database of this patient")
+    parser.add_argument("--dicom-database", help="folder of the DICOM database, default: the database of the application")
+    parser.add_argument("--output", required=True, help="JSON file receiving the summary and the result of every input")
+    parser.add_argument("--store", help="SQLite result store, default: the result store of the module")
+    parser.add_argument("--batch-size", type=int, default=batchSize, help="inputs sent to the model in one call")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="batches run at the same time, each in its own container on the model's GPUs")
+    parser.add_argument("--rerun", action="store_true", help="run inputs that already have a result in the store again")
+    parser.add_argument("--priority", type=int, default=PRIORITY_BATCH, help="scheduler priority of the batches")
+    parser.add_argument("--memory-limit", type=int,
+                        help="MB that the chunked exports of large volumes may allocate together")
+    parser.set_defaults(defaultModalities=list(modalities))
+    return parser
+
+
+def collectBatchItems(logic, args) -> list:
+    """
+    Batch inputs selected by the command line options, in order and without duplicates.
+    `logic` provides batchItemsFromPaths, batchItemsFromSeriesUIDs and batchItemsFromDicomDatabase.
+    """
+    if args.memory_limit:
+        sharedMemoryBudget().setLimit(args.memory_limit * 1024 * 1024)
+    if args.dicom_database:
+        from DICOMLib import DICOMUtils
+
+        DICOMUtils.openDatabase(args.dicom_database)
+    items = []
+    if args.input:
+        items += logic.batchItemsFromPaths(args.input)
+    if args.series_uid:
+        items += logic.batchItemsFromSeriesUIDs(args.series_uid)
+    if args.modality or args.study_date or args.patient_id:
+        items += logic.batchItemsFromDicomDatabase(args.modality or args.defaultModalities, args.study_date,
+                                                   args.patient_id)
+    unique = {}
+    for item in items:
+        unique.setdefault(item.key, item)
+    return list(unique.values())
+
+
+def runBatchJob(job, model: str, items: list, outputPath: str, log=print) -> int:
+    """
+    Run a batch job created by BatchInference.createBatchJob in the calling thread and write
+    {"summary": ..., "results": [record of every input]} to `outputPath`. Returns the exit code.
+    """
+    def onProgress(job, fraction, message):
+        log(f"[{fraction * 100:5.1f}%] {message}")
+
+    log(f"{job.name}: {len(items)} inputs")
+    startTime = time.perf_counter()
+    try:
+        summary = job.runSynchronously(onProgress)
+    except Exception as e:
+        log(f"{job.name} failed: {type(e).__name__}: {e}")
+        return 2
+    if summary is None:
+        log(f"{job.name} was {job.state}")
+        return 2
+    seconds = time.perf_counter() - startTime
+    summary = dict(summary, inputs=len(items), seconds=seconds,
+                   throughput=summary["done"] / seconds if seconds > 0 else 0.0)
+
+    keys = {item.key for item in items}
+    store = ResultStore(summary["store"])
+    try:
+        records = [record for record in store.records(model) if record["key"] in keys]
+    finally:
+        store.close()
+    with open(outputPath, "w") as f:
+        json.dump({"model": model, "summary": summary, "results": records}, f, indent=2, default=str)
+
+    log(f"{summary['done']} done, {summary['failed']} failed, {summary['skipped']} skipped in {seconds:.1f} s "
+        f"({summary['throughput']:.2f} inputs/s). Results written to {outputPath}")
+    if summary["failed"]:
+        for record in records:
+            if record.get("status") != "done":
+                logging.warning(f"{record['key']}: {(record['result'] or {}).get('error')}")
+        return 1
+    return 0
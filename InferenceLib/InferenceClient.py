@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Optional
+
+from .Timing import span
+
+#
+# InferenceError
+#
+
+
+class InferenceError(RuntimeError):
+    """Raised when an inference backend fails or returns an error."""
+
+
+#
+# InferenceClient
+#
+
+
+class InferenceClient:
+    """Client of the resident InferenceServer running inside a model container."""
+
+    def __init__(self, url: str, timeout: float = 300.0) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self, timeout: float = 2.0) -> dict:
+        return self._request("GET", "/health", timeout=timeout)
+
+    def isAvailable(self, model: Optional[str] = None, timeout: float = 2.0) -> bool:
+        """True if the server answers and, when given, serves `model`."""
+        try:
+            health = self.health(timeout)
+        except InferenceError:
+            return False
+        return model is None or model in health.get("models", [])
+
+    def waitUntilAvailable(self, model: Optional[str] = None, timeout: float = 60.0, interval: float = 0.25) -> bool:
+        """Poll the health endpoint until the server (and its models) is up or `timeout` expires."""
+        deadline = time.monotonic() + timeout
+        while not self.isAvailable(model, timeout=min(2.0, timeout)):
+            if time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def infer(self, model: str, request: dict, timeout: Optional[float] = None):
+        return self._request("POST", f"/models/{model}/infer", request, timeout)
+
+    def inferVolume(self, model: str, array, ijkToRas, request: Optional[dict] = None,
+                    compression: Optional[str] = None, timeout: Optional[float] = None):
+        """
+        Send the voxel array directly as a volume frame instead of exporting it to the shared folder.
+        :return: (result, TransferStats)
+        """
+        from .VolumeTransfer import VOLUME_FRAME_CONTENT_TYPE, encodeVolume
+
+        parts, stats = encodeVolume(array, ijkToRas, compression)
+        headers = {
+            "Content-Type": VOLUME_FRAME_CONTENT_TYPE,
+            "Content-Length": str(stats.wireBytes),
+            "X-Inference-Request": urllib.parse.quote(json.dumps(request or {})),
+        }
+        startTime = time.perf_counter()
+        result = self._request("POST", f"/models/{model}/infer_volume", timeout=timeout, body=parts, headers=headers)
+        stats.transferSeconds = time.perf_counter() - startTime
+        return result, stats
+
+    def inferShared(self, model: str, array, ijkToRas, request: Optional[dict] = None,
+                    timeout: Optional[float] = None):
+        """
+        Hand the voxel array to a server on the same machine through shared memory, see SharedMemoryTransfer.
+        :param array: NumPy array, copied into a segment of the shared pool for the call, or a SharedArray of the caller
+        :return: (result with its arrays copied out of shared memory, TransferStats)
+        """
+        import numpy as np
+
+        from .SharedMemoryTransfer import SharedArray, importArrays, sharedSegmentPool
+        from .VolumeTransfer import TransferStats
+
+        startTime = time.perf_counter()
+        shared = array if isinstance(array, SharedArray) else SharedArray.create(array, pool=sharedSegmentPool())
+        try:
+            stats = TransferStats("shm", rawBytes=shared.array.nbytes, encodeSeconds=time.perf_counter() - startTime)
+            body = json.dumps({
+                "request": request or {},
+                "volume": shared.descriptor,
+                "ijkToRas": [float(value) for value in np.asarray(ijkToRas, dtype=float).ravel()],
+                "owner": os.getpid(),
+            }).encode("utf-8")
+            stats.wireBytes = len(body)
+            startTime = time.perf_counter()
+            result = self._request("POST", f"/models/{model}/infer_shared", timeout=timeout, body=body)
+            names = []
+            result = importArrays(result, names)
+            if names:
+                try:
+                    self._request("POST", "/shared/release", {"names": names})
+                except InferenceError as e:
+                    logging.warning(f"Could not release the result segments: {e}")
+            stats.transferSeconds = time.perf_counter() - startTime
+        finally:
+            if shared is not array:
+                shared.unlink()
+        return result, stats
+
+    def inferStream(self, model: str, request: dict, timeout: Optional[float] = None):
+        """
+        Generator yielding the parts of the result as the model produces them (see ModelHandler.inferStream).
+        `timeout` applies to the wait for each part. Closing the generator closes the connection.
+        """
+        path = f"/models/{model}/infer_stream"
+        httpRequest = urllib.request.Request(self.url + path, data=json.dumps(request).encode("utf-8"), method="POST",
+                                             headers={"Content-Type": "application/json"})
+        try:
+            response = urllib.request.urlopen(httpRequest, timeout=timeout or self.timeout)
+        except (urllib.error.URLError, OSError) as e:
+            raise self._error("POST", path, e) from e
+        with span(f"POST {path}"), response:
+            try:
+                for line in response:
+                    if not line.strip():
+                        continue
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise InferenceError(f"POST {path} failed: {message['error']}")
+                    if message.get("done"):
+                        return
+                    yield message["partial"]
+            except (urllib.error.URLError, OSError) as e:
+                raise self._error("POST", path, e) from e
+        raise InferenceError(f"POST {path} ended before the result was complete")
+
+    def setStreamFocus(self, model: str, streamId: str, sliceIndex: int, timeout: Optional[float] = None) -> bool:
+        """
+        Move the focus of a running inferStream request that carries "streamId", so the model continues
+        with the slices around `sliceIndex`. False if the stream already ended or the model ignores it.
+        """
+        result = self._request("POST", f"/models/{model}/stream_focus",
+                               {"streamId": streamId, "focusSlice": int(sliceIndex)}, timeout)
+        return bool(result.get("updated"))
+
+    def inferBatch(self, model: str, requests: list, timeout: Optional[float] = None) -> list:
+        """Run several requests in one call so that the model can process them as one GPU batch."""
+        return self._request("POST", f"/models/{model}/infer_batch", {"requests": requests}, timeout)["results"]
+
+    def inferVolumeBatch(self, model: str, volumes: list, requests: Optional[list] = None,
+                         compression: Optional[str] = None, timeout: Optional[float] = None):
+        """
+        Send several voxel arrays in one request.
+        :param volumes: list of (array, ijkToRas)
+        :return: (list of results, TransferStats of the whole batch)
+        """
+        from .VolumeTransfer import VOLUME_FRAME_CONTENT_TYPE, TransferStats, encodeVolume
+
+        requests = requests if requests is not None else [{} for _ in volumes]
+        if len(requests) != len(volumes):
+            raise ValueError(f"{len(requests)} requests for {len(volumes)} volumes")
+        body = []
+        stats = TransferStats("array")
+        for array, ijkToRas in volumes:
+            parts, volumeStats = encodeVolume(array, ijkToRas, compression)
+            body.extend(parts)
+            stats.rawBytes += volumeStats.rawBytes
+            stats.wireBytes += volumeStats.wireBytes
+            stats.encodeSeconds += volumeStats.encodeSeconds
+        headers = {
+            "Content-Type": VOLUME_FRAME_CONTENT_TYPE,
+            "Content-Length": str(stats.wireBytes),
+            "X-Inference-Request": urllib.parse.quote(json.dumps(requests)),
+        }
+        startTime = time.perf_counter()
+        results = self._request("POST", f"/models/{model}/infer_volume_batch", timeout=timeout, body=body,
+                                headers=headers)["results"]
+        stats.transferSeconds = time.perf_counter() - startTime
+        return results, stats
+
+    def _request(self, method, path, payload=None, timeout=None, body=None, headers=None):
+        if body is None and payload is not None:
+            body = json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=body, method=method,
+                                         headers=headers or {"Content-Type": "application/json"})
+        try:
+            with span(f"{method} {path}"), urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError) as e:
+            raise self._error(method, path, e) from e
+
+    def _error(self, method, path, error) -> InferenceError:
+        if isinstance(error, urllib.error.HTTPError):
+            try:
+                message = json.loads(error.read()).get("error", error.reason)
+            except ValueError:
+                message = error.reason
+            return InferenceError(f"{method} {path} failed with status {error.code}: {message}")
+        return InferenceError(f"Inference server {self.url} is not reachable: {error}")
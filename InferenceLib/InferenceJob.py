@@ -0,0 +1,283 @@
+"""
+Background execution of the inference pipelines.
+
+An InferenceJob is a list of named stages sharing a `context` dictionary. JobRunner runs jobs in a thread
+pool so the Slicer UI stays responsive; stages that touch the MRML scene or VTK objects are flagged
+`mainThread` and are executed on the Qt main thread while the worker waits for them. Progress, completion
+and failure callbacks are always called on the main thread.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .Timing import currentRequestId, newRequestId, requestScope, span
+
+#
+# JobCancelled
+#
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when the user cancelled it."""
+
+
+@dataclass
+class Stage:
+    """
+    One step of an InferenceJob.
+
+    name - shown in the progress display.
+    function - called as function(job, context), may store values in `context` for later stages.
+    mainThread - run on the Qt main thread, required for MRML scene and VTK access.
+    weight - relative duration used to compute the overall progress.
+    """
+
+    name: str
+    function: Callable
+    mainThread: bool = False
+    weight: float = 1.0
+
+
+#
+# InferenceJob
+#
+
+
+class InferenceJob:
+    def __init__(self, name: str, stages: list, context: Optional[dict] = None) -> None:
+        self.name = name
+        self.stages = stages
+        self.context = context if context is not None else {}
+        self.result = None
+        self.error = None
+        self.state = "pending"  # pending, running, done, failed, cancelled
+        # Attached to the timing spans recorded while the job runs
+        self.requestId = newRequestId()
+        self._cancelEvent = threading.Event()
+        self._cleanups = []
+        self._runner = None
+        self._inline = False
+        self._onProgress = None
+        self._onPartialResult = None
+        self._stageIndex = 0
+        self._stageProgress = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelEvent.is_set()
+
+    def cancel(self) -> None:
+        self._cancelEvent.set()
+
+    def checkCancelled(self) -> None:
+        if self._cancelEvent.is_set():
+            raise JobCancelled(f"{self.name} was cancelled")
+
+    def addCleanup(self, function: Callable, *args) -> None:
+        """Register a function called when the job ends, whatever the outcome (e.g. releasing a container)."""
+        self._cleanups.append((function, args))
+
+    def reportProgress(self, fraction: float, message: str = "") -> None:
+        """Report progress of the current stage, `fraction` between 0 and 1."""
+        self._stageProgress = min(max(fraction, 0.0), 1.0)
+        self._post("progress", (self.progress, message or self.stages[self._stageIndex].name))
+
+    def reportPartialResult(self, partialResult) -> None:
+        """
+        Deliver part of the result before the job finishes, e.g. streamed per-slice probabilities.
+        Received by the onPartialResult callback of JobRunner.submit (on the main thread) or runSynchronously.
+        """
+        self._post("partial", partialResult)
+
+    @property
+    def progress(self) -> float:
+        totalWeight = sum(stage.weight for stage in self.stages) or 1.0
+        doneWeight = sum(stage.weight for stage in self.stages[:self._stageIndex])
+        currentWeight = self.stages[self._stageIndex].weight if self._stageIndex < len(self.stages) else 0.0
+        return (doneWeight + currentWeight * self._stageProgress) / totalWeight
+
+    def callInMainThread(self, function: Callable, *args):
+        """Call function(*args) on the Qt main thread from a stage, wait for it and return its result."""
+        if self._runner is None or self._inline:
+            return function(*args)
+        return self._runner._callInMainThread(function, *args)
+
+    def waitFor(self, future, pollInterval: float = 0.1):
+        """Wait for a concurrent future (e.g. ResultChannel.future) while honouring cancellation."""
+        while True:
+            if self.cancelled:
+                future.cancel()
+                self.checkCancelled()
+            try:
+                return future.result(pollInterval)
+            except FutureTimeoutError:
+                if future.done():
+                    raise  # the future itself failed with a timeout
+
+    def runSynchronously(self, onProgress: Optional[Callable] = None, onPartialResult: Optional[Callable] = None):
+        """
+        Run all stages in the calling thread, for scripts and batch runs without a Qt event loop.
+        :param onProgress: onProgress(job, fraction, message), called from the threads reporting progress
+        :param onPartialResult: onPartialResult(job, partialResult), called from the threads reporting them
+        """
+        self._onProgress = onProgress
+        self._onPartialResult = onPartialResult
+        self._execute(inline=True)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _execute(self, inline: bool = False) -> None:
+        self.state = "running"
+        self._inline = inline
+        try:
+            for self._stageIndex, stage in enumerate(self.stages):
+                self.checkCancelled()
+                self._stageProgress = 0.0
+                self._post("progress", (self.progress, stage.name))
+                startTime = time.perf_counter()
+                with requestScope(self.requestId), span(f"{self.name}: {stage.name}", job=self.name):
+                    if stage.mainThread and not inline:
+                        self._runner._callInMainThread(stage.function, self, self.context)
+                    else:
+                        stage.function(self, self.context)
+                logging.debug(f"{self.name}: {stage.name} took {time.perf_counter() - startTime:.3f} s")
+            self._stageIndex = len(self.stages)
+            self.result = self.context.get("result")
+            self.state = "done"
+        except JobCancelled:
+            self.state = "cancelled"
+        except BaseException as e:
+            logging.exception(f"{self.name} failed")
+            self.error = e
+            self.state = "failed"
+        finally:
+            for function, args in reversed(self._cleanups):
+                try:
+                    with requestScope(self.requestId):
+                        function(*args)
+                except Exception:
+                    logging.exception(f"{self.name} cleanup failed")
+        self._post("finished", None)
+
+    def _post(self, kind, payload) -> None:
+        if self._runner is not None:
+            self._runner._events.put((self, kind, payload))
+        elif kind == "progress" and self._onProgress is not None:
+            self._onProgress(self, *payload)
+        elif kind == "partial" and self._onPartialResult is not None:
+            self._onPartialResult(self, payload)
+
+
+#
+# JobRunner
+#
+
+
+class JobRunner:
+    """Runs InferenceJobs in worker threads and calls their callbacks on the Qt main thread."""
+
+    def __init__(self, maxWorkers: int = 2, pollIntervalMs: int = 20) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="InferenceJob")
+        self._events = queue.Queue()
+        self._mainThreadCalls = queue.Queue()
+        self._callbacks = {}
+        self._timer = None
+        self.pollIntervalMs = pollIntervalMs
+
+    def submit(self, job: InferenceJob, onProgress: Optional[Callable] = None, onFinished: Optional[Callable] = None,
+               onPartialResult: Optional[Callable] = None) -> InferenceJob:
+        """
+        Start `job` in the background.
+        :param onProgress: called as onProgress(job, fraction, message)
+        :param onFinished: called as onFinished(job) once job.state is done, failed or cancelled
+        :param onPartialResult: called as onPartialResult(job, partialResult) for each InferenceJob.reportPartialResult
+        """
+        job._runner = self
+        self._callbacks[job] = (onProgress, onFinished, onPartialResult)
+        self._startTimer()
+        self._executor.submit(job._execute)
+        return job
+
+    def activeJobs(self) -> list:
+        return list(self._callbacks)
+
+    def cancelAll(self) -> None:
+        for job in self.activeJobs():
+            job.cancel()
+
+    def shutdown(self) -> None:
+        self.cancelAll()
+        self._executor.shutdown(wait=False)
+        if self._timer is not None:
+            self._timer.stop()
+
+    def processEvents(self) -> None:
+        """Run pending main thread stages and deliver job events. Called periodically on the main thread."""
+        while True:
+            try:
+                function, args, requestId, done = self._mainThreadCalls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                with requestScope(requestId):
+                    done.result = function(*args)
+            except BaseException as e:
+                done.error = e
+            done.set()
+
+        while True:
+            try:
+                job, kind, payload = self._events.get_nowait()
+            except queue.Empty:
+                break
+            onProgress, onFinished, onPartialResult = self._callbacks.get(job, (None, None, None))
+            if kind == "progress" and onProgress is not None:
+                onProgress(job, *payload)
+            elif kind == "partial" and onPartialResult is not None:
+                onPartialResult(job, payload)
+            elif kind == "finished":
+                self._callbacks.pop(job, None)
+                if onFinished is not None:
+                    onFinished(job)
+
+        if not self._callbacks and self._timer is not None:
+            self._timer.stop()
+
+    def _callInMainThread(self, function, *args):
+        done = threading.Event()
+        done.result = None
+        done.error = None
+        self._mainThreadCalls.put((function, args, currentRequestId(), done))
+        done.wait()
+        if done.error is not None:
+            raise done.error
+        return done.result
+
+    def _startTimer(self) -> None:
+        if self._timer is None:
+            import qt
+            self._timer = qt.QTimer()
+            self._timer.setInterval(self.pollIntervalMs)
+            self._timer.connect("timeout()", self.processEvents)
+        if not self._timer.isActive():
+            self._timer.start()
+
+
+_sharedRunner = None
+
+
+def sharedJobRunner() -> JobRunner:
+    """Runner of the process, created on first use. Its workers only bound the jobs running at once."""
+    global _sharedRunner
+    if _sharedRunner is None:
+        # GPU and container usage is limited by the InferenceScheduler; a few more workers than GPUs let jobs
+        # wait there in priority order instead of waiting for a free worker in submission order
+        _sharedRunner = JobRunner(maxWorkers=4)
+    return _sharedRunner
@@ -0,0 +1,184 @@
+"""
+Priority scheduling of inference runs across models.
+
+Before running a model, a job leases it from the InferenceScheduler. A lease occupies the resources the
+model needs (its GPUs and CPU slots, see ModelSpec.resourceNeeds) and a warm container of the shared
+ContainerPool. Waiting leases are granted by priority, then in request order: a higher priority request
+holds back lower priority requests competing for the same resources, so an urgent PE study gets the GPU as
+soon as the running X-ray batch is done, before the remaining queued batches. Batch jobs lease per batch
+for that reason.
+"""
+
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from .ContainerPool import ContainerPool, sharedContainerPool
+from .InferenceJob import JobCancelled
+from .ModelRegistry import ModelRegistry, ModelSpec, sharedModelRegistry
+from .Timing import span
+
+PRIORITY_BATCH = 0
+PRIORITY_INTERACTIVE = 50
+PRIORITY_URGENT = 100
+
+#
+# ModelLease
+#
+
+
+@dataclass
+class ModelLease:
+    """A model granted by the scheduler: its container and, if running, the client of its inference server."""
+
+    model: ModelSpec
+    container: object
+    serverClient: object
+    priority: int
+    resources: dict = field(default_factory=dict)
+    _request: object = field(default=None, repr=False)
+
+
+@dataclass
+class _Request:
+    modelName: str
+    priority: int
+    sequence: int
+    resources: dict
+
+
+#
+# InferenceScheduler
+#
+
+
+class InferenceScheduler:
+    def __init__(self, registry: Optional[ModelRegistry] = None, pool: Optional[ContainerPool] = None,
+                 capacities: Optional[dict] = None, pollInterval: float = 0.1) -> None:
+        """
+        :param capacities: number of concurrent runs per resource, e.g. {"gpu:0": 2}. Each GPU runs one
+          model at a time unless set here, "cpu" defaults to the number of processors.
+        """
+        self.registry = registry or sharedModelRegistry()
+        self.pool = pool or sharedContainerPool()
+        self.capacities = {"cpu": os.cpu_count() or 1}
+        self.capacities.update(capacities or {})
+        self.pollInterval = pollInterval
+        self._condition = threading.Condition()
+        self._inUse = {}
+        self._waiting = []
+        self._running = []
+        self._sequence = itertools.count()
+
+    def capacity(self, resource: str) -> int:
+        return self.capacities.get(resource, 1)
+
+    def allowConcurrentRuns(self, modelName: str, count: int) -> None:
+        """
+        Let up to `count` runs of `modelName` share its GPUs, each in its own warm container, e.g. for a
+        headless batch on a server whose GPUs have the memory for several copies of the model.
+        Never lowers limits that are already higher.
+        """
+        model = self.registry.get(modelName)
+        with self._condition:
+            model.container.poolSize = max(model.container.poolSize, count)
+            for resource in model.resourceNeeds():
+                if resource.startswith("gpu:"):
+                    self.capacities[resource] = max(self.capacity(resource), count)
+            self._condition.notify_all()
+
+    def acquire(self, modelName: str, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None,
+                cancelled: Optional[Callable] = None) -> ModelLease:
+        """
+        Wait until `modelName` may run, then return a lease with a running container. Call `release` when done.
+        :param cancelled: polled while waiting, JobCancelled is raised when it returns True
+        """
+        model = self.registry.get(modelName)
+        resources = {name: min(count, self.capacity(name)) for name, count in model.resourceNeeds().items()}
+        request = _Request(modelName, priority, next(self._sequence), resources)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with span("scheduler wait", model=modelName, priority=priority), self._condition:
+            self._waiting.append(request)
+            self._waiting.sort(key=lambda waiting: (-waiting.priority, waiting.sequence))
+            try:
+                while not self._canStart(request):
+                    if cancelled is not None and cancelled():
+                        raise JobCancelled(f"Waiting for {modelName} was cancelled")
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"{modelName} could not be scheduled")
+                    self._condition.wait(self.pollInterval if remaining is None else min(remaining, self.pollInterval))
+                for name, count in resources.items():
+                    self._inUse[name] = self._inUse.get(name, 0) + count
+                self._running.append(request)
+            finally:
+                self._waiting.remove(request)
+                self._condition.notify_all()
+
+        try:
+            with span("ContainerPool.acquire", model=modelName):
+                container = self.pool.acquire(model.container)
+        except BaseException:
+            self._free(request)
+            raise
+        return ModelLease(model, container, self.pool.serverClient(container), priority, resources, request)
+
+    def release(self, lease: ModelLease) -> None:
+        self.pool.release(lease.container)
+        self._free(lease._request)
+
+    @contextmanager
+    def lease(self, modelName: str, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None,
+              cancelled: Optional[Callable] = None):
+        lease = self.acquire(modelName, priority, timeout, cancelled)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def leaseForJob(self, job, modelName: str, priority: int = PRIORITY_INTERACTIVE) -> ModelLease:
+        """Acquire `modelName` for an InferenceJob, cancellable with the job and released when the job ends."""
+        lease = self.acquire(modelName, priority, cancelled=lambda: job.cancelled)
+        job.addCleanup(self.release, lease)
+        return lease
+
+    def status(self) -> dict:
+        """Running and waiting requests as lists of (model name, priority), waiting ones in grant order."""
+        with self._condition:
+            return {"running": [(request.modelName, request.priority) for request in self._running],
+                    "waiting": [(request.modelName, request.priority) for request in self._waiting],
+                    "resources": dict(self._inUse)}
+
+    def _canStart(self, request) -> bool:
+        # Requests ahead in the queue hold back what they need, even if they cannot start yet
+        available = {name: self.capacity(name) - self._inUse.get(name, 0) for name in request.resources}
+        for waiting in self._waiting:
+            if waiting is request:
+                break
+            for name, count in waiting.resources.items():
+                if name in available:
+                    available[name] -= count
+        return all(available[name] >= count for name, count in request.resources.items())
+
+    def _free(self, request) -> None:
+        with self._condition:
+            if request in self._running:
+                self._running.remove(request)
+                for name, count in request.resources.items():
+                    self._inUse[name] -= count
+            self._condition.notify_all()
+
+
+_sharedScheduler = None
+
+
+def sharedInferenceScheduler() -> InferenceScheduler:
+    """Scheduler of the process, the jobs of all modules go through it to share the GPUs by priority."""
+    global _sharedScheduler
+    if _sharedScheduler is None:
+        _sharedScheduler = InferenceScheduler()
+    return _sharedScheduler
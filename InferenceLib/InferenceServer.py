@@ -0,0 +1,363 @@
+"""
+Resident inference server.
+
+The server keeps model weights loaded between requests and answers them over HTTP on a local port.
+It only depends on the Python standard library so this file can be copied into a model image and
+started once per container, e.g.
+
+    python InferenceServer.py --handler main:InferenceHandler --host 0.0.0.0 --port 8000
+
+Protocol:
+    GET  /health                      -> {"status": "ok", "models": [...]}
+    POST /models/<name>/infer         JSON request -> JSON result
+    POST /models/<name>/infer_volume  VolumeTransfer frame, JSON request in the X-Inference-Request header
+                                      -> JSON result
+    POST /models/<name>/infer_batch   {"requests": [...]} -> {"results": [...]}
+    POST /models/<name>/infer_volume_batch
+                                      concatenated VolumeTransfer frames, JSON list of requests in the
+                                      X-Inference-Request header -> {"results": [...]}
+    POST /models/<name>/infer_stream  JSON request -> chunked JSON lines, {"partial": ...} for each part of the
+                                      result as soon as the model produced it, then {"done": true}
+    POST /models/<name>/stream_focus  {"streamId": ..., "focusSlice": k} -> {"updated": bool}, moves the focus of
+                                      the running infer_stream request that carries the same "streamId"
+    POST /models/<name>/infer_shared  {"request": ..., "volume": SharedMemoryTransfer descriptor, "ijkToRas": [16],
+                                      "owner": pid} -> JSON result, arrays replaced by {"sharedArray": descriptor}
+    POST /shared/release              {"names": [...]} -> {"released": n}, closes the result segments once the
+                                      owner has copied them
+Errors are reported as {"error": "..."} with a 4xx/5xx status, or as an {"error": "..."} line once a stream
+has started.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds the result segments of infer_shared are kept open when the client does not release them
+SHARED_RESULT_TTL = 600.0
+
+#
+# ModelHandler
+#
+
+
+class ModelHandler:
+    """
+    Base class of the models served by InferenceServer.
+    `load` is called once when the server starts, `infer` for every request.
+    """
+
+    name = None
+
+    def load(self) -> None:
+        pass
+
+    def infer(self, request: dict):
+        raise NotImplementedError
+
+    def inferVolume(self, request: dict, array, ijkToRas):
+        """Run inference on a voxel array received as a volume frame instead of a file in the shared folder."""
+        raise NotImplementedError
+
+    def inferBatch(self, requests: list) -> list:
+        """
+        Run inference on several inputs in one call. Override to fill a GPU batch, the default answers the
+        requests one after the other.
+        """
+        return [self.infer(request) for request in requests]
+
+    def inferVolumeBatch(self, requests: list, volumes: list) -> list:
+        """Batch version of inferVolume, `volumes` is a list of (array, ijkToRas) matching `requests`."""
+        return [self.inferVolume(request, array, ijkToRas) for request, (array, ijkToRas) in zip(requests, volumes)]
+
+    def inferStream(self, request: dict):
+        """
+        Generator yielding the result in parts as soon as they are available, e.g. per-slice probabilities
+        before the exam level labels. The default yields the whole result of `infer` as a single part.
+        A request may carry "focusSlice" (slice index the user is looking at): handlers that produce per-slice
+        parts should send the slices nearest to it first, the others may ignore it. With a "streamId" the
+        focus can be moved while the stream runs, see setStreamFocus.
+        """
+        yield self.infer(request)
+
+    def setStreamFocus(self, streamId: str, sliceIndex: int) -> bool:
+        """
+        Move the focus of the running inferStream request `streamId`, e.g. when the user scrolled: the slices
+        not processed yet are taken around `sliceIndex`. Returns False if the stream is unknown or finished,
+        or the handler does not reorder its work (the default).
+        """
+        return False
+
+
+def _volumeTransfer():
+    # numpy is only needed for volume frames, JSON requests work with the standard library alone
+    try:
+        from InferenceLib import VolumeTransfer
+    except ImportError:
+        import VolumeTransfer  # copied next to this file in the model image
+    return VolumeTransfer
+
+
+def _sharedMemoryTransfer():
+    try:
+        from InferenceLib import SharedMemoryTransfer
+    except ImportError:
+        import SharedMemoryTransfer  # copied next to this file in the model image
+    return SharedMemoryTransfer
+
+
+def _decodeVolume(frame):
+    return _volumeTransfer().decodeVolume(frame)
+
+
+def _decodeVolumes(frames):
+    return _volumeTransfer().decodeVolumes(frames)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("InferenceServer: " + format % args)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._sendJson(200, {"status": "ok", "models": sorted(self.server.handlers)})
+        else:
+            self._sendJson(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path == "/shared/release":
+            names = json.loads(self._readBody() or b"{}").get("names", [])
+            self._sendJson(200, {"released": self.server.releaseSegments(names)})
+            return
+        handler, action = self._handlerForPath()
+        if handler is None:
+            return
+        try:
+            if action == "infer":
+                result = handler.infer(json.loads(self._readBody() or b"{}"))
+            elif action == "infer_volume":
+                request = json.loads(urllib.parse.unquote(self.headers.get("X-Inference-Request", "{}")))
+                array, ijkToRas = _decodeVolume(self._readBody())
+                result = handler.inferVolume(request, array, ijkToRas)
+            elif action == "infer_batch":
+                requests = json.loads(self._readBody() or b"{}").get("requests", [])
+                result = {"results": handler.inferBatch(requests)}
+            elif action == "infer_shared":
+                result = self._inferShared(handler, json.loads(self._readBody() or b"{}"))
+            elif action == "infer_stream":
+                self._sendStream(handler.inferStream(json.loads(self._readBody() or b"{}")))
+                return
+            elif action == "stream_focus":
+                payload = json.loads(self._readBody() or b"{}")
+                try:
+                    streamId, sliceIndex = str(payload["streamId"]), int(payload["focusSlice"])
+                except (KeyError, TypeError) as e:
+                    raise ValueError(f"streamId and focusSlice are required: {e}") from e
+                result = {"updated": bool(handler.setStreamFocus(streamId, sliceIndex))}
+            elif action == "infer_volume_batch":
+                requests = json.loads(urllib.parse.unquote(self.headers.get("X-Inference-Request", "[]")))
+                volumes = _decodeVolumes(self._readBody())
+                if len(requests) != len(volumes):
+                    raise ValueError(f"{len(requests)} requests for {len(volumes)} volumes")
+                result = {"results": handler.inferVolumeBatch(requests, volumes)}
+            else:
+                self._sendJson(404, {"error": f"Unknown path {self.path}"})
+                return
+        except ValueError as e:
+            self._sendJson(400, {"error": f"Invalid request: {e}"})
+            return
+        except NotImplementedError:
+            self._sendJson(501, {"error": f"Model {handler.name} does not support {action}"})
+            return
+        except Exception as e:
+            logging.exception("Inference failed")
+            self._sendJson(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._sendJson(200, result)
+
+    def _handlerForPath(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "models":
+            self._sendJson(404, {"error": f"Unknown path {self.path}"})
+            return None, None
+        handler = self.server.handlers.get(parts[1])
+        if handler is None:
+            self._sendJson(404, {"error": f"Unknown model {parts[1]}"})
+        return handler, parts[2]
+
+    def _inferShared(self, handler, payload):
+        import numpy as np
+
+        transfer = _sharedMemoryTransfer()
+        try:
+            shared = transfer.SharedArray.attach(payload["volume"])
+            ijkToRas = np.asarray(payload.get("ijkToRas", np.eye(4).ravel()), dtype=float).reshape(4, 4)
+        except (KeyError, FileNotFoundError, TypeError) as e:
+            raise ValueError(f"no shared volume: {e}") from e
+        try:
+            result = handler.inferVolume(payload.get("request", {}), shared.array, ijkToRas)
+        finally:
+            shared.close()
+        segments = []
+        result = transfer.exportArrays(result, payload.get("owner"), segments)
+        self.server.holdSegments(segments)
+        return result
+
+    def _readBody(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _sendStream(self, parts):
+        """Send every part as a JSON line in its own chunk. Errors after the first part end the stream with an error line."""
+        parts = iter(parts)
+        # Errors before the first part are reported with a status code like the other actions
+        first = next(parts, None)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            if first is not None:
+                self._sendChunk({"partial": first})
+            try:
+                for part in parts:
+                    self._sendChunk({"partial": part})
+                self._sendChunk({"done": True})
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                logging.exception("Streamed inference failed")
+                self._sendChunk({"error": f"{type(e).__name__}: {e}"})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. the job was cancelled), stop the model as well
+            logging.info("Inference stream closed by the client")
+            self.close_connection = True
+        finally:
+            if hasattr(parts, "close"):
+                parts.close()
+
+    def _sendChunk(self, payload):
+        data = json.dumps(payload).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _sendJson(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+#
+# InferenceServer
+#
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handlers) -> None:
+        super().__init__(address, _RequestHandler)
+        self.handlers = handlers
+        self._segments = {}  # name -> (SharedArray, time held), result segments not yet released by their owner
+        self._segmentsLock = threading.Lock()
+
+    def holdSegments(self, segments) -> None:
+        # The segments must stay open until the owner mapped them: on Windows the last handle frees the memory
+        now = time.monotonic()
+        with self._segmentsLock:
+            expired = [name for name, (_, heldSince) in self._segments.items() if now - heldSince > SHARED_RESULT_TTL]
+            for segment in segments:
+                self._segments[segment.name] = (segment, now)
+        self.releaseSegments(expired)
+
+    def releaseSegments(self, names) -> int:
+        with self._segmentsLock:
+            released = [self._segments.pop(name)[0] for name in names if name in self._segments]
+        for segment in released:
+            segment.close()
+        return len(released)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.releaseSegments(list(self._segments))
+
+
+class InferenceServer:
+    """HTTP server answering inference requests with already loaded ModelHandler instances."""
+
+    def __init__(self, handlers, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.handlers = {handler.name: handler for handler in handlers}
+        self._httpServer = _HTTPServer((host, port), self.handlers)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpServer.server_address[:2]
+        if host in ("0.0.0.0", ""):
+            host = "127.0.0.1"
+        return f"http://{host}:{port}"
+
+    def loadModels(self) -> None:
+        for handler in self.handlers.values():
+            logging.info(f"Loading model {handler.name}")
+            handler.load()
+
+    def serveForever(self) -> None:
+        self.loadModels()
+        self._httpServer.serve_forever()
+
+    def start(self) -> "InferenceServer":
+        """Load the models and serve requests from a background thread."""
+        self.loadModels()
+        self._thread = threading.Thread(target=self._httpServer.serve_forever, name="InferenceServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpServer.shutdown()
+        self._httpServer.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def loadHandler(spec: str) -> ModelHandler:
+    """Instantiate a handler from a "module:ClassName" specification."""
+    moduleName, _, className = spec.partition(":")
+    return getattr(importlib.import_module(moduleName), className)()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Serve inference models over HTTP.")
+    parser.add_argument("--handler", action="append", default=[], help="model handler as module:ClassName, can be repeated")
+    parser.add_argument("--stand-in", action="store_true", help="serve the CPU-only stand-in models (no GPU or weights needed)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    handlers = [loadHandler(spec) for spec in args.handler]
+    if args.stand_in:
+        from InferenceLib.StandInModels import standInHandlers
+        handlers.extend(standInHandlers())
+    if not handlers:
+        parser.error("at least one --handler or --stand-in is required")
+
+    logging.basicConfig(level=logging.INFO)
+    server = InferenceServer(handlers, args.host, args.port)
+    logging.info(f"Serving {', '.join(server.handlers)} on {server.url}")
+    server.serveForever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Registry of the inference models known to the application.
+
+Every module registers the models it runs once, with the container they run in, the host folders mounted
+into it, the input format they expect and the resources a run occupies. InferenceScheduler uses the
+registry to start the right container and to decide which jobs may run at the same time.
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .ContainerPool import ContainerSpec
+
+# Input formats
+INPUT_NRRD = "nrrd"  # volume file exported to inputFolder
+INPUT_DICOM = "dicom"  # DICOM series copied to inputFolder/<study>/<series>
+INPUT_ARRAY = "array"  # voxels sent to the inference server
+INPUT_SHARED_MEMORY = "shm"  # voxels handed to a local inference server in shared memory
+
+#
+# ModelSpec
+#
+
+
+@dataclass
+class ModelSpec:
+    """
+    Describes one inference model.
+
+    name - model name, also the name used by the inference server, e.g. "chestyolov5".
+    container - ContainerSpec of the container running the model (image, mounts, GPUs, server port).
+    inputFormats - input formats accepted by the model, the preferred one first.
+    inputFolder - host folder of the mount the inputs are written to.
+    resultFolder - host folder of the mount the result json files are written to by exec_run.
+    cpuSlots - CPU slots occupied by one run, in addition to the GPUs of the container.
+    """
+
+    name: str
+    container: ContainerSpec
+    inputFormats: list = field(default_factory=lambda: [INPUT_NRRD])
+    inputFolder: Optional[str] = None
+    resultFolder: Optional[str] = None
+    cpuSlots: int = 1
+
+    @property
+    def modelVersion(self) -> str:
+        return self.container.modelVersion
+
+    def accepts(self, inputFormat: str) -> bool:
+        return inputFormat in self.inputFormats
+
+    def resourceNeeds(self) -> dict:
+        """Resources occupied by one run: {"gpu:<device id>": 1, ..., "cpu": cpuSlots}."""
+        needs = {f"gpu:{deviceId}": 1 for deviceId in self.container.gpuDeviceIds}
+        if self.cpuSlots:
+            needs["cpu"] = self.cpuSlots
+        return needs
+
+
+#
+# ModelRegistry
+#
+
+
+class ModelRegistry:
+    def __init__(self) -> None:
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def register(self, model: ModelSpec) -> ModelSpec:
+        """Add or replace a model. Registering the same name again (e.g. on module reload) replaces it."""
+        with self._lock:
+            self._models[model.name] = model
+        return model
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._models.pop(name, None)
+
+    def get(self, name: str) -> ModelSpec:
+        with self._lock:
+            model = self._models.get(name)
+        if model is None:
+            raise KeyError(f"Model {name} is not registered")
+        return model
+
+    def names(self) -> list:
+        with self._lock:
+            return list(self._models)
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._models
+
+
+_sharedRegistry = None
+
+
+def sharedModelRegistry() -> ModelRegistry:
+    """Registry of the process, filled by the modules when they are imported."""
+    global _sharedRegistry
+    if _sharedRegistry is None:
+        _sharedRegistry = ModelRegistry()
+    return _sharedRegistry
@@ -0,0 +1,183 @@
+"""
+Staged pipeline with bounded queues.
+
+Items flow through a list of stages, each with its own worker threads and a bounded input queue. A full
+queue blocks the previous stage (back-pressure), so a fast export stage cannot pile up volumes in memory
+while the GPU stage is busy, and different items are in different stages at the same time: while item N
+is on the GPU, item N+1 is exported and item N-1 is stored or rendered.
+
+Stages flagged `mainThread` are not run by worker threads but handed to the thread that called `run`,
+which executes them with the `callInMainThread` function it was given (e.g. InferenceJob.callInMainThread),
+so MRML and VTK access stays on the Qt main thread.
+"""
+
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .Timing import currentRequestId, requestScope, span
+
+_STOP = object()
+
+#
+# PipelineStage
+#
+
+
+@dataclass
+class PipelineStage:
+    """
+    One stage of a Pipeline.
+
+    name - used in log messages.
+    function - called as function(item) for every item, the return value is passed to the next stage.
+    workers - number of items processed concurrently, e.g. 1 for a single GPU.
+    queueSize - capacity of the input queue, the previous stage blocks when it is full.
+    mainThread - run on the main thread (workers is then always 1).
+    """
+
+    name: str
+    function: Callable
+    workers: int = 1
+    queueSize: int = 2
+    mainThread: bool = False
+
+
+class PipelineCancelled(Exception):
+    """Raised by Pipeline.run when the cancel event was set."""
+
+
+class _MainThreadAbandoned(Exception):
+    """The pipeline was cancelled while an item waited for the main thread."""
+
+
+#
+# Pipeline
+#
+
+
+class Pipeline:
+    def __init__(self, stages: list, callInMainThread: Optional[Callable] = None,
+                 cancelEvent: Optional[threading.Event] = None, pollInterval: float = 0.05) -> None:
+        """
+        :param callInMainThread: callInMainThread(function, *args) runs a function on the main thread and
+          returns its result. Called from the thread running `run`. By default functions are called directly.
+        :param cancelEvent: stops the pipeline when set
+        """
+        self.stages = stages
+        self.callInMainThread = callInMainThread or (lambda function, *args: function(*args))
+        self.cancelEvent = cancelEvent or threading.Event()
+        self.pollInterval = pollInterval
+
+    def run(self, items, onItemDone: Optional[Callable] = None, onItemFailed: Optional[Callable] = None) -> int:
+        """
+        Push all `items` through the stages and wait until they are processed.
+        :param onItemDone: called as onItemDone(result) with the output of the last stage, in the calling thread
+        :param onItemFailed: called as onItemFailed(item, stageName, exception), in the calling thread.
+          A failed item leaves the pipeline, the other items go on.
+        :return: number of items that went through all stages
+        """
+        queues = [queue.Queue(maxsize=max(1, stage.queueSize)) for stage in self.stages]
+        requestId = currentRequestId()
+        outputs = queue.Queue()  # ("done", result) / ("failed", item, stageName, exception) / ("main", ...)
+
+        def put(targetQueue, value):
+            # Blocking put with cancellation: this is where back-pressure happens
+            while not self.cancelEvent.is_set():
+                try:
+                    targetQueue.put(value, timeout=self.pollInterval)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def forward(stageIndex, value):
+            if stageIndex + 1 < len(self.stages):
+                put(queues[stageIndex + 1], value)
+            else:
+                outputs.put(("done", value))
+
+        def worker(stageIndex):
+            with requestScope(requestId):
+                work(stageIndex)
+
+        def work(stageIndex):
+            stage = self.stages[stageIndex]
+            while True:
+                item = queues[stageIndex].get()
+                if item is _STOP:
+                    return
+                if self.cancelEvent.is_set():
+                    continue
+                try:
+                    with span(f"pipeline {stage.name}"):
+                        result = self._process(stage, item, outputs)
+                except _MainThreadAbandoned:
+                    continue
+                except Exception as e:
+                    outputs.put(("failed", item, stage.name, e))
+                    continue
+                forward(stageIndex, result)
+
+        for stageIndex, stage in enumerate(self.stages):
+            for workerIndex in range(1 if stage.mainThread else max(1, stage.workers)):
+                threading.Thread(target=worker, args=(stageIndex,), daemon=True,
+                                 name=f"Pipeline {stage.name} {workerIndex}").start()
+
+        items = list(items)
+        feeder = threading.Thread(target=lambda: [put(queues[0], item) for item in items], daemon=True,
+                                  name="Pipeline feeder")
+        feeder.start()
+
+        finished = 0
+        succeeded = 0
+        try:
+            while finished < len(items):
+                if self.cancelEvent.is_set():
+                    raise PipelineCancelled()
+                try:
+                    message = outputs.get(timeout=self.pollInterval)
+                except queue.Empty:
+                    continue
+                if message[0] == "main":
+                    _, function, item, done, reply = message
+                    try:
+                        reply["result"] = self.callInMainThread(function, item)
+                    except Exception as e:
+                        reply["error"] = e
+                    done.set()
+                elif message[0] == "done":
+                    finished += 1
+                    succeeded += 1
+                    if onItemDone is not None:
+                        onItemDone(message[1])
+                else:
+                    _, item, stageName, error = message
+                    finished += 1
+                    logging.error(f"Pipeline stage {stageName} failed: {error}")
+                    if onItemFailed is not None:
+                        onItemFailed(item, stageName, error)
+        finally:
+            if finished < len(items):
+                # Cancelled or failed in a callback: let blocked workers and the feeder give up
+                self.cancelEvent.set()
+            for stageIndex, stage in enumerate(self.stages):
+                for _ in range(1 if stage.mainThread else max(1, stage.workers)):
+                    queues[stageIndex].put(_STOP)
+        return succeeded
+
+    def _process(self, stage, item, outputs):
+        if not stage.mainThread:
+            return stage.function(item)
+        # Hand the item to the thread running `run` and wait for it
+        done = threading.Event()
+        reply = {}
+        outputs.put(("main", stage.function, item, done, reply))
+        while not done.wait(self.pollInterval):
+            if self.cancelEvent.is_set():
+                raise _MainThreadAbandoned()
+        if "error" in reply:
+            raise reply["error"]
+        return reply["result"]
@@ -0,0 +1,225 @@
+"""
+Per-slice probability display.
+
+A model returning one probability per slice (e.g. pe_on_image of pedetect_v1) is shown once per result,
+instead of being looked up on every slice change:
+
+- an overlay volume aligned with the CT, with one voxel per slice stretched over the whole slice, colour
+  mapped and shown in the foreground of the slice views, so hot slices stand out while scrolling;
+- a probability track (plot chart of probability against slice index) to see the whole series at once;
+- the hottest slices, to jump to them directly.
+
+Everything is built from the (K,) probability array with vectorised NumPy, and nothing is rebuilt while the
+same result is shown. The partial results of a streamed inference only modify the voxels of the overlay and
+the column of the track in place (`update`).
+"""
+
+import numpy as np
+
+from .Timing import timed
+
+# Attribute marking the nodes created by ProbabilityOverlay
+PROBABILITY_OVERLAY_ATTRIBUTE = "InferenceLib.ProbabilityOverlay"
+
+
+def hotSlices(probabilities, threshold: float = 0.5, count: int = 10) -> list:
+    """[(slice index, probability)] of the `count` most probable slices above `threshold`, most probable first."""
+    probabilities = np.asarray(probabilities, dtype=float)
+    candidates = np.flatnonzero(np.nan_to_num(probabilities, nan=-1.0) >= threshold)
+    order = candidates[np.argsort(-probabilities[candidates], kind="stable")][:count]
+    return [(int(index), float(probabilities[index])) for index in order]
+
+
+def sliceTrackIjkToRas(ijkToRas, dimensions):
+    """
+    IJK to RAS matrix of a (1, 1, K) volume whose voxel k covers the whole slice k of a volume with the given
+    IJK to RAS matrix and dimensions (I, J, K): the I and J axes are stretched over the slice and the voxel
+    centers are moved to the slice centers.
+    """
+    ijkToRas = np.asarray(ijkToRas, dtype=float)
+    track = ijkToRas.copy()
+    track[:3, 0] *= dimensions[0]
+    track[:3, 1] *= dimensions[1]
+    track[:3, 3] = (ijkToRas @ np.array([(dimensions[0] - 1) / 2.0, (dimensions[1] - 1) / 2.0, 0.0, 1.0]))[:3]
+    return track
+
+
+def sliceCenter(ijkToRas, dimensions, sliceIndex: int):
+    """RAS position of the center of slice `sliceIndex`."""
+    ijk = np.array([(dimensions[0] - 1) / 2.0, (dimensions[1] - 1) / 2.0, float(sliceIndex), 1.0])
+    return (np.asarray(ijkToRas, dtype=float) @ ijk)[:3]
+
+
+#
+# ProbabilityOverlay
+#
+
+
+class ProbabilityOverlay:
+    """Creates, updates and removes the overlay volume and the probability track of one module."""
+
+    def __init__(self, name: str = "Probability", colorNodeID: str = "vtkMRMLColorTableNodeFileColdToHotRainbow.txt",
+                 opacity: float = 0.35, displayThreshold: float = 0.1) -> None:
+        """
+        :param displayThreshold: slices below this probability are not coloured
+        """
+        self.name = name
+        self.colorNodeID = colorNodeID
+        self.opacity = opacity
+        self.displayThreshold = displayThreshold
+        self.volumeNode = None
+        self.overlayNode = None
+        self.chartNode = None
+        self._key = None
+
+    @timed("ProbabilityOverlay.show")
+    def show(self, volumeNode, probabilities, viewNames=("Red", "Yellow", "Green"), showChart: bool = True,
+             switchLayout: bool = True):
+        """
+        Show `probabilities` ((K,) array in the slice order of `volumeNode`, NaN where unknown) over `volumeNode`.
+        Showing the same probabilities for the same volume again only makes the overlay visible again.
+        :param switchLayout: switch the view layout to one that shows the probability track
+        :return: the overlay volume node
+        """
+        import slicer
+
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        key = (volumeNode.GetID(), probabilities.tobytes())
+        if key != self._key or self.overlayNode is None or slicer.mrmlScene.GetNodeByID(self.overlayNode.GetID()) is None:
+            wasModifying = slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+            try:
+                self._updateOverlay(volumeNode, probabilities)
+                if showChart:
+                    self._updateChart(probabilities)
+            finally:
+                slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+            self._key = key
+            self.volumeNode = volumeNode
+        self._showInViews(viewNames)
+        if showChart and switchLayout and self.chartNode is not None and slicer.app.layoutManager() is not None:
+            slicer.modules.plots.logic().ShowChartInLayout(self.chartNode)
+        return self.overlayNode
+
+    @timed("ProbabilityOverlay.update")
+    def update(self, volumeNode, probabilities) -> bool:
+        """
+        Replace the probabilities shown over `volumeNode` in place, without creating nodes, changing the views
+        or the layout. Meant for the partial results of a streamed inference.
+        :return: False if `show` has not shown probabilities of the same number of slices over `volumeNode`
+        """
+        import slicer
+
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        if (volumeNode is not self.volumeNode or self.overlayNode is None
+                or slicer.mrmlScene.GetNodeByID(self.overlayNode.GetID()) is None):
+            return False
+        voxels = slicer.util.arrayFromVolume(self.overlayNode)
+        if voxels.shape != (len(probabilities), 1, 1):
+            return False
+        voxels[:, 0, 0] = np.nan_to_num(probabilities, nan=-1.0)
+        slicer.util.arrayFromVolumeModified(self.overlayNode)
+        if self.chartNode is not None and slicer.mrmlScene.GetNodeByID(self.chartNode.GetID()) is not None:
+            tableNode = self.chartNode.GetNthPlotSeriesNode(0).GetTableNode()
+            column = slicer.util.arrayFromTableColumn(tableNode, self.name)
+            if len(column) == len(probabilities):
+                column[:] = probabilities
+                slicer.util.arrayFromTableColumnModified(tableNode, self.name)
+            else:
+                self._updateChart(probabilities)
+        self._key = (volumeNode.GetID(), probabilities.tobytes())
+        return True
+
+    def jumpToSlice(self, sliceIndex: int, viewNames=("Red",)) -> None:
+        """Move the slice views to slice `sliceIndex` of the volume shown with `show`."""
+        import slicer
+        import vtk
+
+        if self.volumeNode is None or slicer.app.layoutManager() is None:
+            return
+        ijkToRas = vtk.vtkMatrix4x4()
+        self.volumeNode.GetIJKToRASMatrix(ijkToRas)
+        center = sliceCenter(slicer.util.arrayFromVTKMatrix(ijkToRas), self.volumeNode.GetImageData().GetDimensions(),
+                             sliceIndex)
+        for viewName in viewNames:
+            sliceWidget = slicer.app.layoutManager().sliceWidget(viewName)
+            if sliceWidget is not None:
+                sliceWidget.mrmlSliceNode().JumpSliceByOffsetting(*center)
+
+    def remove(self) -> None:
+        import slicer
+
+        for node in (self.overlayNode, self.chartNode):
+            if node is not None and slicer.mrmlScene.GetNodeByID(node.GetID()) is not None:
+                if node.IsA("vtkMRMLPlotChartNode"):
+                    for index in range(node.GetNumberOfPlotSeriesNodes()):
+                        seriesNode = node.GetNthPlotSeriesNode(index)
+                        if seriesNode is not None:
+                            slicer.mrmlScene.RemoveNode(seriesNode.GetTableNode())
+                            slicer.mrmlScene.RemoveNode(seriesNode)
+                slicer.mrmlScene.RemoveNode(node)
+        self.overlayNode = self.chartNode = self.volumeNode = None
+        self._key = None
+
+    def _updateOverlay(self, volumeNode, probabilities) -> None:
+        import slicer
+        import vtk
+
+        if self.overlayNode is None or slicer.mrmlScene.GetNodeByID(self.overlayNode.GetID()) is None:
+            self.overlayNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", f"{self.name} overlay")
+            self.overlayNode.SetAttribute(PROBABILITY_OVERLAY_ATTRIBUTE, "overlay")
+            self.overlayNode.CreateDefaultDisplayNodes()
+        # (K, J, I) = (K, 1, 1): one voxel per slice, unknown slices below the display threshold
+        voxels = np.nan_to_num(probabilities, nan=-1.0).reshape(-1, 1, 1)
+        slicer.util.updateVolumeFromArray(self.overlayNode, voxels)
+
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        trackMatrix = sliceTrackIjkToRas(slicer.util.arrayFromVTKMatrix(ijkToRas),
+                                         volumeNode.GetImageData().GetDimensions())
+        self.overlayNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(trackMatrix))
+        self.overlayNode.SetAttribute(PROBABILITY_OVERLAY_ATTRIBUTE + ".Volume", volumeNode.GetID())
+
+        displayNode = self.overlayNode.GetDisplayNode()
+        displayNode.SetAndObserveColorNodeID(self.colorNodeID)
+        displayNode.SetAutoWindowLevel(False)
+        displayNode.SetWindowLevelMinMax(0.0, 1.0)
+        displayNode.SetApplyThreshold(True)
+        displayNode.SetLowerThreshold(self.displayThreshold)
+        displayNode.SetUpperThreshold(1.0)
+        displayNode.SetInterpolate(False)
+
+    def _updateChart(self, probabilities) -> None:
+        import slicer
+
+        if self.chartNode is None or slicer.mrmlScene.GetNodeByID(self.chartNode.GetID()) is None:
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", f"{self.name} by slice")
+            seriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", self.name)
+            seriesNode.SetAndObserveTableNodeID(tableNode.GetID())
+            seriesNode.SetPlotType(seriesNode.PlotTypeScatter)
+            seriesNode.SetMarkerStyle(seriesNode.MarkerStyleNone)
+            seriesNode.SetXColumnName("Slice")
+            seriesNode.SetYColumnName(self.name)
+            self.chartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode", f"{self.name} track")
+            self.chartNode.SetAttribute(PROBABILITY_OVERLAY_ATTRIBUTE, "track")
+            self.chartNode.AddAndObservePlotSeriesNodeID(seriesNode.GetID())
+            self.chartNode.SetXAxisTitle("Slice")
+            self.chartNode.SetYAxisTitle(self.name)
+            self.chartNode.SetYAxisRangeAuto(False)
+            self.chartNode.SetYAxisRange(0.0, 1.0)
+        tableNode = self.chartNode.GetNthPlotSeriesNode(0).GetTableNode()
+        # updateTableFromArray names the columns in order, unknown slices are left as gaps
+        slicer.util.updateTableFromArray(tableNode, (np.arange(len(probabilities), dtype=np.float32), probabilities),
+                                         ["Slice", self.name])
+
+    def _showInViews(self, viewNames) -> None:
+        import slicer
+
+        if slicer.app.layoutManager() is None:
+            return
+        for viewName in viewNames:
+            sliceWidget = slicer.app.layoutManager().sliceWidget(viewName)
+            if sliceWidget is None:
+                continue
+            compositeNode = sliceWidget.mrmlSliceCompositeNode()
+            compositeNode.SetForegroundVolumeID(self.overlayNode.GetID())
+            compositeNode.SetForegroundOpacity(self.opacity)
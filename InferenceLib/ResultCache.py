@@ -0,0 +1,141 @@
+"""
+Persistent, content-addressed cache of inference results.
+
+Entries are keyed by a hash of what determines the result: the model and its version, the identity of the
+input (DICOM series UIDs or a hash of the voxels) and the request parameters such as the confidence
+threshold. Re-opening a case therefore shows the earlier result immediately instead of running the model
+again, while a new model version or a different threshold never returns a stale result. The cache is
+bounded in size and evicts the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from .Timing import timed
+
+# Default upper bound of the cache file content
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def hashVolume(array, ijkToRas=None) -> str:
+    """Content hash of a voxel array (and its geometry), used as input identity of images without UIDs."""
+    import numpy as np
+
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{array.dtype.str}{array.shape}".encode("ascii"))
+    if ijkToRas is not None:
+        digest.update(np.asarray(ijkToRas, dtype="<f8").tobytes())
+    digest.update(memoryview(array).cast("B"))
+    return "pixels:" + digest.hexdigest()
+
+
+def seriesIdentity(studyInstanceUID: str, seriesInstanceUID: str, instanceCount: Optional[int] = None) -> str:
+    """Input identity of a DICOM series. The instance count tells apart partially loaded series."""
+    identity = f"series:{studyInstanceUID}/{seriesInstanceUID}"
+    return identity if instanceCount is None else f"{identity}/{instanceCount}"
+
+
+def cacheKey(model: str, modelVersion: str, identity: str, parameters: Optional[dict] = None) -> str:
+    text = json.dumps([model, modelVersion, identity, parameters or {}], sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+#
+# ResultCache
+#
+
+
+class ResultCache:
+    """Thread-safe SQLite cache of JSON results with size-based LRU eviction."""
+
+    def __init__(self, path: str, maxBytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY,"
+                " size INTEGER NOT NULL,"
+                " lastAccess REAL NOT NULL,"
+                " value TEXT NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cacheLastAccess ON cache (lastAccess)")
+
+    @timed("ResultCache.get")
+    def get(self, key: str):
+        """Return the cached result, or None. A hit makes the entry the most recently used."""
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE cache SET lastAccess = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    @timed("ResultCache.put")
+    def put(self, key: str, result) -> None:
+        value = json.dumps(result)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO cache (key, size, lastAccess, value) VALUES (?, ?, ?, ?)",
+                                     (key, len(value), time.time(), value))
+            self._evict()
+
+    def remove(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache")
+
+    @property
+    def totalBytes(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        totalBytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if totalBytes <= self.maxBytes:
+            return
+        evictedKeys = []
+        for key, size in self._connection.execute("SELECT key, size FROM cache ORDER BY lastAccess"):
+            if totalBytes <= self.maxBytes:
+                break
+            evictedKeys.append((key,))
+            totalBytes -= size
+        self._connection.executemany("DELETE FROM cache WHERE key = ?", evictedKeys)
+
+
+_sharedCache = None
+
+
+def sharedResultCache(path: Optional[str] = None, maxBytes: int = DEFAULT_MAX_BYTES) -> ResultCache:
+    """
+    Result cache of the process.
+    `path` is only used by the first call, by default the cache is stored in the user cache folder.
+    """
+    global _sharedCache
+    if _sharedCache is None:
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".cache", "SlicerInference", "InferenceResultCache.sqlite")
+        _sharedCache = ResultCache(path, maxBytes)
+    return _sharedCache
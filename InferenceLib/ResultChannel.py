@@ -0,0 +1,208 @@
+"""
+Asynchronous delivery of inference results.
+
+A ResultChannel wraps a `concurrent.futures.Future` that is resolved as soon as the result exists, either
+from the response of the inference server or from the result JSON written by `exec_run` of main.py.
+Channels support a timeout and cancellation, and fail with InferenceError when the command exits with a
+non-zero code instead of waiting forever for a file that will never appear.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, Optional
+
+from .InferenceClient import InferenceError
+from .Timing import currentRequestId, requestScope, span
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+#
+# ResultChannel
+#
+
+
+class ResultChannel:
+    """Future of one inference result, with timeout and cancellation."""
+
+    def __init__(self, timeout: Optional[float] = None, description: str = "inference") -> None:
+        self.future = Future()
+        self.description = description
+        self.cancelEvent = threading.Event()
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._onTimeout, args=(timeout,))
+            self._timer.daemon = True
+            self._timer.start()
+        self.future.add_done_callback(self._onDone)
+
+    def cancel(self) -> bool:
+        self.cancelEvent.set()
+        return self.future.cancel()
+
+    def cancelled(self) -> bool:
+        return self.cancelEvent.is_set()
+
+    def setResult(self, result) -> None:
+        try:
+            self.future.set_result(result)
+        except InvalidStateError:
+            pass  # already cancelled or timed out
+
+    def setException(self, exception: BaseException) -> None:
+        try:
+            self.future.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+    def result(self, timeout: Optional[float] = None):
+        return self.future.result(timeout)
+
+    def _onTimeout(self, timeout) -> None:
+        self.cancelEvent.set()
+        self.setException(TimeoutError(f"{self.description} did not return a result within {timeout:g} seconds"))
+
+    def _onDone(self, future) -> None:
+        self.cancelEvent.set()
+        if self._timer is not None:
+            self._timer.cancel()
+
+    @classmethod
+    def run(cls, function: Callable, *args, timeout: Optional[float] = None, description: str = "inference", **kwargs) -> "ResultChannel":
+        """Call `function` in a background thread and deliver its return value, e.g. an InferenceClient request."""
+        channel = cls(timeout, description)
+        requestId = currentRequestId()
+
+        def worker():
+            try:
+                with requestScope(requestId), span(description):
+                    channel.setResult(function(*args, **kwargs))
+            except BaseException as e:
+                channel.setException(e)
+
+        threading.Thread(target=worker, name=f"ResultChannel {description}", daemon=True).start()
+        return channel
+
+
+def waitForFile(path: str, cancelEvent: threading.Event, pollInterval: float = 0.05) -> bool:
+    """
+    Block until `path` exists or `cancelEvent` is set. Returns True if the file exists.
+    Uses file system notifications when the optional watchdog package is installed, short polling otherwise.
+    """
+    if os.path.exists(path):
+        return True
+    directory = os.path.dirname(path) or "."
+    if Observer is not None and os.path.isdir(directory):
+        created = threading.Event()
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if os.path.normcase(getattr(event, "dest_path", "") or event.src_path) == os.path.normcase(path):
+                    created.set()
+
+        observer = Observer()
+        observer.schedule(_Handler(), directory)
+        observer.start()
+        try:
+            # Check again to not miss a file created before the observer started
+            while not (created.is_set() or os.path.exists(path)) and not cancelEvent.is_set():
+                created.wait(0.5)
+        finally:
+            observer.stop()
+        return os.path.exists(path)
+
+    while not os.path.exists(path):
+        if cancelEvent.wait(pollInterval):
+            return os.path.exists(path)
+    return True
+
+
+def _readJson(path, attempts=20, interval=0.05):
+    # The file may appear before the container finished writing it
+    for attempt in range(attempts):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(interval)
+
+
+def execResultChannel(container, command: str, resultPath: str, timeout: Optional[float] = None,
+                      gracePeriod: float = 5.0) -> ResultChannel:
+    """
+    Run `command` in `container` and deliver the JSON written to `resultPath`.
+    The channel fails with InferenceError if the command exits with a non-zero code, or if it succeeds but
+    no result appears within `gracePeriod` seconds. A previous result at `resultPath` is removed first so
+    that a stale file is never delivered.
+    """
+    channel = ResultChannel(timeout, f"{command!r} in {container.name}")
+    if os.path.exists(resultPath):
+        os.remove(resultPath)
+    requestId = currentRequestId()
+
+    def runCommand():
+        try:
+            with requestScope(requestId), span("exec_run", container=container.name):
+                exitCode, output = container.exec_run(cmd=command)
+        except BaseException as e:
+            channel.setException(InferenceError(f"Failed to run {command!r} in {container.name}: {e}"))
+            return
+        if exitCode not in (0, None):
+            if isinstance(output, bytes):
+                output = output.decode("utf-8", errors="replace")
+            logging.error(f"{command!r} exited with code {exitCode}:\n{output}")
+            channel.setException(InferenceError(f"Inference command exited with code {exitCode}: {(output or '').strip()[-500:]}"))
+            return
+        # Give the file watcher a moment in case the file system is slow to report the result
+        if not channel.cancelEvent.wait(gracePeriod) and not channel.future.done():
+            channel.setException(InferenceError(f"Inference command succeeded but {resultPath} was not written"))
+
+    def watchResult():
+        with requestScope(requestId), span("wait for result file", path=resultPath):
+            found = waitForFile(resultPath, channel.cancelEvent)
+        if found:
+            try:
+                with requestScope(requestId), span("read result file"):
+                    result = _readJson(resultPath)
+                channel.setResult(result)
+            except BaseException as e:
+                channel.setException(InferenceError(f"Could not read {resultPath}: {e}"))
+
+    threading.Thread(target=runCommand, name="ResultChannel exec", daemon=True).start()
+    threading.Thread(target=watchResult, name="ResultChannel watcher", daemon=True).start()
+    return channel
+
+
+_pendingTimers = set()
+
+
+def deliverInMainThread(future: Future, callback: Callable, pollIntervalMs: int = 20):
+    """
+    Call `callback(future)` from the Qt main thread once `future` is done, without blocking the event loop.
+    Qt timers only fire in the main thread, so the callback may safely update the MRML scene and widgets.
+    """
+    import qt
+
+    timer = qt.QTimer()
+    timer.setInterval(pollIntervalMs)
+    _pendingTimers.add(timer)
+
+    def check():
+        if not future.done():
+            return
+        timer.stop()
+        _pendingTimers.discard(timer)
+        callback(future)
+
+    timer.connect("timeout()", check)
+    timer.start()
+    return timer
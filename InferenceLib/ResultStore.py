@@ -0,0 +1,97 @@
+"""
+Consolidated store of batch inference results.
+
+All results of a batch run (and of later runs writing to the same file) are kept in one SQLite database,
+one row per model and input, so that a night of triage can be reviewed, queried or exported as a whole
+instead of collecting hundreds of result JSON files from the shared folders.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+#
+# ResultStore
+#
+
+
+class ResultStore:
+    """Thread-safe SQLite table of inference results keyed by model name and input key."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " model TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " status TEXT NOT NULL,"
+                " metadata TEXT,"
+                " result TEXT,"
+                " PRIMARY KEY (model, key))")
+
+    def put(self, model: str, key: str, result, metadata: Optional[dict] = None, status: str = "done") -> None:
+        """Store (or replace) the result of `model` for the input identified by `key`."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (model, key, created, status, metadata, result) VALUES (?, ?, ?, ?, ?, ?)",
+                (model, key, time.time(), status, json.dumps(metadata or {}), json.dumps(result)))
+
+    def putError(self, model: str, key: str, error: str, metadata: Optional[dict] = None) -> None:
+        """Record a failed input, so that a batch run continues and the failure can be reviewed later."""
+        self.put(model, key, {"error": error}, metadata, status="failed")
+
+    def get(self, model: str, key: str):
+        """Return the stored result, or None."""
+        record = self.record(model, key)
+        return record["result"] if record is not None else None
+
+    def record(self, model: str, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT model, key, created, status, metadata, result FROM results WHERE model = ? AND key = ?",
+                (model, key)).fetchone()
+        return self._toRecord(row) if row is not None else None
+
+    def records(self, model: Optional[str] = None, status: Optional[str] = None) -> list:
+        """All records, optionally filtered by model and status, oldest first."""
+        query = "SELECT model, key, created, status, metadata, result FROM results"
+        conditions, parameters = [], []
+        if model is not None:
+            conditions.append("model = ?")
+            parameters.append(model)
+        if status is not None:
+            conditions.append("status = ?")
+            parameters.append(status)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY created", parameters).fetchall()
+        return [self._toRecord(row) for row in rows]
+
+    def keys(self, model: str) -> list:
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT key FROM results WHERE model = ?", (model,))]
+
+    def exportJson(self, path: str, model: Optional[str] = None) -> None:
+        """Write all records to a single JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.records(model), f, indent=2)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _toRecord(row) -> dict:
+        model, key, created, status, metadata, result = row
+        return {"model": model, "key": key, "created": created, "status": status,
+                "metadata": json.loads(metadata or "{}"), "result": json.loads(result)}
@@ -0,0 +1,267 @@
+"""
+Hand-off of voxel arrays to a local inference server through shared memory.
+
+For an inference server on the same machine (no container, or a container started with the host IPC
+namespace, see ContainerSpec.ipcMode), the volume is copied once into a shared memory segment and only a
+small JSON descriptor {"name", "shape", "dtype"} is sent with the request. The server maps the segment
+instead of receiving the voxels over the socket or reading a file. Arrays of the result come back the same
+way: the server puts them into new segments and replaces them in the JSON result by
+{"sharedArray": descriptor}; the client copies them out and releases the segments.
+
+Writing to a new segment costs a page fault per page, as much as the copy itself. The input segments are
+therefore taken from a SegmentPool that keeps the segments of finished transfers for the next ones.
+
+Every segment is named after the process that owns (and finally unlinks) it, the Slicer process for both
+the inputs and the results. The segments of a process that crashed are removed by its multiprocessing
+resource tracker, and `cleanupStaleSegments` removes those left over by a process that is gone on
+systems with /dev/shm. On Windows the system frees a segment when its last handle is closed.
+
+Only the client runs `cleanupStaleSegments`, when it creates its segment pool. A server in a container
+shares /dev/shm with the host (ipc=host) but not the process ids, so the owners of all client segments
+would look gone to it.
+
+Like VolumeTransfer, this file only needs the standard library and NumPy, so it can be copied into a
+model image next to InferenceServer.py.
+"""
+
+import atexit
+import logging
+import os
+import secrets
+import sys
+import threading
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+SEGMENT_PREFIX = "sinf_"
+_SHM_FOLDER = "/dev/shm"
+# Bytes of idle segments kept by a SegmentPool for the next transfers
+DEFAULT_IDLE_BYTES = 512 * 1024 * 1024
+
+#
+# SegmentPool
+#
+
+
+class SegmentPool:
+    """Idle segments of this process, reused by SharedArray.create instead of creating a segment per transfer."""
+
+    def __init__(self, maxIdleBytes: int = DEFAULT_IDLE_BYTES) -> None:
+        self.maxIdleBytes = maxIdleBytes
+        self._idle = []  # least recently released first
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes: int):
+        """An idle segment of `nbytes` to twice as many bytes, or a new segment."""
+        with self._lock:
+            fitting = [segment for segment in self._idle if nbytes <= segment.size <= 2 * nbytes + 4096]
+            if fitting:
+                segment = min(fitting, key=lambda segment: segment.size)
+                self._idle.remove(segment)
+                return segment
+        return _openSegment(segmentName(os.getpid()), create=True, size=max(nbytes, 1))
+
+    def release(self, segment) -> None:
+        """Keep `segment` for a later transfer, the least recently used ones are removed beyond maxIdleBytes."""
+        with self._lock:
+            self._idle.append(segment)
+            evicted = []
+            while self._idle and sum(idle.size for idle in self._idle) > self.maxIdleBytes:
+                evicted.append(self._idle.pop(0))
+        for segment in evicted:
+            _unlinkSegment(segment)
+
+    def clear(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for segment in idle:
+            _unlinkSegment(segment)
+
+
+_sharedPool = None
+
+
+def sharedSegmentPool() -> SegmentPool:
+    """
+    Segment pool of the client process, its segments are removed when the process exits. Creating it also
+    removes the segments left over by client processes that are gone.
+    """
+    global _sharedPool
+    if _sharedPool is None:
+        cleanupStaleSegments()
+        _sharedPool = SegmentPool()
+        atexit.register(_sharedPool.clear)
+    return _sharedPool
+
+
+#
+# SharedArray
+#
+
+
+class SharedArray:
+    """A NumPy array in a named shared memory segment, created by `create` or mapped by `attach`."""
+
+    def __init__(self, segment, shape, dtype, pool: Optional[SegmentPool] = None) -> None:
+        self.segment = segment
+        self.pool = pool
+        self.array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+    @classmethod
+    def create(cls, array, owner: Optional[int] = None, pool: Optional[SegmentPool] = None) -> "SharedArray":
+        """
+        Copy `array` into a segment.
+        :param owner: pid of the process that will unlink the segment, default: this process
+        :param pool: take the segment from this pool and give it back on `unlink`, for segments of this process
+        """
+        array = np.asarray(array)
+        if pool is not None and owner in (None, os.getpid()):
+            shared = cls(pool.acquire(array.nbytes), array.shape, array.dtype, pool)
+        else:
+            segment = _openSegment(segmentName(os.getpid() if owner is None else owner), create=True,
+                                   size=max(array.nbytes, 1))
+            shared = cls(segment, array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor: dict) -> "SharedArray":
+        """Map the segment of a descriptor without copying."""
+        return cls(_openSegment(descriptor["name"]), tuple(descriptor["shape"]), np.dtype(descriptor["dtype"]))
+
+    @property
+    def name(self) -> str:
+        return self.segment.name.lstrip("/")
+
+    @property
+    def descriptor(self) -> dict:
+        return {"name": self.name, "shape": list(self.array.shape), "dtype": self.array.dtype.str}
+
+    def close(self) -> None:
+        """Unmap the segment in this process. Views of `array` must not be used afterwards."""
+        self.array = None
+        try:
+            self.segment.close()
+        except BufferError:
+            # A view of the array is still referenced, the mapping is released with it
+            logging.debug(f"Shared memory segment {self.name} is still in use")
+
+    def unlink(self) -> None:
+        """Close and remove the segment, or give it back to its pool. Only the owner unlinks."""
+        if self.pool is not None:
+            self.array = None
+            self.pool.release(self.segment)
+            self.pool = None
+            return
+        self.close()
+        try:
+            self.segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "SharedArray":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.unlink()
+
+
+def segmentName(owner: int) -> str:
+    return f"{SEGMENT_PREFIX}{owner}_{secrets.token_hex(6)}"
+
+
+def segmentOwner(name: str):
+    """Pid of the process owning the segment `name`, None for segments not created by SharedArray."""
+    if not name.startswith(SEGMENT_PREFIX):
+        return None
+    owner = name[len(SEGMENT_PREFIX):].partition("_")[0]
+    return int(owner) if owner.isdigit() else None
+
+
+def _openSegment(name: str, create: bool = False, size: int = 0):
+    # Only the resource tracker of the owner removes the segment when its process dies
+    track = segmentOwner(name) == os.getpid()
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=size, track=track)
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    if not track and os.name == "posix":
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _unlinkSegment(segment) -> None:
+    try:
+        segment.close()
+        segment.unlink()
+    except (BufferError, FileNotFoundError):
+        pass
+
+
+def _isRunning(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cleanupStaleSegments() -> int:
+    """
+    Remove the segments whose owner process is gone. Returns the number of removed segments.
+    Only for processes in the PID namespace of the owners, i.e. not in a model container.
+    """
+    if os.name != "posix" or not os.path.isdir(_SHM_FOLDER):
+        return 0
+    removed = 0
+    for name in os.listdir(_SHM_FOLDER):
+        owner = segmentOwner(name)
+        if owner is not None and owner != os.getpid() and not _isRunning(owner):
+            try:
+                os.remove(os.path.join(_SHM_FOLDER, name))
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        logging.info(f"Removed {removed} stale shared memory segments")
+    return removed
+
+
+def exportArrays(value, owner: int, segments: list):
+    """
+    Copy of a JSON-like result with every NumPy array of at least one dimension moved to a new segment
+    owned by `owner` and replaced by {"sharedArray": descriptor}. The created SharedArray are appended to
+    `segments`, the caller keeps them open until the owner has copied them.
+    """
+    if isinstance(value, np.ndarray) and value.ndim:
+        shared = SharedArray.create(value, owner)
+        segments.append(shared)
+        return {"sharedArray": shared.descriptor}
+    if isinstance(value, dict):
+        return {key: exportArrays(item, owner, segments) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [exportArrays(item, owner, segments) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def importArrays(value, names: list):
+    """Inverse of exportArrays in the owner: copy the shared arrays out and unlink their segments."""
+    if isinstance(value, dict):
+        if set(value) == {"sharedArray"}:
+            shared = SharedArray.attach(value["sharedArray"])
+            names.append(shared.name)
+            try:
+                return shared.array.copy()
+            finally:
+                shared.unlink()
+        return {key: importArrays(item, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [importArrays(item, names) for item in value]
+    return value
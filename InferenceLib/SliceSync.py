@@ -0,0 +1,115 @@
+"""
+Managed slice view observers.
+
+Widgets register named handlers instead of adding observers to slice nodes directly. There is at most one
+observer per slice view, registering a handler again replaces the previous one, and bursts of ModifiedEvents
+(e.g. while scrolling) are coalesced into one handler call per view and timer interval. `stop` removes the
+VTK observers and `teardown` also forgets the handlers, so nothing keeps firing after a module is left or
+closed, whatever the number of inference runs.
+"""
+
+import logging
+from typing import Callable
+
+#
+# SliceSync
+#
+
+
+class SliceSync:
+    """Coalesced ModifiedEvent dispatch of slice views, e.g. SliceSync().setHandler("label", update, ["Red"])."""
+
+    def __init__(self, intervalMs: int = 16) -> None:
+        self.intervalMs = intervalMs
+        self._handlers = {}  # name -> (callback, viewNames)
+        self._observers = {}  # viewName -> (sliceNode, observerTag)
+        self._dirtyViews = set()
+        self._timer = None
+        self._active = True
+
+    def setHandler(self, name: str, callback: Callable, viewNames=("Red",)) -> None:
+        """
+        Call `callback(sliceNode, event)` after the slice nodes of `viewNames` changed.
+        A handler registered earlier under the same `name` is replaced.
+        """
+        self._handlers[name] = (callback, tuple(viewNames))
+        self._updateObservers()
+
+    def removeHandler(self, name: str) -> None:
+        self._handlers.pop(name, None)
+        self._updateObservers()
+
+    def hasHandler(self, name: str) -> bool:
+        return name in self._handlers
+
+    def refresh(self, viewNames=None) -> None:
+        """Schedule a handler call as if the views had been modified, e.g. right after registering a handler."""
+        for viewName in viewNames or self._observedViewNames():
+            self._dirtyViews.add(viewName)
+        self._schedule()
+
+    def start(self) -> None:
+        """Observe the slice views again after `stop`, e.g. when the module is entered."""
+        self._active = True
+        self._updateObservers()
+        self.refresh()
+
+    def stop(self) -> None:
+        """Remove the slice node observers but keep the handlers, e.g. when the module is left."""
+        self._active = False
+        self._updateObservers()
+        self._dirtyViews.clear()
+        if self._timer is not None:
+            self._timer.stop()
+
+    def teardown(self) -> None:
+        """Remove all observers and handlers, called from the widget cleanup."""
+        self._handlers.clear()
+        self.stop()
+
+    def _observedViewNames(self) -> set:
+        return {viewName for _, viewNames in self._handlers.values() for viewName in viewNames}
+
+    def _updateObservers(self) -> None:
+        import slicer
+        import vtk
+
+        wanted = self._observedViewNames() if self._active else set()
+        for viewName in list(self._observers):
+            if viewName not in wanted:
+                sliceNode, tag = self._observers.pop(viewName)
+                sliceNode.RemoveObserver(tag)
+        for viewName in wanted - set(self._observers):
+            sliceWidget = slicer.app.layoutManager().sliceWidget(viewName) if slicer.app.layoutManager() else None
+            if sliceWidget is None:
+                continue
+            sliceNode = sliceWidget.mrmlSliceNode()
+            tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                        lambda caller, event, viewName=viewName: self._onSliceModified(viewName))
+            self._observers[viewName] = (sliceNode, tag)
+
+    def _onSliceModified(self, viewName) -> None:
+        self._dirtyViews.add(viewName)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if not self._active:
+            return
+        if self._timer is None:
+            import qt
+            self._timer = qt.QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.setInterval(self.intervalMs)
+            self._timer.connect("timeout()", self._dispatch)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _dispatch(self) -> None:
+        dirtyViews, self._dirtyViews = self._dirtyViews, set()
+        for name, (callback, viewNames) in list(self._handlers.items()):
+            for viewName in viewNames:
+                if viewName in dirtyViews and viewName in self._observers:
+                    try:
+                        callback(self._observers[viewName][0], "ModifiedEvent")
+                    except Exception:
+                        logging.exception(f"Slice handler {name} failed")
@@ -0,0 +1,53 @@
+"""
+Viewport-aware order of slice-level inference.
+
+A series of K slices is split into fixed windows of consecutive slices. The window nearest to the focus
+slice (the slice the user is looking at) is handed out first; the focus can be moved at any time from
+another thread (e.g. the slice view observer on the main thread), and the next window is picked around
+the new focus. Every window is handed out exactly once.
+"""
+
+import threading
+from typing import Optional
+
+#
+# SliceWindowQueue
+#
+
+
+class SliceWindowQueue:
+    def __init__(self, sliceCount: int, windowSize: int = 16, focus: Optional[int] = None) -> None:
+        self.sliceCount = sliceCount
+        self.windowSize = max(windowSize, 1)
+        self._remaining = list(range(0, sliceCount, self.windowSize))  # start of the windows not handed out
+        self.windowCount = len(self._remaining)
+        self._focus = sliceCount // 2 if focus is None else focus
+        self._lock = threading.Lock()
+
+    @property
+    def focus(self) -> int:
+        return self._focus
+
+    def setFocus(self, sliceIndex: int) -> None:
+        """Move the focus, e.g. when the user scrolled to `sliceIndex`. Thread safe."""
+        with self._lock:
+            self._focus = min(max(int(sliceIndex), 0), max(self.sliceCount - 1, 0))
+
+    def next(self) -> Optional[list]:
+        """Slice indices of the remaining window nearest to the focus, None when all were handed out."""
+        with self._lock:
+            if not self._remaining:
+                return None
+            start = min(self._remaining, key=lambda start: (self._distance(start), start))
+            self._remaining.remove(start)
+        return list(range(start, min(start + self.windowSize, self.sliceCount)))
+
+    def remainingWindows(self) -> int:
+        with self._lock:
+            return len(self._remaining)
+
+    def _distance(self, start: int) -> int:
+        end = min(start + self.windowSize, self.sliceCount) - 1
+        if start <= self._focus <= end:
+            return 0
+        return start - self._focus if start > self._focus else self._focus - end
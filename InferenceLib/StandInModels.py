@@ -0,0 +1,176 @@
+"""
+CPU-only stand-ins for the chestyolov5 and pedetect_v1 models.
+
+They answer with the same result format as the real models but compute deterministic pseudo results
+from the input names, so the client, the server and the Slicer modules can be exercised without Docker,
+a GPU or model weights.
+"""
+
+import hashlib
+import math
+import os
+import random
+import threading
+import zlib
+
+from .InferenceServer import ModelHandler
+from .SliceWindowQueue import SliceWindowQueue
+
+PE_EXAM_LABELS = [
+    "negative_exam_for_pe",
+    "indeterminate",
+    "chronic_pe",
+    "acute_and_chronic_pe",
+    "central_pe",
+    "leftsided_pe",
+    "rightsided_pe",
+    "rv_lv_ratio_gte_1",
+    "rv_lv_ratio_lt_1",
+]
+# Instances per part of the streamed PE result
+STREAM_CHUNK_SIZE = 32
+
+
+def _seededRandom(text: str) -> random.Random:
+    return random.Random(int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16))
+
+
+def readNrrdSizes(path: str):
+    """Return the "sizes" field of a NRRD header, or None if the file cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.decode("latin-1").strip()
+                if not line:
+                    break
+                if line.startswith("sizes:"):
+                    return [int(value) for value in line.split(":", 1)[1].split()]
+    except OSError:
+        pass
+    return None
+
+
+def _checksumFile(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            return zlib.crc32(f.read())
+    except OSError:
+        return 0
+
+
+class StandInChestModel(ModelHandler):
+    """Returns a few bounding boxes per image, same format as the chestyolov5 result JSON."""
+
+    name = "chestyolov5"
+
+    def __init__(self, inputFolder: str = "", maxBoxes: int = 5) -> None:
+        self.inputFolder = inputFolder
+        self.maxBoxes = maxBoxes
+
+    def infer(self, request: dict):
+        inputName = request["input"]
+        path = os.path.join(request.get("inputFolder", self.inputFolder), inputName)
+        sizes = readNrrdSizes(path) or [1024, 1024]
+        # The model reads all voxels, as inferVolume does with the array, so the transports compare fairly
+        _checksumFile(path)
+        return self._detect(inputName, sizes[0], sizes[1], float(request.get("confidence") or 0.0))
+
+    def inferVolume(self, request: dict, array, ijkToRas):
+        # Arrays from slicer.util.arrayFromVolume are indexed (k, j, i)
+        seedText = request.get("input") or str(zlib.crc32(array))
+        return self._detect(seedText, array.shape[-1], array.shape[-2], float(request.get("confidence") or 0.0))
+
+    def _detect(self, seedText, width, height, confidence):
+        rng = _seededRandom(seedText)
+        boxes = []
+        for _ in range(rng.randint(1, self.maxBoxes)):
+            boxWidth = rng.uniform(0.03, 0.12) * width
+            boxHeight = rng.uniform(0.03, 0.12) * height
+            left = rng.uniform(0, width - boxWidth)
+            bottom = rng.uniform(0, height - boxHeight)
+            score = rng.uniform(0.05, 0.99)
+            if score >= confidence:
+                boxes.append({"left": left, "bottom": bottom, "right": left + boxWidth, "top": bottom + boxHeight,
+                              "confidence": score})
+        return {"bounding_boxes": boxes}
+
+
+class StandInPEModel(ModelHandler):
+    """Returns exam level probabilities followed by one probability per instance, like pedetect_v1."""
+
+    name = "pedetect_v1"
+
+    def __init__(self, inputFolder: str = "") -> None:
+        self.inputFolder = inputFolder
+        self._streams = {}  # streamId -> SliceWindowQueue of the running streams
+        self._streamsLock = threading.Lock()
+
+    def instanceIds(self, request: dict) -> list:
+        if request.get("instanceUIDs"):
+            return list(request["instanceUIDs"])
+        studyUID, _, seriesUID = request["input"].partition("_")
+        seriesFolder = os.path.join(request.get("inputFolder", self.inputFolder), studyUID, seriesUID)
+        if not os.path.isdir(seriesFolder):
+            return []
+        return [os.path.splitext(name)[0] for name in sorted(os.listdir(seriesFolder)) if name.endswith(".dcm")]
+
+    def infer(self, request: dict):
+        return self._classify(request["input"], self.instanceIds(request))
+
+    def inferVolume(self, request: dict, array, ijkToRas):
+        instanceIds = request.get("instanceUIDs") or [str(index) for index in range(array.shape[0])]
+        return self._classify(request.get("input") or str(zlib.crc32(array)), instanceIds)
+
+    def inferStream(self, request: dict, chunkSize: int = STREAM_CHUNK_SIZE):
+        """
+        Per-instance probabilities in chunks of `chunkSize` instances first, the exam level labels last.
+        Each chunk is scored when it is taken from a SliceWindowQueue: with "focusSlice" the chunks nearest to
+        that slice index come first, and setStreamFocus moves the focus of a stream with a "streamId".
+        """
+        instanceIds = self.instanceIds(request)
+        examResult, probability = self._model(request["input"], len(instanceIds))
+        windows = SliceWindowQueue(len(instanceIds), chunkSize, request.get("focusSlice"))
+        streamId = request.get("streamId")
+        if streamId is not None:
+            with self._streamsLock:
+                self._streams[streamId] = windows
+        try:
+            window = windows.next()
+            while window is not None:
+                yield [{"id": instanceIds[index], "probability": probability(index)} for index in window]
+                window = windows.next()
+            yield examResult
+        finally:
+            if streamId is not None:
+                with self._streamsLock:
+                    self._streams.pop(streamId, None)
+
+    def streamPartCount(self, request: dict, chunkSize: int = STREAM_CHUNK_SIZE) -> int:
+        """Number of parts of inferStream: the chunks and the exam level labels."""
+        return -(-len(self.instanceIds(request)) // chunkSize) + 1
+
+    def setStreamFocus(self, streamId: str, sliceIndex: int) -> bool:
+        with self._streamsLock:
+            windows = self._streams.get(streamId)
+        if windows is None:
+            return False
+        windows.setFocus(sliceIndex)
+        return True
+
+    def _classify(self, seedText, instanceIds):
+        examResult, probability = self._model(seedText, len(instanceIds))
+        return examResult + [{"id": instanceId, "probability": probability(index)}
+                             for index, instanceId in enumerate(instanceIds)]
+
+    @staticmethod
+    def _model(seedText, sliceCount):
+        """Exam level result and per-slice probability function of a series, a bump around a random slice."""
+        rng = _seededRandom(seedText)
+        examResult = [{"id": label, "probability": rng.random()} for label in PE_EXAM_LABELS]
+        center = rng.uniform(0.3, 0.7) * sliceCount
+        width = max(sliceCount / 10.0, 1.0)
+        return examResult, lambda index: math.exp(-((index - center) / width) ** 2)
+
+
+def standInHandlers(inputFolder: str = "") -> list:
+    return [StandInChestModel(inputFolder), StandInPEModel(inputFolder)]
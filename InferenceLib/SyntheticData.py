@@ -0,0 +1,146 @@
+"""
+Synthetic inputs for benchmarks and offline runs.
+
+Writes NRRD volumes (like the chest X-ray export of `slicer.util.saveNode`) and CT-like DICOM series (like
+the series copied for PE detection) of any size, with deterministic content, without Slicer or pydicom.
+The DICOM files are minimal but valid Part 10 files in explicit VR little endian.
+"""
+
+import os
+import struct
+import uuid
+
+import numpy as np
+
+_UID_ROOT = "2.25."
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+
+
+def newUID() -> str:
+    """UID derived from a random UUID (the 2.25 root does not need a registered organization root)."""
+    return _UID_ROOT + str(uuid.uuid4().int)
+
+
+def syntheticImage(shape, seed: int = 0, dtype=np.int16):
+    """Deterministic noisy image with a few bright blobs, indexed (k, j, i) like slicer.util.arrayFromVolume."""
+    rng = np.random.default_rng(seed)
+    shape = tuple(int(size) for size in shape)
+    array = rng.normal(100.0, 20.0, size=shape).astype(np.float32)
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    for _ in range(3):
+        center = [rng.uniform(0, size) for size in shape]
+        radius = max(min(shape[-2:]) * rng.uniform(0.03, 0.1), 1.0)
+        distance = sum(((axis - c) / radius) ** 2 for axis, c in zip(grid, center))
+        array += 800.0 * np.exp(-distance)
+    return array.astype(dtype)
+
+
+def writeNrrd(path: str, array, spacing=(1.0, 1.0, 1.0)) -> str:
+    """Write a (k, j, i) array as a raw little endian NRRD file, a 2D image being written with one slice."""
+    array = np.asarray(array)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    types = {np.dtype(np.int16): "short", np.dtype(np.uint16): "ushort", np.dtype(np.uint8): "uchar",
+             np.dtype(np.float32): "float", np.dtype(np.int32): "int"}
+    sizes = " ".join(str(size) for size in reversed(array.shape))
+    header = (
+        "NRRD0004\n"
+        f"type: {types[array.dtype]}\n"
+        "dimension: 3\n"
+        "space: left-posterior-superior\n"
+        f"sizes: {sizes}\n"
+        f"space directions: ({spacing[0]},0,0) (0,{spacing[1]},0) (0,0,{spacing[2]})\n"
+        "kinds: domain domain domain\n"
+        "endian: little\n"
+        "encoding: raw\n"
+        "space origin: (0,0,0)\n"
+        "\n"
+    )
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")).tobytes())
+    return path
+
+
+def _element(group: int, element: int, vr: str, value) -> bytes:
+    if isinstance(value, str):
+        data = value.encode("ascii")
+        if len(data) % 2:
+            data += b"\0" if vr == "UI" else b" "
+    else:
+        data = bytes(value)
+        if len(data) % 2:
+            data += b"\0"
+    if vr in ("OB", "OW", "SQ", "UN", "UT"):
+        return struct.pack("<HH2s2xI", group, element, vr.encode("ascii"), len(data)) + data
+    return struct.pack("<HH2sH", group, element, vr.encode("ascii"), len(data)) + data
+
+
+def _us(value: int) -> bytes:
+    return struct.pack("<H", value)
+
+
+def writeDicomSlice(path: str, pixels, studyUID: str, seriesUID: str, instanceUID: str, instanceNumber: int,
+                    position, patientID: str = "SYNTHETIC", studyDate: str = "20240101",
+                    pixelSpacing=(0.7, 0.7)) -> str:
+    """Write one CT slice (a 2D uint16/int16 array) as a DICOM Part 10 file."""
+    pixels = np.ascontiguousarray(pixels, dtype="<u2")
+    rows, columns = pixels.shape
+    dataset = b"".join([
+        _element(0x0008, 0x0016, "UI", CT_IMAGE_STORAGE),
+        _element(0x0008, 0x0018, "UI", instanceUID),
+        _element(0x0008, 0x0020, "DA", studyDate),
+        _element(0x0008, 0x0060, "CS", "CT"),
+        _element(0x0010, 0x0020, "LO", patientID),
+        _element(0x0020, 0x000D, "UI", studyUID),
+        _element(0x0020, 0x000E, "UI", seriesUID),
+        _element(0x0020, 0x0013, "IS", str(instanceNumber)),
+        _element(0x0020, 0x0032, "DS", "\\".join(f"{value:g}" for value in position)),
+        _element(0x0020, 0x0037, "DS", "1\\0\\0\\0\\1\\0"),
+        _element(0x0028, 0x0002, "US", _us(1)),
+        _element(0x0028, 0x0004, "CS", "MONOCHROME2"),
+        _element(0x0028, 0x0010, "US", _us(rows)),
+        _element(0x0028, 0x0011, "US", _us(columns)),
+        _element(0x0028, 0x0030, "DS", "\\".join(f"{value:g}" for value in pixelSpacing)),
+        _element(0x0028, 0x0100, "US", _us(16)),
+        _element(0x0028, 0x0101, "US", _us(12)),
+        _element(0x0028, 0x0102, "US", _us(11)),
+        _element(0x0028, 0x0103, "US", _us(0)),
+        _element(0x0028, 0x1052, "DS", "-1024"),
+        _element(0x0028, 0x1053, "DS", "1"),
+        _element(0x7FE0, 0x0010, "OW", pixels.tobytes()),
+    ])
+    meta = b"".join([
+        _element(0x0002, 0x0001, "OB", b"\0\1"),
+        _element(0x0002, 0x0002, "UI", CT_IMAGE_STORAGE),
+        _element(0x0002, 0x0003, "UI", instanceUID),
+        _element(0x0002, 0x0010, "UI", EXPLICIT_VR_LITTLE_ENDIAN),
+    ])
+    with open(path, "wb") as f:
+        f.write(b"\0" * 128 + b"DICM")
+        f.write(_element(0x0002, 0x0000, "UL", struct.pack("<I", len(meta))))
+        f.write(meta)
+        f.write(dataset)
+    return path
+
+
+def writeDicomSeries(folder: str, slices: int = 64, rows: int = 256, columns: int = 256, seed: int = 0,
+                     sliceThickness: float = 1.25) -> dict:
+    """
+    Write a synthetic CT series, one file per slice, to `folder`.
+    :return: series dict as used by the batch inputs (see DicomIndex.SeriesIndex.toDict)
+    """
+    os.makedirs(folder, exist_ok=True)
+    studyUID, seriesUID = newUID(), newUID()
+    volume = np.clip(syntheticImage((slices, rows, columns), seed) + 1024, 0, 4095)
+    instanceUIDs, files = [], []
+    for index in range(slices):
+        instanceUID = newUID()
+        path = os.path.join(folder, f"{index:05d}.dcm")
+        writeDicomSlice(path, volume[index], studyUID, seriesUID, instanceUID, index + 1,
+                        (0.0, 0.0, index * sliceThickness))
+        instanceUIDs.append(instanceUID)
+        files.append(path)
+    return {"studyInstanceUID": studyUID, "seriesInstanceUID": seriesUID, "instanceUIDs": instanceUIDs,
+            "files": files, "modality": "CT", "patientID": "SYNTHETIC", "studyDate": "20240101"}
@@ -0,0 +1 @@
+"""Unit tests of the InferenceLib modules that run without Slicer, Docker or a GPU: python -m pytest InferenceLib"""
@@ -0,0 +1,47 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from InferenceLib.ChunkedExport import MemoryBudget, slabs, writeNrrd
+
+
+def readNrrd(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    header, _, payload = content.partition(b"\n\n")
+    fields = dict(line.split(": ", 1) for line in header.decode("ascii").splitlines()[1:])
+    if fields["encoding"] == "gzip":
+        payload = gzip.decompress(payload)
+    return fields, payload
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_write_nrrd_in_slabs(tmp_path, compression):
+    array = np.arange(10 * 6 * 5, dtype=">i2").reshape(10, 6, 5)  # big endian: every slab is converted
+    budget = MemoryBudget(limit=2 * array[:3].nbytes)
+    path = str(tmp_path / "volume.nrrd")
+
+    stats = writeNrrd(path, array, np.eye(4), compression, chunkBytes=array[:3].nbytes, budget=budget)
+
+    fields, payload = readNrrd(path)
+    assert fields["sizes"] == "5 6 10" and fields["type"] == "short" and fields["endian"] == "little"
+    np.testing.assert_array_equal(np.frombuffer(payload, dtype="<i2").reshape(array.shape), array)
+    assert 0 < budget.peak <= budget.limit and budget.inUse == 0
+    assert stats.rawBytes == array.nbytes
+    assert not (tmp_path / "volume.nrrd.part").exists()
+
+
+def test_slabs_cover_whole_slices():
+    array = np.zeros((7, 4, 4), dtype=np.uint8)
+    ranges = [(start, stop) for start, stop, _ in slabs(array, chunkBytes=3 * 16 + 1)]
+    assert ranges == [(0, 3), (3, 6), (6, 7)]
+
+
+def test_budget_reservation_times_out():
+    budget = MemoryBudget(limit=100)
+    with budget.reserve(80):
+        with pytest.raises(TimeoutError):
+            with budget.reserve(40, timeout=0.01):
+                pass
+    assert budget.inUse == 0
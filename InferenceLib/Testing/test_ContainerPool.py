@@ -0,0 +1,76 @@
+import threading
+import time
+
+from InferenceLib.ContainerPool import ContainerPool, ContainerSpec
+
+
+class SlowContainer:
+    def __init__(self, name):
+        self.name = name
+        self.status = "running"
+
+    def reload(self):
+        pass
+
+    def start(self):
+        self.status = "running"
+
+    def stop(self):
+        self.status = "exited"
+
+
+class SlowContainers:
+    def __init__(self, delay):
+        self.delay = delay
+        self.created = []
+
+    def list(self, all=False, filters=None):
+        return []
+
+    def run(self, image, name=None, **kwargs):
+        time.sleep(self.delay)
+        self.created.append(name)
+        return SlowContainer(name)
+
+
+class SlowDockerClient:
+    def __init__(self, delay):
+        self.containers = SlowContainers(delay)
+
+
+def test_container_creation_does_not_block_other_callers():
+    client = SlowDockerClient(delay=0.5)
+    pool = ContainerPool(clientFactory=lambda: client, idleTimeout=None)
+    first = ContainerSpec("first", gpuDeviceIds=[])
+    second = ContainerSpec("second", gpuDeviceIds=[])
+    warm = pool.acquire(first)
+    pool.release(warm)
+
+    slowAcquire = threading.Thread(target=pool.acquire, args=(second,))
+    slowAcquire.start()
+    time.sleep(0.1)
+    startTime = time.perf_counter()
+    container = pool.acquire(first)
+    pool.release(container)
+    assert time.perf_counter() - startTime < 0.2
+    slowAcquire.join()
+    assert client.containers.created == ["first_container", "second_container"]
+    pool.shutdown()
+
+
+def test_failed_creation_frees_the_slot():
+    client = SlowDockerClient(delay=0.0)
+    pool = ContainerPool(clientFactory=lambda: client, idleTimeout=None)
+    spec = ContainerSpec("broken", gpuDeviceIds=[])
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("image not found")
+
+    client.containers.run = fail
+    try:
+        pool.acquire(spec, timeout=1.0)
+    except RuntimeError:
+        pass
+    client.containers.run = SlowContainers(0.0).run
+    assert pool.acquire(spec, timeout=1.0).name == "broken_container"
+    pool.shutdown(stopContainers=False)
@@ -0,0 +1,112 @@
+import numpy as np
+
+from InferenceLib.DetectionRegistry import DetectionRegistry
+
+
+class FakeNode:
+    def __init__(self, nodeID):
+        self.nodeID = nodeID
+
+    def GetID(self):
+        return self.nodeID
+
+
+class FakeOverlay:
+    """Records the box visibility the registry asks for, per model node."""
+
+    def __init__(self):
+        self.shown = {}
+        self.removed = []
+
+    def setBoxesVisible(self, modelNode, visible):
+        self.shown[modelNode.GetID()] = np.array(visible, dtype=bool)
+
+    def setBoxVisible(self, modelNode, boxIndex, visible):
+        self.shown.setdefault(modelNode.GetID(), {})[boxIndex] = visible
+
+    def removeDetectionSet(self, modelNode):
+        self.removed.append(modelNode.GetID())
+
+    def clear(self):
+        self.shown.clear()
+
+
+class FakeParameterNode:
+    """Get/set string parameters like vtkMRMLScriptedModuleNode."""
+
+    def __init__(self):
+        self.parameters = {}
+
+    def GetParameter(self, name):
+        return self.parameters.get(name, "")
+
+    def SetParameter(self, name, value):
+        self.parameters[name] = value
+
+
+def makeRegistry(nodes, parameterNode=None):
+    def save(registry):
+        if parameterNode is not None:
+            parameterNode.SetParameter("detectionRegistry", registry.toJson())
+
+    return DetectionRegistry(FakeOverlay(), onChanged=save, getNodeByID=nodes.get)
+
+
+def test_filter_by_confidence_in_one_run_or_all_runs():
+    nodes = {"vtkMRMLModelNode1": FakeNode("vtkMRMLModelNode1"), "vtkMRMLModelNode2": FakeNode("vtkMRMLModelNode2")}
+    registry = makeRegistry(nodes)
+    first = registry.addRun(nodes["vtkMRMLModelNode1"], [0.9, 0.2, 0.5])
+    second = registry.addRun(nodes["vtkMRMLModelNode2"], [0.1, 0.7])
+
+    registry.filterByConfidence(0.5, first)
+    assert registry.overlay.shown["vtkMRMLModelNode1"].tolist() == [True, False, True]
+    assert "vtkMRMLModelNode2" not in registry.overlay.shown
+
+    registry.filterByConfidence(0.8)
+    assert registry.overlay.shown["vtkMRMLModelNode1"].tolist() == [True, False, False]
+    assert registry.overlay.shown["vtkMRMLModelNode2"].tolist() == [False, False]
+    assert registry.runs[second].minimumConfidence == 0.8
+
+
+def test_clear_box_stays_cleared_when_filtering():
+    nodes = {"vtkMRMLModelNode1": FakeNode("vtkMRMLModelNode1")}
+    registry = makeRegistry(nodes)
+    runId = registry.addRun(nodes["vtkMRMLModelNode1"], [0.9, 0.8, 0.7])
+
+    assert registry.clearBox(runId, 1)
+    assert registry.overlay.shown["vtkMRMLModelNode1"] == {1: False}
+    assert not registry.clearBox(runId, 3)
+    assert not registry.clearBox("run99", 0)
+
+    registry.filterByConfidence(0.0)
+    assert registry.overlay.shown["vtkMRMLModelNode1"].tolist() == [True, False, True]
+
+
+def test_json_round_trip_through_the_parameter_node():
+    nodes = {"vtkMRMLModelNode1": FakeNode("vtkMRMLModelNode1"), "vtkMRMLModelNode2": FakeNode("vtkMRMLModelNode2")}
+    parameterNode = FakeParameterNode()
+    registry = makeRegistry(nodes, parameterNode)
+    first = registry.addRun(nodes["vtkMRMLModelNode1"], [0.9, 0.3])
+    registry.addRun(nodes["vtkMRMLModelNode2"], [0.6])
+    registry.clearBox(first, 0)
+    registry.filterByConfidence(0.5, first)
+    registry.setBoxVisible(first, 1, False)
+
+    # the scene is loaded again without the node of the second run
+    del nodes["vtkMRMLModelNode2"]
+    restored = makeRegistry(nodes)
+    restored.loadJson(parameterNode.GetParameter("detectionRegistry"))
+
+    assert restored.runIds() == [first]
+    run = restored.runs[first]
+    assert run.nodeID == "vtkMRMLModelNode1"
+    assert run.cleared.tolist() == [True, False] and run.visible.tolist() == [True, False]
+    assert run.minimumConfidence == 0.5
+    # new runs do not reuse the ids of the saved ones
+    assert restored.addRun(nodes["vtkMRMLModelNode1"], [0.4]) == "run3"
+
+
+def test_empty_parameter_restores_an_empty_registry():
+    registry = makeRegistry({})
+    registry.loadJson("")
+    assert registry.runIds() == [] and registry.latestRunId is None
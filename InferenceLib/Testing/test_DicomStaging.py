@@ -0,0 +1,56 @@
+import os
+import time
+
+from InferenceLib.DicomStaging import stageFiles, stagedFileNames
+
+
+def writeFile(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_duplicate_basenames_are_all_staged(tmp_path):
+    first = writeFile(str(tmp_path / "a" / "IM0001"), b"first")
+    second = writeFile(str(tmp_path / "b" / "IM0001"), b"second")
+    single = writeFile(str(tmp_path / "b" / "IM0002.dcm"), b"single")
+    staged = str(tmp_path / "staged")
+
+    stats = stageFiles([first, second, single], staged)
+
+    assert stats.files == 3
+    assert sorted(stagedFileNames([first, second, single]).values()) == sorted([first, second, single])
+    names = sorted(os.listdir(staged))
+    assert len(names) == 3 and "IM0002.dcm" in names
+    contents = sorted(open(os.path.join(staged, name), "rb").read() for name in names)
+    assert contents == [b"first", b"second", b"single"]
+    # the names only depend on the paths
+    assert stagedFileNames([second, first, single]) == stagedFileNames([first, second, single])
+
+
+def test_restaging_skips_up_to_date_files(tmp_path):
+    files = [writeFile(str(tmp_path / "series" / f"IM{index}"), b"x" * index) for index in range(1, 4)]
+    staged = str(tmp_path / "staged")
+    stageFiles(files, staged)
+
+    stats = stageFiles(files, staged)
+
+    assert stats.skipped == 3 and stats.linked == 0 and stats.copied == 0
+
+
+def test_replaced_source_is_staged_again(tmp_path):
+    source = writeFile(str(tmp_path / "series" / "IM1"), b"old")
+    staged = str(tmp_path / "staged")
+    stageFiles([source], staged)
+    mtime = os.stat(source).st_mtime
+    # same size and mtime, but a new file: the hard link still points to the old one
+    os.remove(source)
+    writeFile(source, b"new")
+    os.utime(source, (time.time(), mtime))
+
+    stats = stageFiles([source], staged)
+
+    assert stats.skipped == 0
+    with open(os.path.join(staged, "IM1.dcm"), "rb") as f:
+        assert f.read() == b"new"
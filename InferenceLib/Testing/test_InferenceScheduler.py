@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from InferenceLib.ContainerPool import ContainerSpec
+from InferenceLib.InferenceScheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_URGENT, InferenceScheduler
+from InferenceLib.ModelRegistry import ModelRegistry, ModelSpec
+
+
+class FakePool:
+    def acquire(self, spec):
+        return f"{spec.image} container"
+
+    def release(self, container):
+        pass
+
+    def serverClient(self, container):
+        return None
+
+
+def makeScheduler(gpuSlots=2):
+    registry = ModelRegistry()
+    for name, gpu in (("chestyolov5", "0"), ("pedetect_v1", "0"), ("other", "1")):
+        registry.register(ModelSpec(name, ContainerSpec(name, gpuDeviceIds=[gpu]), cpuSlots=0))
+    return InferenceScheduler(registry, FakePool(), capacities={"gpu:0": gpuSlots}, pollInterval=0.01)
+
+
+def waitUntil(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def startAcquire(scheduler, modelName, priority, granted):
+    def run():
+        lease = scheduler.acquire(modelName, priority)
+        granted.append((modelName, priority, lease))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_slots_limit_concurrent_runs():
+    scheduler = makeScheduler(gpuSlots=2)
+    first = scheduler.acquire("chestyolov5", PRIORITY_BATCH)
+    second = scheduler.acquire("pedetect_v1", PRIORITY_BATCH)
+    assert scheduler.status()["resources"] == {"gpu:0": 2}
+
+    with pytest.raises(TimeoutError):
+        scheduler.acquire("chestyolov5", PRIORITY_URGENT, timeout=0.05)
+
+    scheduler.release(first)
+    third = scheduler.acquire("chestyolov5", PRIORITY_URGENT, timeout=1.0)
+    assert scheduler.status()["resources"] == {"gpu:0": 2}
+    scheduler.release(second)
+    scheduler.release(third)
+    assert scheduler.status() == {"running": [], "waiting": [], "resources": {"gpu:0": 0}}
+
+
+def test_urgent_job_goes_ahead_of_queued_batch_work():
+    scheduler = makeScheduler(gpuSlots=2)
+    running = [scheduler.acquire("chestyolov5", PRIORITY_BATCH), scheduler.acquire("chestyolov5", PRIORITY_BATCH)]
+    granted = []
+    startAcquire(scheduler, "chestyolov5", PRIORITY_BATCH, granted)
+    waitUntil(lambda: len(scheduler.status()["waiting"]) == 1)
+    startAcquire(scheduler, "pedetect_v1", PRIORITY_URGENT, granted)
+    waitUntil(lambda: len(scheduler.status()["waiting"]) == 2)
+    assert scheduler.status()["waiting"] == [("pedetect_v1", PRIORITY_URGENT), ("chestyolov5", PRIORITY_BATCH)]
+
+    scheduler.release(running.pop())
+    waitUntil(lambda: len(granted) == 1)
+    assert granted[0][:2] == ("pedetect_v1", PRIORITY_URGENT)
+    time.sleep(0.05)
+    assert len(granted) == 1  # the batch waits for the next free slot
+
+    scheduler.release(running.pop())
+    waitUntil(lambda: len(granted) == 2)
+    assert granted[1][:2] == ("chestyolov5", PRIORITY_BATCH)
+    for _, _, lease in granted:
+        scheduler.release(lease)
+
+
+def test_waiting_request_only_holds_back_its_own_resources():
+    scheduler = makeScheduler(gpuSlots=1)
+    running = scheduler.acquire("chestyolov5", PRIORITY_BATCH)
+    granted = []
+    startAcquire(scheduler, "pedetect_v1", PRIORITY_URGENT, granted)
+    waitUntil(lambda: len(scheduler.status()["waiting"]) == 1)
+
+    other = scheduler.acquire("other", PRIORITY_INTERACTIVE, timeout=1.0)  # gpu:1 is free
+
+    assert granted == []
+    scheduler.release(running)
+    waitUntil(lambda: len(granted) == 1)
+    scheduler.release(granted[0][2])
+    scheduler.release(other)
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from InferenceLib.BatchInference import BatchItem, createBatchJob
+from InferenceLib.Pipeline import Pipeline, PipelineCancelled, PipelineStage
+from InferenceLib.ResultStore import ResultStore
+
+
+def test_slow_stage_bounds_the_items_in_flight():
+    lock = threading.Lock()
+    counts = {"produced": 0, "consumed": 0, "maxInFlight": 0}
+
+    def produce(item):
+        with lock:
+            counts["produced"] += 1
+            counts["maxInFlight"] = max(counts["maxInFlight"], counts["produced"] - counts["consumed"])
+        return item
+
+    def consume(item):
+        with lock:
+            counts["consumed"] += 1
+        time.sleep(0.01)
+        return item
+
+    pipeline = Pipeline([PipelineStage("produce", produce, queueSize=1), PipelineStage("consume", consume, queueSize=2)])
+    done = []
+
+    assert pipeline.run(range(30), done.append) == 30
+
+    assert sorted(done) == list(range(30))
+    # the queue of the slow stage, the item waiting to be put into it and the one that was just produced
+    assert counts["maxInFlight"] <= 2 + 1 + 1
+
+
+def test_failed_item_does_not_stop_the_others():
+    def infer(item):
+        if item == 3:
+            raise ValueError("bad input")
+        return item * 10
+
+    failures = []
+    done = []
+    pipeline = Pipeline([PipelineStage("prepare", lambda item: item, mainThread=True), PipelineStage("infer", infer, workers=2)])
+
+    succeeded = pipeline.run(range(8), done.append, lambda item, stageName, error: failures.append((item, stageName, error)))
+
+    assert succeeded == 7
+    assert sorted(done) == [0, 10, 20, 40, 50, 60, 70]
+    assert [(item, stageName) for item, stageName, _ in failures] == [(3, "infer")]
+    assert isinstance(failures[0][2], ValueError)
+
+
+def test_main_thread_stage_runs_in_the_calling_thread():
+    threads = []
+    calls = []
+
+    def callInMainThread(function, *args):
+        calls.append(function)
+        return function(*args)
+
+    pipeline = Pipeline([PipelineStage("render", lambda item: threads.append(threading.current_thread()) or item,
+                                       mainThread=True, workers=4)], callInMainThread)
+    assert pipeline.run(range(5)) == 5
+    assert set(threads) == {threading.current_thread()} and len(calls) == 5
+
+
+def test_cancel_stops_the_run():
+    cancelEvent = threading.Event()
+    processed = []
+
+    def slow(item):
+        time.sleep(0.02)
+        processed.append(item)
+        return item
+
+    pipeline = Pipeline([PipelineStage("slow", slow)], cancelEvent=cancelEvent)
+    with pytest.raises(PipelineCancelled):
+        pipeline.run(range(100), lambda result: cancelEvent.set())
+    time.sleep(0.1)
+    assert len(processed) < 10
+
+
+def test_batch_job_isolates_failing_items(tmp_path):
+    def prepare(job, context, batch):
+        for item in batch:
+            if item.key == "unreadable":
+                item.error = "Could not load unreadable"
+            else:
+                item.request = {"input": item.key}
+
+    def infer(job, context, batch):
+        for item in batch:
+            if item.key == "crash":
+                raise RuntimeError("model crashed")
+        for item in batch:
+            item.result = {"input": item.request["input"]}
+
+    keys = ["a", "unreadable", "b", "c", "crash", "d"]
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    try:
+        job = createBatchJob("test batch", "model", [BatchItem(key=key) for key in keys], store, 2, prepare, infer)
+        summary = job.runSynchronously()
+
+        records = {record["key"]: record for record in store.records("model")}
+        assert summary["done"] + summary["failed"] == len(keys)
+        assert records["unreadable"]["status"] != "done"
+        assert records["a"]["status"] == "done" and records["a"]["result"] == {"input": "a"}
+        assert all(records[key]["status"] == "done" for key in ("b", "c"))
+        # "crash" fails the infer call of its batch (with "d"), the other batches still run
+        assert records["crash"]["status"] != "done" and records["d"]["status"] != "done"
+        assert summary["done"] == 3
+    finally:
+        store.close()
@@ -0,0 +1,50 @@
+import itertools
+import sys
+import types
+
+from InferenceLib.ResultCache import ResultCache, cacheKey
+
+
+def openCache(tmp_path, monkeypatch, maxBytes):
+    # one tick per access, so that the access order does not depend on the clock resolution
+    clock = itertools.count(1)
+    # (InferenceLib re-exports the ResultCache class under the name of its module)
+    monkeypatch.setattr(sys.modules["InferenceLib.ResultCache"], "time", types.SimpleNamespace(time=lambda: float(next(clock))))
+    return ResultCache(str(tmp_path / "cache.sqlite"), maxBytes=maxBytes)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    entry = {"boxes": "x" * 100}
+    cache = openCache(tmp_path, monkeypatch, maxBytes=3 * 120)
+    try:
+        for key in ("a", "b", "c"):
+            cache.put(key, entry)
+        assert cache.get("a") == entry  # "b" is now the least recently used
+
+        cache.put("d", entry)
+
+        assert cache.get("b") is None
+        assert all(cache.get(key) == entry for key in ("a", "c", "d"))
+        assert len(cache) == 3 and cache.totalBytes <= cache.maxBytes
+    finally:
+        cache.close()
+
+
+def test_entries_survive_reopening(tmp_path, monkeypatch):
+    cache = openCache(tmp_path, monkeypatch, maxBytes=1024)
+    cache.put("key", [1, 2, 3])
+    cache.close()
+
+    cache = openCache(tmp_path, monkeypatch, maxBytes=1024)
+    try:
+        assert cache.get("key") == [1, 2, 3]
+        assert cache.hits == 1 and cache.misses == 0
+    finally:
+        cache.close()
+
+
+def test_keys_depend_on_version_and_parameters():
+    key = cacheKey("chestyolov5", "1", "pixels:abc", {"confidence": 0.05})
+    assert key == cacheKey("chestyolov5", "1", "pixels:abc", {"confidence": 0.05})
+    assert key != cacheKey("chestyolov5", "2", "pixels:abc", {"confidence": 0.05})
+    assert key != cacheKey("chestyolov5", "1", "pixels:abc", {"confidence": 0.25})
@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from InferenceLib.ContainerPool import ContainerSpec
+from InferenceLib.FakeDocker import FakeDockerClient
+from InferenceLib.InferenceClient import InferenceError
+from InferenceLib.ModelRegistry import INPUT_DICOM, ModelSpec
+from InferenceLib.ResultChannel import ResultChannel, execResultChannel
+from InferenceLib.StandInModels import PE_EXAM_LABELS
+
+COMMAND = "python /workfolder/main.py --run-type inference --input study_series"
+
+
+class SilentContainer:
+    """Exits with 0 without writing a result, or writes `content` to `resultPath` like a crashed writer."""
+
+    name = "silent"
+
+    def __init__(self, resultPath=None, content=None):
+        self.resultPath = resultPath
+        self.content = content
+
+    def exec_run(self, cmd, detach=False):
+        if self.resultPath is not None:
+            with open(self.resultPath, "w") as f:
+                f.write(self.content)
+        return 0, b""
+
+
+@pytest.fixture
+def fakeContainer(tmp_path):
+    def makeContainer(modelLoadTime=0.0):
+        model = ModelSpec("pedetect_v1", ContainerSpec("pedetect_v1"), inputFormats=[INPUT_DICOM],
+                          inputFolder=str(tmp_path / "input"), resultFolder=str(tmp_path / "result"))
+        os.makedirs(model.resultFolder, exist_ok=True)
+        client = FakeDockerClient([model], modelLoadTime=modelLoadTime)
+        return client.containers.list()[0], os.path.join(model.resultFolder, "study_series_result.json")
+    return makeContainer
+
+
+def test_result_file_is_delivered(fakeContainer):
+    container, resultPath = fakeContainer()
+
+    result = execResultChannel(container, COMMAND, resultPath, timeout=10).result(10)
+
+    assert [entry["id"] for entry in result] == PE_EXAM_LABELS
+
+
+def test_non_zero_exit_code_fails_instead_of_delivering_a_stale_result(fakeContainer):
+    container, resultPath = fakeContainer()
+    with open(resultPath, "w") as f:
+        json.dump([{"id": "stale"}], f)
+
+    channel = execResultChannel(container, "python /workfolder/main.py --run-type inference", resultPath, timeout=10)
+
+    with pytest.raises(InferenceError, match="exited with code 1"):
+        channel.result(10)
+    assert not os.path.exists(resultPath)
+
+
+def test_timeout(fakeContainer):
+    container, resultPath = fakeContainer(modelLoadTime=2.0)
+    channel = execResultChannel(container, COMMAND, resultPath, timeout=0.2)
+    with pytest.raises(TimeoutError):
+        channel.result(5)
+    assert channel.cancelled()
+
+
+def test_missing_result_file(tmp_path):
+    channel = execResultChannel(SilentContainer(), COMMAND, str(tmp_path / "result.json"), timeout=10, gracePeriod=0.1)
+    with pytest.raises(InferenceError, match="was not written"):
+        channel.result(5)
+
+
+def test_invalid_result_file(tmp_path):
+    resultPath = str(tmp_path / "result.json")
+    channel = execResultChannel(SilentContainer(resultPath, "{not json"), COMMAND, resultPath, timeout=10)
+    with pytest.raises(InferenceError, match="Could not read"):
+        channel.result(5)
+
+
+def test_run_delivers_return_value_and_exceptions():
+    assert ResultChannel.run(lambda value: value * 2, 21, timeout=5).result(5) == 42
+    with pytest.raises(ZeroDivisionError):
+        ResultChannel.run(lambda: 1 / 0, timeout=5).result(5)
@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from InferenceLib import SharedMemoryTransfer
+from InferenceLib.SharedMemoryTransfer import (SegmentPool, SharedArray, exportArrays, importArrays, segmentName,
+                                               segmentOwner)
+
+
+def removeForeignSegment(shared):
+    # segments of another owner are not registered with the resource tracker of this process
+    shared.close()
+    path = os.path.join("/dev/shm", shared.name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def test_create_attach_round_trip():
+    array = np.arange(2 * 3 * 4, dtype=np.int16).reshape(2, 3, 4)
+    with SharedArray.create(array) as shared:
+        assert segmentOwner(shared.name) == os.getpid()
+        attached = SharedArray.attach(shared.descriptor)
+        try:
+            assert attached.array.dtype == np.int16
+            np.testing.assert_array_equal(attached.array, array)
+        finally:
+            attached.close()
+
+
+def test_export_import_arrays_round_trip():
+    result = {"probabilities": np.linspace(0, 1, 5, dtype=np.float32), "label": "pe", "score": np.float32(0.5),
+              "boxes": [np.ones((2, 4)), 3]}
+    segments = []
+    exported = exportArrays(result, os.getpid(), segments)
+    assert len(segments) == 2 and exported["label"] == "pe" and exported["score"] == 0.5
+    assert set(exported["probabilities"]) == {"sharedArray"}
+    for shared in segments:
+        shared.close()
+
+    names = []
+    imported = importArrays(exported, names)
+
+    assert sorted(names) == sorted(shared.name for shared in segments)
+    np.testing.assert_array_equal(imported["probabilities"], result["probabilities"])
+    np.testing.assert_array_equal(imported["boxes"][0], result["boxes"][0])
+    assert imported["boxes"][1] == 3
+
+
+def test_pool_reuses_released_segments():
+    pool = SegmentPool(maxIdleBytes=1024 * 1024)
+    try:
+        first = SharedArray.create(np.zeros(1000, dtype=np.uint8), pool=pool)
+        name = first.name
+        first.unlink()
+        second = SharedArray.create(np.ones(900, dtype=np.uint8), pool=pool)
+        assert second.name == name
+        assert second.array.shape == (900,) and second.array.all()
+        second.unlink()
+    finally:
+        pool.clear()
+
+
+def test_server_side_export_leaves_client_segments_alone(monkeypatch):
+    calls = []
+    monkeypatch.setattr(SharedMemoryTransfer, "cleanupStaleSegments", lambda: calls.append(True) or 0)
+    # pid of the client as seen from the server, not a process of this PID namespace
+    segments = []
+    exportArrays({"mask": np.zeros((4, 4))}, owner=2 ** 22 + 1, segments=segments)
+    for shared in segments:
+        removeForeignSegment(shared)
+    assert calls == []
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_cleanup_removes_segments_of_exited_processes():
+    process = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    deadPid = int(process.stdout)
+    stale = SharedArray.create(np.zeros(16), owner=deadPid)
+    stale.close()
+    live = SharedArray.create(np.zeros(16))
+    try:
+        SharedMemoryTransfer.cleanupStaleSegments()
+        assert not os.path.exists(os.path.join("/dev/shm", stale.name))
+        assert os.path.exists(os.path.join("/dev/shm", live.name))
+    finally:
+        live.unlink()
+        removeForeignSegment(stale)
+
+
+def test_segment_names_carry_their_owner():
+    assert segmentOwner(segmentName(1234)) == 1234
+    assert segmentOwner("psm_1234") is None
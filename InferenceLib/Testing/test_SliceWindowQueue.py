@@ -0,0 +1,80 @@
+from InferenceLib.FakeDocker import SlowHandler
+from InferenceLib.InferenceClient import InferenceClient
+from InferenceLib.InferenceServer import InferenceServer
+from InferenceLib.SliceWindowQueue import SliceWindowQueue
+from InferenceLib.StandInModels import PE_EXAM_LABELS, StandInPEModel
+
+
+def drain(queue):
+    windows = []
+    window = queue.next()
+    while window is not None:
+        windows.append(window)
+        window = queue.next()
+    return windows
+
+
+def test_windows_nearest_to_focus_first():
+    windows = drain(SliceWindowQueue(100, 16, focus=50))
+    assert [window[0] for window in windows] == [48, 32, 64, 16, 80, 0, 96]
+    assert windows[-1] == [96, 97, 98, 99]
+
+
+def test_every_slice_handed_out_once():
+    windows = drain(SliceWindowQueue(37, 8, focus=3))
+    assert sorted(index for window in windows for index in window) == list(range(37))
+
+
+def test_default_focus_is_middle_slice():
+    assert SliceWindowQueue(40, 10).next() == list(range(20, 30))
+
+
+def test_set_focus_reorders_remaining_windows():
+    queue = SliceWindowQueue(100, 10, focus=0)
+    assert queue.next()[0] == 0
+    queue.setFocus(1000)
+    assert queue.focus == 99
+    assert queue.next()[0] == 90
+    assert queue.remainingWindows() == queue.windowCount - 2
+
+
+def test_stand_in_stream_follows_focus_slice():
+    uids = [f"1.2.{index}" for index in range(100)]
+    parts = list(StandInPEModel().inferStream({"input": "series", "instanceUIDs": uids, "focusSlice": 70}, chunkSize=16))
+    assert [part[0]["id"] for part in parts[:-1]][:2] == ["1.2.64", "1.2.48"]
+    assert [entry["id"] for entry in parts[-1]] == PE_EXAM_LABELS
+    assert sorted(entry["id"] for part in parts[:-1] for entry in part) == sorted(uids)
+
+
+def test_stand_in_stream_follows_focus_moved_while_streaming():
+    model = StandInPEModel()
+    uids = [f"1.2.{index}" for index in range(100)]
+    stream = model.inferStream({"input": "series", "instanceUIDs": uids, "focusSlice": 50, "streamId": "s1"},
+                               chunkSize=10)
+    assert next(stream)[0]["id"] == "1.2.50"
+    assert model.setStreamFocus("s1", 5)
+    assert next(stream)[0]["id"] == "1.2.0"
+    assert next(stream)[0]["id"] == "1.2.10"
+    assert model.setStreamFocus("s1", 95)
+    assert next(stream)[0]["id"] == "1.2.90"
+    rest = list(stream)
+    assert [entry["id"] for entry in rest[-1]] == PE_EXAM_LABELS
+    assert len(rest) == 10 - 4 + 1
+    assert not model.setStreamFocus("s1", 0)  # finished streams are forgotten
+
+
+def test_focus_update_reaches_a_running_stream_through_the_server():
+    uids = [f"1.2.{index}" for index in range(128)]  # 4 chunks of 32
+    # 0.2 s per part: the focus update arrives while the server waits for the next part
+    server = InferenceServer([SlowHandler(StandInPEModel(), latency=0.2 * 5)]).start()
+    try:
+        client = InferenceClient(server.url)
+        request = {"input": "series", "instanceUIDs": uids, "focusSlice": 64, "streamId": "s2"}
+        stream = client.inferStream("pedetect_v1", request)
+        first = next(stream)
+        assert client.setStreamFocus("pedetect_v1", "s2", 127)
+        parts = [first] + list(stream)
+        assert [part[0]["id"] for part in parts[:-1]] == ["1.2.64", "1.2.96", "1.2.32", "1.2.0"]
+        assert not client.setStreamFocus("pedetect_v1", "s2", 0)
+    finally:
+        server.stop()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from InferenceLib.VolumeTransfer import decodeVolume, decodeVolumes, encodeVolume
+
+
+def frameBytes(parts):
+    return b"".join(bytes(part) for part in parts)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_round_trip(compression):
+    array = np.arange(3 * 4 * 5, dtype=np.int16).reshape(3, 4, 5)
+    ijkToRas = np.diag([-0.7, -0.7, 2.5, 1.0])
+    ijkToRas[:3, 3] = [10.0, -20.0, 30.0]
+
+    parts, stats = encodeVolume(array, ijkToRas, compression)
+    decoded, matrix = decodeVolume(frameBytes(parts))
+
+    assert decoded.dtype == array.dtype
+    np.testing.assert_array_equal(decoded, array)
+    np.testing.assert_array_equal(matrix, ijkToRas)
+    assert stats.rawBytes == array.nbytes and stats.wireBytes == len(frameBytes(parts))
+
+
+def test_uncompressed_payload_is_not_copied():
+    array = np.zeros((2, 8, 8), dtype=np.float32)
+    parts, _ = encodeVolume(array, np.eye(4))
+    assert np.shares_memory(np.frombuffer(parts[1], dtype=np.float32), array)
+
+
+def test_non_contiguous_and_big_endian_arrays():
+    array = np.arange(4 * 6, dtype=">u2").reshape(4, 6)[:, ::2]
+    decoded, _ = decodeVolume(frameBytes(encodeVolume(array, np.eye(4))[0]))
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_batch_of_frames():
+    volumes = [(np.full((1, 2, 3), index, dtype=np.uint8), np.eye(4) * (index + 1)) for index in range(3)]
+    frames = b"".join(frameBytes(encodeVolume(array, matrix, "zlib" if index % 2 else None)[0])
+                      for index, (array, matrix) in enumerate(volumes))
+
+    decoded = decodeVolumes(frames)
+
+    assert len(decoded) == 3
+    for (array, matrix), (decodedArray, decodedMatrix) in zip(volumes, decoded):
+        np.testing.assert_array_equal(decodedArray, array)
+        np.testing.assert_array_equal(decodedMatrix, matrix)
+
+
+def test_rejects_other_data():
+    with pytest.raises(ValueError):
+        decodeVolume(b"NRRD0004" + bytes(200))
+    with pytest.raises(ValueError):
+        encodeVolume(np.zeros(1), np.eye(4), compression="lz4")
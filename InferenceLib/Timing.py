@@ -0,0 +1,195 @@
+"""
+Timing spans of the inference hot paths.
+
+Code that may be slow is wrapped in `span("name")` blocks. Every span records its start, duration, thread
+and the request ID of the job it belongs to, and is kept in a fixed size ring buffer, so instrumentation can
+stay enabled in production. The buffer can be summarised per span name (what the module timing panels
+show), exported as JSON lines, or exported in the Chrome trace format to be opened in chrome://tracing or
+https://ui.perfetto.dev.
+
+The request ID is kept per thread: InferenceJob sets it while running its stages, and it is carried over to
+the main thread and pipeline threads that work for the job.
+"""
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+_local = threading.local()
+
+
+def newRequestId() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def currentRequestId() -> Optional[str]:
+    """Request ID of the job the calling thread is working for, None outside of jobs."""
+    return getattr(_local, "requestId", None)
+
+
+@contextmanager
+def requestScope(requestId: Optional[str]):
+    """Attribute the spans recorded by the calling thread to `requestId` while the block runs."""
+    previous = currentRequestId()
+    _local.requestId = requestId
+    try:
+        yield
+    finally:
+        _local.requestId = previous
+
+
+#
+# Span
+#
+
+
+@dataclass
+class Span:
+    """One timed block. `start` is time.time() based, `duration` in seconds."""
+
+    name: str
+    start: float
+    duration: float
+    requestId: Optional[str] = None
+    thread: str = ""
+    error: Optional[str] = None
+    attributes: dict = field(default_factory=dict)
+
+
+#
+# SpanRecorder
+#
+
+
+class SpanRecorder:
+    """Thread safe ring buffer of the last `capacity` spans."""
+
+    def __init__(self, capacity: int = 4096, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._spans = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return self._spans.maxlen
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the block, e.g. `with recorder.span("saveNode", path=path):`. Failures are recorded too."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        startCounter = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(Span(name, start, time.perf_counter() - startCounter, currentRequestId(),
+                             threading.current_thread().name, error, attributes))
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, requestId: Optional[str] = None) -> list:
+        with self._lock:
+            spans = list(self._spans)
+        return spans if requestId is None else [span for span in spans if span.requestId == requestId]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+    def summary(self) -> list:
+        """
+        Statistics per span name, slowest total first:
+        [{"name", "count", "errors", "total", "mean", "p50", "p95", "max"}, ...], durations in seconds.
+        """
+        durations = collections.defaultdict(list)
+        errors = collections.Counter()
+        for span in self.spans():
+            durations[span.name].append(span.duration)
+            if span.error:
+                errors[span.name] += 1
+        rows = []
+        for name, values in durations.items():
+            values.sort()
+            rows.append({"name": name, "count": len(values), "errors": errors[name], "total": sum(values),
+                         "mean": sum(values) / len(values), "p50": _percentile(values, 0.5),
+                         "p95": _percentile(values, 0.95), "max": values[-1]})
+        rows.sort(key=lambda row: row["total"], reverse=True)
+        return rows
+
+    def exportJsonLines(self, path: str) -> int:
+        """Write one JSON object per span. Returns the number of spans written."""
+        spans = self.spans()
+        with open(path, "w", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(asdict(span), default=str) + "\n")
+        return len(spans)
+
+    def chromeTrace(self) -> dict:
+        """Spans as complete ("X") events of the Chrome trace event format, one track per thread."""
+        threadIds = {}
+        events = []
+        for span in self.spans():
+            threadId = threadIds.setdefault(span.thread, len(threadIds) + 1)
+            args = dict(span.attributes, requestId=span.requestId)
+            if span.error:
+                args["error"] = span.error
+            events.append({"name": span.name, "cat": span.requestId or "inference", "ph": "X",
+                           "ts": span.start * 1e6, "dur": span.duration * 1e6, "pid": os.getpid(),
+                           "tid": threadId, "args": {key: str(value) for key, value in args.items()}})
+        for threadName, threadId in threadIds.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": threadId,
+                           "args": {"name": threadName}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def exportChromeTrace(self, path: str) -> int:
+        trace = self.chromeTrace()
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(trace, file)
+        return sum(1 for event in trace["traceEvents"] if event["ph"] == "X")
+
+
+def _percentile(sortedValues: list, fraction: float) -> float:
+    index = min(int(round(fraction * (len(sortedValues) - 1))), len(sortedValues) - 1)
+    return sortedValues[index]
+
+
+_sharedRecorder = None
+
+
+def sharedSpanRecorder() -> SpanRecorder:
+    """Recorder that `span` and `timed` write to, read by the timing panels and the benchmark."""
+    global _sharedRecorder
+    if _sharedRecorder is None:
+        _sharedRecorder = SpanRecorder()
+    return _sharedRecorder
+
+
+def span(name: str, **attributes):
+    """Time a block with the shared recorder: `with span("exec_run", command=command):`."""
+    return sharedSpanRecorder().span(name, **attributes)
+
+
+def timed(name: str):
+    """Decorator recording every call of a function as a span of the shared recorder."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,101 @@
+"""
+Collapsible timing panel of the inference modules.
+
+Shows the span summary of a SpanRecorder (count, mean, p95 and max duration per span name) and the stage
+breakdown of the last job, and exports the recorded spans as JSON lines or as a Chrome trace.
+"""
+
+import os
+
+from .Timing import SpanRecorder, sharedSpanRecorder
+
+_COLUMNS = ["Span", "Count", "Mean (ms)", "p95 (ms)", "Max (ms)", "Total (s)"]
+
+#
+# TimingPanel
+#
+
+
+class TimingPanel:
+    """Widget to add to a module layout: `self.layout.addWidget(TimingPanel().widget)`."""
+
+    def __init__(self, recorder: SpanRecorder = None, title: str = "Timing") -> None:
+        import ctk
+        import qt
+
+        self.recorder = recorder or sharedSpanRecorder()
+        self.widget = ctk.ctkCollapsibleButton()
+        self.widget.text = title
+        self.widget.collapsed = True
+        layout = qt.QVBoxLayout(self.widget)
+
+        self.lastRequestLabel = qt.QLabel()
+        self.lastRequestLabel.wordWrap = True
+        layout.addWidget(self.lastRequestLabel)
+
+        self.table = qt.QTableWidget(0, len(_COLUMNS))
+        self.table.setHorizontalHeaderLabels(_COLUMNS)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.table.setMinimumHeight(160)
+        layout.addWidget(self.table)
+
+        buttons = qt.QHBoxLayout()
+        for text, slot in (("Refresh", self.refresh), ("Clear", self.clear),
+                           ("Export JSON lines...", self.onExportJsonLines),
+                           ("Export Chrome trace...", self.onExportChromeTrace)):
+            button = qt.QPushButton(text)
+            button.connect("clicked(bool)", lambda checked, slot=slot: slot())
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+
+        self.widget.connect("contentsCollapsed(bool)", lambda collapsed: None if collapsed else self.refresh())
+
+    def refresh(self) -> None:
+        """Update the table from the recorder. Cheap enough to call after every job."""
+        import qt
+
+        rows = self.recorder.summary()
+        self.table.setRowCount(len(rows))
+        for rowIndex, row in enumerate(rows):
+            values = [row["name"], str(row["count"]) + (f" ({row['errors']} failed)" if row["errors"] else ""),
+                      f"{row['mean'] * 1000:.1f}", f"{row['p95'] * 1000:.1f}", f"{row['max'] * 1000:.1f}",
+                      f"{row['total']:.2f}"]
+            for columnIndex, value in enumerate(values):
+                self.table.setItem(rowIndex, columnIndex, qt.QTableWidgetItem(value))
+        self.table.resizeColumnToContents(0)
+
+    def showRequest(self, requestId: str, title: str = "Last run") -> None:
+        """Show the stage breakdown of one job (InferenceJob.requestId) above the table and refresh the table."""
+        spans = sorted(self.recorder.spans(requestId), key=lambda span: span.start)
+        if spans:
+            total = max(span.start + span.duration for span in spans) - spans[0].start
+            slowest = sorted(spans, key=lambda span: span.duration, reverse=True)[:5]
+            details = ", ".join(f"{span.name} {span.duration:.2f} s" for span in slowest)
+            self.lastRequestLabel.text = f"{title} ({requestId}): {total:.2f} s. Slowest: {details}"
+        else:
+            self.lastRequestLabel.text = ""
+        self.refresh()
+
+    def clear(self) -> None:
+        self.recorder.clear()
+        self.lastRequestLabel.text = ""
+        self.refresh()
+
+    def onExportJsonLines(self) -> None:
+        self._export("Export timing spans", "JSON lines (*.jsonl)", "inference_spans.jsonl", self.recorder.exportJsonLines)
+
+    def onExportChromeTrace(self) -> None:
+        self._export("Export Chrome trace", "Chrome trace (*.json)", "inference_trace.json", self.recorder.exportChromeTrace)
+
+    def _export(self, caption, fileFilter, defaultName, export) -> None:
+        import qt
+        import slicer
+
+        path = qt.QFileDialog.getSaveFileName(self.widget, caption, os.path.join(slicer.app.temporaryPath, defaultName),
+                                              fileFilter)
+        if not path:
+            return
+        count = export(path)
+        slicer.util.showStatusMessage(f"Exported {count} spans to {path}", 3000)
@@ -0,0 +1,126 @@
+"""
+Compact binary frame carrying a voxel array and its IJK to RAS matrix.
+
+Frame layout (little endian):
+    magic b"SVOL" | version u8 | compression u8 | dtype length u8 | dtype str | ndim u8 | shape u32 * ndim
+    | IJK to RAS 16 * f64 (row major) | payload length u64 | payload
+The payload is the C-ordered voxel buffer, optionally zlib compressed.
+"""
+
+import struct
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+VOLUME_FRAME_CONTENT_TYPE = "application/x-slicer-volume"
+VOLUME_FRAME_MAGIC = b"SVOL"
+VOLUME_FRAME_VERSION = 1
+
+_COMPRESSIONS = {None: 0, "zlib": 1}
+
+#
+# TransferStats
+#
+
+
+@dataclass
+class TransferStats:
+    """
+    Byte counts and timings of one volume transfer, used to compare the transfer paths.
+
+    mode - "array" for binary frames, "nrrd" for the shared folder export.
+    rawBytes - size of the voxel buffer.
+    wireBytes - bytes written to the socket or to disk.
+    encodeSeconds - time spent building the frame or writing the NRRD file.
+    transferSeconds - time spent sending the frame and waiting for the result.
+    """
+
+    mode: str
+    rawBytes: int = 0
+    wireBytes: int = 0
+    encodeSeconds: float = 0.0
+    transferSeconds: float = 0.0
+
+    def summary(self) -> str:
+        ratio = self.wireBytes / self.rawBytes if self.rawBytes else 0.0
+        return (f"{self.mode}: {self.rawBytes / 1e6:.2f} MB raw, {self.wireBytes / 1e6:.2f} MB sent ({ratio:.0%}), "
+                f"encode {self.encodeSeconds * 1000:.1f} ms, transfer {self.transferSeconds * 1000:.1f} ms")
+
+
+def encodeVolume(array, ijkToRas, compression: Optional[str] = None, level: int = 1):
+    """
+    Pack `array` and the 4x4 `ijkToRas` matrix into a volume frame.
+    The uncompressed payload is a view of `array`, so the voxels are not copied.
+    :return: ([header, payload] buffers whose concatenation is the frame, TransferStats)
+    """
+    if compression not in _COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression}")
+    startTime = time.perf_counter()
+    array = np.ascontiguousarray(array)
+    matrix = np.asarray(ijkToRas, dtype="<f8").reshape(4, 4)
+    dtype = array.dtype.str.encode("ascii")
+    payload = memoryview(array).cast("B")
+    if compression == "zlib":
+        payload = zlib.compress(payload, level)
+    header = b"".join([
+        VOLUME_FRAME_MAGIC,
+        struct.pack("<BBB", VOLUME_FRAME_VERSION, _COMPRESSIONS[compression], len(dtype)),
+        dtype,
+        struct.pack("<B", array.ndim),
+        struct.pack(f"<{array.ndim}I", *array.shape),
+        matrix.tobytes(),
+        struct.pack("<Q", len(payload)),
+    ])
+    stats = TransferStats("array", rawBytes=array.nbytes, wireBytes=len(header) + len(payload),
+                          encodeSeconds=time.perf_counter() - startTime)
+    return [header, payload], stats
+
+
+def decodeVolume(frame):
+    """
+    Unpack a volume frame.
+    :return: (array, 4x4 IJK to RAS matrix as numpy array)
+    """
+    array, matrix, _ = _decodeVolumeAt(memoryview(frame), 0)
+    return array, matrix
+
+
+def decodeVolumes(frames):
+    """
+    Unpack the concatenated volume frames of a batch request.
+    :return: list of (array, 4x4 IJK to RAS matrix)
+    """
+    frames = memoryview(frames)
+    volumes = []
+    offset = 0
+    while offset < len(frames):
+        array, matrix, offset = _decodeVolumeAt(frames, offset)
+        volumes.append((array, matrix))
+    return volumes
+
+
+def _decodeVolumeAt(frame, offset):
+    if bytes(frame[offset:offset + 4]) != VOLUME_FRAME_MAGIC:
+        raise ValueError("Not a volume frame")
+    version, compressionCode, dtypeLength = struct.unpack_from("<BBB", frame, offset + 4)
+    if version != VOLUME_FRAME_VERSION:
+        raise ValueError(f"Unsupported volume frame version {version}")
+    offset += 7
+    dtype = np.dtype(bytes(frame[offset:offset + dtypeLength]).decode("ascii"))
+    offset += dtypeLength
+    (ndim,) = struct.unpack_from("<B", frame, offset)
+    offset += 1
+    shape = struct.unpack_from(f"<{ndim}I", frame, offset)
+    offset += 4 * ndim
+    matrix = np.frombuffer(frame[offset:offset + 128], dtype="<f8").reshape(4, 4).copy()
+    offset += 128
+    (payloadLength,) = struct.unpack_from("<Q", frame, offset)
+    offset += 8
+    payload = frame[offset:offset + payloadLength]
+    if compressionCode == _COMPRESSIONS["zlib"]:
+        payload = zlib.decompress(payload)
+    array = np.frombuffer(payload, dtype=dtype).reshape(shape)
+    return array, matrix, offset + payloadLength
@@ -0,0 +1,9 @@
+"""Inference helpers shared by the ChestXrayNodules and PE_Detect modules."""
+
+from .ContainerPool import ContainerPool, ContainerSpec, sharedContainerPool
+from .InferenceClient import InferenceClient, InferenceError
+from .InferenceScheduler import InferenceScheduler, sharedInferenceScheduler
+from .InferenceServer import InferenceServer, ModelHandler
+from .ModelRegistry import ModelRegistry, ModelSpec, sharedModelRegistry
+from .ResultCache import ResultCache, sharedResultCache
+from .ResultStore import ResultStore
@@ -0,0 +1,3 @@
+from .InferenceServer import main
+
+main()
@@ -2,6 +2,9 @@ import logging
 import os
 from typing import Annotated, Optional
 import random
+import secrets
+import ctk
+import qt
 import vtk
 import docker
 import slicer
@@ -18,93 +21,167 @@ from slicer import vtkMRMLScalarVolumeNode
 import numpy as np
 import time
 from vtk.util import numpy_support
-import shutil
 import pydicom
+import sys
+
+# The shared InferenceLib package lives next to the module folders
+_repositoryRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _repositoryRoot not in sys.path:
+    sys.path.append(_repositoryRoot)
+from InferenceLib import ContainerSpec, Headless, ResultStore, sharedResultCache
+from InferenceLib.BatchInference import BatchItem, createBatchJob, findDicomSeries
+from InferenceLib.DicomIndex import sharedDicomIndex
+from InferenceLib.DicomStaging import UID_TAGS, stageFiles
+from InferenceLib.InferenceJob import InferenceJob, Stage, sharedJobRunner
+from InferenceLib.InferenceScheduler import PRIORITY_BATCH, PRIORITY_URGENT, sharedInferenceScheduler
+from InferenceLib.ModelRegistry import INPUT_DICOM, ModelSpec, sharedModelRegistry
+from InferenceLib.ProbabilityOverlay import ProbabilityOverlay, hotSlices
+from InferenceLib.ResultCache import cacheKey, seriesIdentity
+from InferenceLib.ResultChannel import ResultChannel, execResultChannel
+from InferenceLib.SliceSync import SliceSync
+from InferenceLib.Timing import requestScope, span
+from InferenceLib.TimingPanel import TimingPanel
+
+# Seconds to wait for an inference result before reporting a failure
+RESULT_TIMEOUT = 600
+# Seconds to wait for the server to move the focus of a running stream (viewport mode)
+FOCUS_UPDATE_TIMEOUT = 5
+
+# CT series sent to pedetect_v1 in one call in batch mode
+PE_BATCH_SIZE = 4
+# Consolidated results of the batch runs
+PE_RESULT_STORE = r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\result\batch_results.sqlite"
+
+PE_CONTAINER_SPEC = ContainerSpec(
+    image="pedetect_v1",
+    serverPort=18081,
+    serverCommand="python /workfolder/InferenceServer.py --handler main:InferenceHandler --host 0.0.0.0 --port 8000",
+    volumes={
+        r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\input": {'bind': '/workfolder/input', 'mode': 'rw'},
+        r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\result": {'bind': '/workfolder/result', 'mode': 'rw'}
+    },
+)
+
+# 在共用的model registry登錄pedetect_v1, 由共用的scheduler與其他模型(例如chestyolov5)排程
+PE_MODEL = sharedModelRegistry().register(ModelSpec(
+    name="pedetect_v1",
+    container=PE_CONTAINER_SPEC,
+    inputFormats=[INPUT_DICOM],
+    inputFolder=r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\input",
+    resultFolder=r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\result",
+))
+
+# exam level結果的id與顯示該機率的標籤, 順序與模型輸出相同
+PE_EXAM_LABEL_WIDGETS = {
+    "negative_exam_for_pe": "label_9",
+    "indeterminate": "label_20",
+    "chronic_pe": "label_10",
+    "acute_and_chronic_pe": "label_11",
+    "central_pe": "label_12",
+    "leftsided_pe": "label_13",
+    "rightsided_pe": "label_14",
+    "rv_lv_ratio_gte_1": "label_15",
+    "rv_lv_ratio_lt_1": "label_16",
+}
 
 ### self-define functions ###
-def copy_dicom_files(source_folder, dest_folder_base):
-    # 遍历源文件夹中的所有 DICOM 文件
-    for root, _, files in os.walk(source_folder):
-        for file in files:
-            if file.endswith('.dcm'):
-                file_path = os.path.join(root, file)
-                
-                # 读取 DICOM 文件以获取 UID
-                ds = pydicom.dcmread(file_path)
-                
-                # 获取 Study Instance UID 和 Series Instance UID
-                study_instance_uid = ds.StudyInstanceUID
-                series_instance_uid = ds.SeriesInstanceUID
-                
-                # 创建目标文件夹路径
-                study_folder = os.path.join(dest_folder_base, study_instance_uid)
-                series_folder = os.path.join(study_folder, series_instance_uid)
-                
-                # 确保目标文件夹存在
-                if not os.path.exists(series_folder):
-                    os.makedirs(series_folder)
-                
-                # 构建目标文件路径
-                dest_file_path = os.path.join(series_folder, file)
-                
-                # 复制 DICOM 文件
-                shutil.copyfile(file_path, dest_file_path)
-                # print(f"Copied {file_path} to {dest_file_path}")
-
-def createUpdateLabelFunction(data, mainWindow):
+def list_files(path):
+    # path為檔案時只有該檔案, 為資料夾時包含所有子資料夾的檔案
+    if os.path.isfile(path):
+        return [path]
+    return [os.path.join(root, file) for root, _, files in os.walk(path) for file in sorted(files)]
+
+def find_dicom_series(*paths):
+    # 依 Series Instance UID 將資料夾(或檔案)內的DICOM檔分組, 只讀取header
+    series = {}
+    for path in paths:
+        for file_path in list_files(path):
+            try:
+                ds = pydicom.dcmread(file_path, stop_before_pixels=True,
+                                     specific_tags=UID_TAGS + ["Modality", "PatientID", "StudyDate"])
+            except (pydicom.errors.InvalidDicomError, OSError):
+                continue
+            if "SeriesInstanceUID" not in ds:
+                continue
+            entry = series.setdefault(ds.SeriesInstanceUID, {
+                "studyInstanceUID": str(ds.StudyInstanceUID),
+                "seriesInstanceUID": str(ds.SeriesInstanceUID),
+                "modality": str(ds.get("Modality", "")),
+                "patientID": str(ds.get("PatientID", "")),
+                "studyDate": str(ds.get("StudyDate", "")),
+                "instanceUIDs": [],
+                "files": [],
+            })
+            entry["instanceUIDs"].append(str(ds.SOPInstanceUID))
+            entry["files"].append(file_path)
+    return list(series.values())
+
+def build_slice_probabilities(data, instanceUIDs):
+    # 依 instanceUIDs 的順序建立每個切片的 pe_on_image 機率陣列, 沒有資料的切片為 NaN
+    probability_by_id = {item['id']: item['probability'] for item in data}
+    return np.array([probability_by_id.get(uid, np.nan) for uid in instanceUIDs], dtype=float)
+
+def order_pe_result(entries, instanceUIDs):
+    # 串流收到的結果依原本的格式排列: exam level的結果在前, 各切片的機率在後
+    instance_set = set(instanceUIDs)
+    return [entry for entry in entries if entry['id'] not in instance_set] + \
+        [entry for entry in entries if entry['id'] in instance_set]
+
+def slice_index_for_offset(volumeNode, sliceOffset):
+    # slice offset對應的切片index, 超出volume範圍時回傳None
+    imageData = volumeNode.GetImageData()
+    if not imageData:
+        return None
+    extent = imageData.GetExtent()
+    sliceIndex = int((sliceOffset - volumeNode.GetOrigin()[2]) / volumeNode.GetSpacing()[2])
+    if not extent[4] <= sliceIndex <= extent[5]:
+        return None
+    return sliceIndex
+
+def createUpdateLabelFunction(data, mainWindow, series=None, seriesVolumeNode=None, probabilities=None):
+    # 標籤元件與切片 logic 只查找一次, 每個 volume 的機率陣列也只建立一次 (可直接傳入已建立的陣列)
     pe_on_image_label = slicer.util.findChild(mainWindow, 'label_19')
+    sliceNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceNode()
+    sliceLogic = slicer.app.applicationLogic().GetSliceLogic(sliceNode)
+    probabilities_by_node = {}
+    if series is not None and seriesVolumeNode is not None:
+        if probabilities is None:
+            probabilities = build_slice_probabilities(data, series.instanceUIDs)
+        probabilities_by_node[seriesVolumeNode.GetID()] = probabilities
+    last_text = [None]
+
+    def setText(text):
+        if text != last_text[0]:
+            last_text[0] = text
+            pe_on_image_label.setText(text)
 
     def updateLabel(caller, event):
-        pe_on_image_label = slicer.util.findChild(mainWindow, 'label_19')
-        # 獲取當前顯示的切片節點
-        sliceNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceNode()
-        sliceLogic = slicer.app.applicationLogic().GetSliceLogic(sliceNode)
-        layerLogic = sliceLogic.GetBackgroundLayer()
-
         # 獲取當前切片的 volume 节點
-        SliceVolumeNode = layerLogic.GetVolumeNode()
-
-        # 獲取當前切片的 slice offset
-        sliceOffset = sliceNode.GetSliceOffset()
-
-        # 獲取對應於當前 slice offset 的 Instance UID
-        if SliceVolumeNode:
-            # 獲取 volume 的 image data
-            imageData = SliceVolumeNode.GetImageData()
-            if imageData:
-                # 獲取 slice index 對應於當前的 slice offset
-                extent = imageData.GetExtent()
-                spacing = SliceVolumeNode.GetSpacing()
-                origin = SliceVolumeNode.GetOrigin()
-                sliceIndex = int((sliceOffset - origin[2]) / spacing[2])
-
-                if extent[4] <= sliceIndex <= extent[5]:
-                    # 獲取 DICOM Instance UID
-                    instanceUIDs = SliceVolumeNode.GetAttribute('DICOM.instanceUIDs').split()
-                    target_instance_uid = instanceUIDs[sliceIndex]
-                    # print(f'Current slice Instance UID: {target_instance_uid}')
-
-                    # 查找並顯示相應的數值
-                    pe_on_image_prob = None
-                    for item in data:
-                        if item['id'] == target_instance_uid:
-                            pe_on_image_prob = item['probability']
-                            break
-
-                    if pe_on_image_prob is not None:
-                        pe_on_image_prob = f"{pe_on_image_prob:.4f}"
-                        pe_on_image_label.setText(pe_on_image_prob)
-                    else:
-                        pe_on_image_label.setText("No data available for current slice")
-                else:
-                    print('Slice index out of range')
-                    pe_on_image_label.setText("Slice index out of range")
-            else:
-                print('No image data available')
-                pe_on_image_label.setText("No image data available")
+        SliceVolumeNode = sliceLogic.GetBackgroundLayer().GetVolumeNode()
+        if not SliceVolumeNode:
+            setText("No volume node available")
+            return
+        # 獲取 volume 的 image data
+        if not SliceVolumeNode.GetImageData():
+            setText("No image data available")
+            return
+
+        # 獲取 slice index 對應於當前的 slice offset
+        sliceIndex = slice_index_for_offset(SliceVolumeNode, sliceNode.GetSliceOffset())
+        if sliceIndex is None:
+            setText("Slice index out of range")
+            return
+
+        # 以 slice index 直接查表, 不需掃描整個結果
+        probabilities = probabilities_by_node.get(SliceVolumeNode.GetID())
+        if probabilities is None:
+            instanceUIDs = (SliceVolumeNode.GetAttribute('DICOM.instanceUIDs') or '').split()
+            probabilities = probabilities_by_node[SliceVolumeNode.GetID()] = build_slice_probabilities(data, instanceUIDs)
+        pe_on_image_prob = probabilities[sliceIndex] if sliceIndex < len(probabilities) else np.nan
+        if np.isnan(pe_on_image_prob):
+            setText("No data available for current slice")
         else:
-            print('No volume node available')
-            pe_on_image_label.setText("No volume node available")
+            setText(f"{pe_on_image_prob:.4f}")
     return updateLabel
 #
 # PE_Detect
@@ -230,6 +307,17 @@ class PE_DetectWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic = None
         self._parameterNode = None
         self._parameterNodeGuiTag = None
+        self._inferenceJob = None
+        # 串流中已收到的部分結果
+        self._partialEntries = []
+        # 所有切片觀察者由同一個SliceSync管理, 每個view只有一個observer
+        self._sliceSync = SliceSync()
+        # 每個切片的pe_on_image機率以overlay volume與曲線圖呈現, 每次結果只建立一次
+        self.probabilityOverlay = ProbabilityOverlay("PE on image probability")
+        # 這次inference是否已顯示過曲線圖(已切換layout)
+        self._probabilityTrackShown = False
+        # 上一次結果的切片機率標籤更新函數, viewport模式串流期間仍繼續更新標籤
+        self._sliceLabelUpdater = None
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -240,6 +328,10 @@ class PE_DetectWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         uiWidget = slicer.util.loadUI(self.resourcePath("UI/PE_Detect.ui"))
         self.layout.addWidget(uiWidget)
         self.ui = slicer.util.childWidgetVariables(uiWidget)
+        self._setupHotSlices()
+        # 各階段耗時的統計與匯出, 預設收合
+        self.timingPanel = TimingPanel()
+        self.layout.addWidget(self.timingPanel.widget)
 
         # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
         # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
@@ -258,26 +350,67 @@ class PE_DetectWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # Buttons
         self.ui.inferencePushButton.connect("clicked(bool)", self.oninferencePushButton)
+        self.ui.cancelInferencePushButton.connect("clicked(bool)", self.oncancelInferencePushButton)
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
 
+    def _setupHotSlices(self) -> None:
+        '''機率最高的切片清單, 選擇後切換到該切片'''
+        collapsibleButton = ctk.ctkCollapsibleButton()
+        collapsibleButton.text = _("PE probability by slice")
+        layout = qt.QFormLayout(collapsibleButton)
+        self.hotSliceComboBox = qt.QComboBox()
+        self.hotSliceComboBox.toolTip = _("Slices with the highest PE on image probability, select one to jump to it")
+        self.hotSliceComboBox.connect("activated(int)", self.onHotSliceActivated)
+        layout.addRow(_("Hot slices:"), self.hotSliceComboBox)
+        self.showOverlayCheckBox = qt.QCheckBox()
+        self.showOverlayCheckBox.checked = True
+        self.showOverlayCheckBox.toolTip = _("Colour the slices by PE on image probability")
+        self.showOverlayCheckBox.connect("toggled(bool)", self.onShowOverlayToggled)
+        layout.addRow(_("Probability overlay:"), self.showOverlayCheckBox)
+        self.viewportFirstCheckBox = qt.QCheckBox()
+        self.viewportFirstCheckBox.checked = True
+        self.viewportFirstCheckBox.toolTip = _(
+            "Ask the model to process the slices around the Red view first, following the view while scrolling")
+        layout.addRow(_("Viewed slices first:"), self.viewportFirstCheckBox)
+        self.layout.addWidget(collapsibleButton)
+
+    def onHotSliceActivated(self, index) -> None:
+        sliceIndex = self.hotSliceComboBox.itemData(index)
+        if sliceIndex is not None:
+            self.probabilityOverlay.jumpToSlice(int(sliceIndex))
+
+    def onShowOverlayToggled(self, checked) -> None:
+        overlayNode = self.probabilityOverlay.overlayNode
+        if overlayNode is not None and overlayNode.GetDisplayNode() is not None:
+            overlayNode.GetDisplayNode().SetVisibility(checked)
+            for compositeNode in slicer.util.getNodesByClass("vtkMRMLSliceCompositeNode"):
+                if compositeNode.GetForegroundVolumeID() == overlayNode.GetID():
+                    compositeNode.SetForegroundOpacity(self.probabilityOverlay.opacity if checked else 0.0)
+
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        self._sliceSync.teardown()
+        if self._inferenceJob is not None:
+            self._inferenceJob.cancel()
+        # 共用的container pool由兩個模組使用, 在slicer結束時才停止, 模組關閉或reload時保持container運作
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
+        # 先恢復切片觀察, 參數節點初始化失敗時標籤仍會更新
+        self._sliceSync.start()
         # Make sure parameter node exists and observed
         self.initializeParameterNode()
 
     def exit(self) -> None:
         """Called each time the user opens a different module."""
+        self._sliceSync.stop()
         # Do not react to parameter node changes (GUI will be updated when the user enters into the module)
         if self._parameterNode:
             self._parameterNode.disconnectGui(self._parameterNodeGuiTag)
             self._parameterNodeGuiTag = None
-            self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self._checkCanApply)
 
     def onSceneStartClose(self, caller, event) -> None:
         """Called just before the scene is closed."""
@@ -311,109 +444,102 @@ class PE_DetectWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         if self._parameterNode:
             self._parameterNode.disconnectGui(self._parameterNodeGuiTag)
-            self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self._checkCanApply)
         self._parameterNode = inputParameterNode
         if self._parameterNode:
             # Note: in the .ui file, a Qt dynamic property called "SlicerParameterName" is set on each
             # ui element that needs connection.
+            # 沒有apply按鈕, 不需要觀察參數節點來更新按鈕狀態
             self._parameterNodeGuiTag = self._parameterNode.connectGui(self.ui)
-            self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self._checkCanApply)
-            self._checkCanApply()
-
-    # def _checkCanApply(self, caller=None, event=None) -> None:
-    #     if self._parameterNode and self._parameterNode.inputVolume and self._parameterNode.thresholdedVolume:
-    #         self.ui.applyButton.toolTip = _("Compute output volume")
-    #         self.ui.applyButton.enabled = True
-    #     else:
-    #         self.ui.applyButton.toolTip = _("Select input and output volume nodes")
-    #         self.ui.applyButton.enabled = False
 
     def oninferencePushButton(self) -> None:
-        '''創建docker container或重啟現有的container'''
-        # 創建 Docker 客戶端
-        client = docker.from_env()
-
-        # 定義容器參數
-        image = "pedetect_v1" # 指定映像檔名稱
-        container_name = image + "_container"  # 給定容器指定名字
-
-        # 獲取所有容器名稱
-        all_containers = client.containers.list(all=True)
-
-        # 搜尋名稱相同的容器
-        matching_containers = [container for container in all_containers if container_name in container.name]
-        if matching_containers:
-            print("Container already exists and will be reused.")
-            container = matching_containers[0]  # 重新啟用現有容器
-            if container.status != "running":
-                container.start()
-        else:
-            # 若容器不存在，則創建新容器
-            print(container_name + ' will be created.')
-            volumes = {
-                r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\input": {'bind': '/workfolder/input', 'mode': 'rw'},
-                r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\result": {'bind': '/workfolder/result', 'mode': 'rw'}
-            }
-            container = client.containers.run(image, detach=True, name=container_name, volumes=volumes, auto_remove=False, device_requests=[docker.types.DeviceRequest(device_ids=['0'], capabilities=[['gpu']])])
-
-        '''將slicer當前開啟的ct檔案複製到local資料夾'''
-        # 設定輸出資料夾路徑
-        exportDir = r"D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\input"
-
-        # 檢查資料夾是否存在
-        if not os.path.exists(exportDir):
-            print("no such directory")
+        if self._inferenceJob is not None:
+            print("Inference is already running.")
+            return
 
         # 獲取當前volume
         activeVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
-
-        # 獲取當前影像的上傳位置
-
-        # 确认节点存在
-        if activeVolumeNode:
-            # 使用 DICOM 数据库获取影像的 DICOM 文件路径
-            instanceUIDs = activeVolumeNode.GetAttribute("DICOM.instanceUIDs")
-            # print('instanceUIDs= ', instanceUIDs)
-            if instanceUIDs:
-                instanceUID = instanceUIDs.split()[0]
-                # print('instanceUID= ',instanceUID)
-                filePath = slicer.dicomDatabase.fileForInstance(instanceUID)
-                # print('filePath= ', filePath)
-                if filePath:
-                    # 读取 DICOM 文件中的 Study Instance UID 和 Series Instance UID
-                    study_instance_uid = slicer.dicomDatabase.fileValue(filePath, "0020,000D")
-                    series_instance_uid = slicer.dicomDatabase.fileValue(filePath, "0020,000E")
-                    # print('seriesInstanceUID= ',series_instance_uid)
-                    # print('studyInstanceUID= ',study_instance_uid)
-                    upload_dir = os.path.dirname(filePath)
-                    copy_dicom_files(upload_dir, exportDir)
-                    print('successfully loaded dicom files')
-
-                else:
-                    print("Could not retrieve the file path for the given instance UID.")
-            else:
-                print("Volume node does not have associated DICOM instance UIDs.")
-        else:
+        if not activeVolumeNode:
             print("No volume node found.")
-    
-        '''對container下指令''' # 大約花30秒
-        basename = study_instance_uid + "_" + series_instance_uid
-        # print(basename)
-        command = "python /workfolder/main.py --run-type inference --input " + basename
-        execute = container.exec_run(cmd=command)
-        # print(command)
-
-        '''讀取result的json檔'''
-        result_folder = r'D:\Jonathan\AI_on_3Dslicer\PE_detection\RSNA-STR-Pulmonary-Embolism-Detection-main\RSNA-STR-Pulmonary-Embolism-Detection-main\docker\result'
-        resultDir = os.path.join(result_folder, study_instance_uid + "_" + series_instance_uid + "_result.json")
-        print(resultDir)
-        if os.path.exists(resultDir):
-            with open(resultDir, 'r') as file:
-                data = json.load(file)
-                # print(data)
+            return
+
+        # 在背景執行inference (大約30秒), 執行期間slicer仍可操作
+        focusSlice = self._viewedSliceIndex(activeVolumeNode) if self.viewportFirstCheckBox.checked else None
+        job = self.logic.createInferenceJob(activeVolumeNode, focusSlice=focusSlice)
+        self._partialEntries = []
+        self._probabilityTrackShown = False
+        if focusSlice is not None:
+            # 串流期間捲動Red view時, 模型接著處理目前觀看切片附近的切片; 結果顯示後換回標籤的更新函數
+            self._sliceSync.setHandler("pe_on_image_prob",
+                                       lambda caller, event: self._followViewedSlice(job, activeVolumeNode, caller, event),
+                                       ["Red"])
+        self._inferenceJob = sharedJobRunner().submit(job, self.onInferenceProgress, self.onInferenceFinished,
+                                                      self.onPartialResult)
+        self.ui.inferencePushButton.enabled = False
+        self.ui.cancelInferencePushButton.enabled = True
+
+    def _viewedSliceIndex(self, volumeNode) -> Optional[int]:
+        '''Red view目前顯示的切片index, 與createUpdateLabelFunction相同的對應方式; 無法取得時為None (從中間開始)'''
+        layoutManager = slicer.app.layoutManager()
+        sliceWidget = layoutManager.sliceWidget("Red") if layoutManager else None
+        if sliceWidget is None:
+            return None
+        return slice_index_for_offset(volumeNode, sliceWidget.mrmlSliceNode().GetSliceOffset())
+
+    def _followViewedSlice(self, job, volumeNode, caller, event) -> None:
+        if self._sliceLabelUpdater is not None:
+            self._sliceLabelUpdater(caller, event)
+        sliceIndex = self._viewedSliceIndex(volumeNode)
+        if sliceIndex is not None and job is self._inferenceJob:
+            self.logic.setFocusSlice(job, sliceIndex)
+
+    def _restoreSliceLabelHandler(self) -> None:
+        if self._sliceLabelUpdater is not None:
+            self._sliceSync.setHandler("pe_on_image_prob", self._sliceLabelUpdater, ["Red"])
+        else:
+            self._sliceSync.removeHandler("pe_on_image_prob")
+
+    def oncancelInferencePushButton(self) -> None:
+        if self._inferenceJob is not None:
+            self._inferenceJob.cancel()
+
+    def onInferenceProgress(self, job, fraction, message) -> None:
+        self.ui.inferenceProgressBar.value = int(fraction * 100)
+        self.ui.inferenceProgressBar.format = f"{message} %p%"
+
+    def onPartialResult(self, job, partial) -> None:
+        '''串流中的部分結果: 先更新切片機率(overlay與熱點切片), exam level的結果到達時更新標籤'''
+        series, volumeNode = job.context.get("series"), job.context.get("volumeNode")
+        if series is None or volumeNode is None:
+            return
+        self._partialEntries.extend(partial)
+        instance_set = set(series.instanceUIDs)
+        if any(entry['id'] in instance_set for entry in partial):
+            probabilities = build_slice_probabilities(self._partialEntries, series.instanceUIDs)
+            self._showSliceProbabilities(volumeNode, probabilities)
+            received = int(np.count_nonzero(~np.isnan(probabilities)))
+            self.ui.inferenceProgressBar.format = _("Received {received}/{total} slices").format(
+                received=received, total=len(series.instanceUIDs)) + " %p%"
+        self._showExamProbabilities([entry for entry in partial if entry['id'] not in instance_set])
+
+    def onInferenceFinished(self, job) -> None:
+        self._inferenceJob = None
+        self.ui.inferencePushButton.enabled = True
+        self.ui.cancelInferencePushButton.enabled = False
+        if job.state == "done":
+            self.ui.inferenceProgressBar.value = 100
+            self.ui.inferenceProgressBar.format = _("Done")
+            with requestScope(job.requestId), span(f"{job.name}: Showing result"):
+                self._showResult(job.result, job.context["series"], job.context["volumeNode"])
+        elif job.state == "cancelled":
+            self._restoreSliceLabelHandler()
+            self.ui.inferenceProgressBar.format = _("Cancelled")
         else:
-            print("No such file or directory")
+            self._restoreSliceLabelHandler()
+            self.ui.inferenceProgressBar.format = _("Failed")
+            slicer.util.errorDisplay(f"Inference failed: {job.error}")
+        self.timingPanel.showRequest(job.requestId, job.name)
 
+    def _showResult(self, data, series=None, volumeNode=None) -> None:
         '''顯示fixed probability'''
         negative_exam_for_pe_prob = f"{data[0]['probability']:.4f}"
         indeterminate_prob = f"{data[1]['probability']:.4f}"
@@ -455,18 +581,38 @@ class PE_DetectWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
 
         '''處理pe_on_image_prob'''
+        # 機率陣列只建立一次, 同時用於overlay, 曲線圖, 熱點切片清單與標籤
+        probabilities = None
+        if series is not None and volumeNode is not None:
+            probabilities = build_slice_probabilities(data, series.instanceUIDs)
+            self._showSliceProbabilities(volumeNode, probabilities)
         # 創建帶參數的更新函數
-        updateLabelWithParams = createUpdateLabelFunction(data, mainWindow)
-        # 添加監聽器監控切片變化事件
-        sliceNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceNode()
-        observerTag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, updateLabelWithParams)
-        # # 在退出時移除監聽器
-        # def removeObserver():
-        #     sliceNode.GetSliceCompositeNode().RemoveObserver(observerTag)
-        # slicer.app.connect("aboutToQuit()", removeObserver)
-
-
-        
+        updateLabelWithParams = createUpdateLabelFunction(data, mainWindow, series, volumeNode, probabilities)
+        # 監控切片變化事件; 取代前一次inference的更新函數, 連續的事件合併成一次更新
+        self._sliceLabelUpdater = updateLabelWithParams
+        self._sliceSync.setHandler("pe_on_image_prob", updateLabelWithParams, ["Red"])
+        self._sliceSync.refresh(["Red"])
+
+    def _showExamProbabilities(self, entries) -> None:
+        '''依id更新exam level結果的標籤, 串流時只有部分結果'''
+        mainWindow = slicer.util.mainWindow()
+        for entry in entries:
+            labelName = PE_EXAM_LABEL_WIDGETS.get(entry['id'])
+            if labelName is not None:
+                slicer.util.findChild(mainWindow, labelName).setText(f"{entry['probability']:.4f}")
+
+    def _showSliceProbabilities(self, volumeNode, probabilities) -> None:
+        '''以overlay volume與曲線圖顯示每個切片的機率, 並列出機率最高的切片'''
+        # 每次inference只在第一次顯示時切換layout, 之後的部分結果與最終結果直接更新overlay與曲線圖的數值
+        if not (self._probabilityTrackShown and self.probabilityOverlay.update(volumeNode, probabilities)):
+            self.probabilityOverlay.show(volumeNode, probabilities, switchLayout=not self._probabilityTrackShown)
+            self._probabilityTrackShown = True
+            self.onShowOverlayToggled(self.showOverlayCheckBox.checked)
+        self.hotSliceComboBox.clear()
+        for sliceIndex, probability in hotSlices(probabilities):
+            self.hotSliceComboBox.addItem(f"Slice {sliceIndex}: {probability:.4f}", sliceIndex)
+        if self.hotSliceComboBox.count == 0:
+            self.hotSliceComboBox.addItem(_("No slice above 0.5"))
 
 
 #
@@ -487,10 +633,224 @@ class PE_DetectLogic(ScriptedLoadableModuleLogic):
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
+        # 已經inference過的series直接從cache讀取結果, 不需再等30秒
+        self.resultCache = sharedResultCache(os.path.join(slicer.app.cachePath, "InferenceResultCache.sqlite"))
 
     def getParameterNode(self):
         return PE_DetectParameterNode(super().getParameterNode())
 
+    def createInferenceJob(self, volumeNode: vtkMRMLScalarVolumeNode, priority: int = PRIORITY_URGENT,
+                           focusSlice: Optional[int] = None) -> InferenceJob:
+        """
+        Create the job that copies the DICOM series of `volumeNode` to the input folder and runs pedetect_v1.
+        The job result is the list of exam level and per-instance probabilities.
+        Series that were already processed with the same model version are not run again.
+        A suspected PE is urgent: by default the job gets the GPU before queued batches of any model.
+        :param focusSlice: viewport mode, the streamed request asks the server to process the slices around this
+          slice index first, and `setFocusSlice` moves the focus while the stream runs. Models that do not
+          support it stream in series order. The exam level labels come last. Needs the inference server,
+          exec_run scores the whole series at once.
+        """
+        context = {"volumeNode": volumeNode, "priority": priority}
+        if focusSlice is not None:
+            context["focusSlice"] = focusSlice
+            context["streamId"] = secrets.token_hex(8)
+        return InferenceJob("pedetect_v1 inference", [
+            Stage(_("Reading DICOM information"), self._readDicomInformation, mainThread=True),
+            Stage(_("Checking result cache"), self._checkResultCache),
+            Stage(_("Copying DICOM files"), self._copyDicomFiles, weight=2.0),
+            Stage(_("Starting container"), self._acquireContainer),
+            Stage(_("Running inference"), self._runInference, weight=10.0),
+        ], context)
+
+    def seriesCacheKey(self, studyInstanceUID: str, seriesInstanceUID: str, instanceCount: int) -> str:
+        """Result cache key of a DICOM series."""
+        identity = seriesIdentity(studyInstanceUID, seriesInstanceUID, instanceCount)
+        return cacheKey(PE_MODEL.name, PE_MODEL.modelVersion, identity)
+
+    def _checkResultCache(self, job, context):
+        series = context["series"]
+        context["cacheKey"] = self.seriesCacheKey(series.studyInstanceUID, series.seriesInstanceUID,
+                                                  len(series.instanceUIDs))
+        data = self.resultCache.get(context["cacheKey"])
+        if data is not None:
+            logging.info("pedetect_v1 result found in the result cache")
+            context["result"] = data
+            context["cached"] = True
+
+    def _acquireContainer(self, job, context):
+        '''由共用的scheduler依優先順序取得GPU與已啟動的container, DICOM檔複製完才取得, 不佔用GPU'''
+        if context.get("cached"):
+            return
+        lease = sharedInferenceScheduler().leaseForJob(job, PE_MODEL.name, context["priority"])
+        context["container"] = lease.container
+        context["serverClient"] = lease.serverClient
+
+    def _readDicomInformation(self, job, context):
+        # 從DICOM database的tag cache取得series的UID, 檔案路徑與切片位置, 每個series只讀取一次
+        context["series"] = sharedDicomIndex().seriesForVolume(context["volumeNode"])
+
+    def _copyDicomFiles(self, job, context):
+        '''將slicer當前開啟的ct檔案複製到local資料夾'''
+        if context.get("cached"):
+            return
+        # 設定輸出資料夾路徑
+        exportDir = PE_MODEL.inputFolder
+
+        # 檢查資料夾是否存在
+        if not os.path.exists(exportDir):
+            print("no such directory")
+
+        # 只複製這個series自己的instance檔案
+        series = context["series"]
+        series_folder = os.path.join(exportDir, series.studyInstanceUID, series.seriesInstanceUID)
+        stageFiles(series.files, series_folder, onProgress=lambda done, total: job.reportProgress(done / total))
+        print('successfully loaded dicom files')
+
+    def _runInference(self, job, context):
+        '''對container下指令''' # 大約花30秒
+        if context.get("cached"):
+            return
+        series = context["series"]
+        basename = series.basename
+        serverClient = context["serverClient"]
+        if serverClient is not None:
+            # 常駐的inference server已載入模型, 不需每次重新載入權重; 結果以串流方式逐步送回
+            # viewport模式多傳focusSlice與streamId, 模型先處理目前觀看切片附近的切片, 捲動時由setFocusSlice更新
+            request = {"input": basename, "instanceUIDs": series.instanceUIDs}
+            if context.get("focusSlice") is not None:
+                request["focusSlice"] = context["focusSlice"]
+                request["streamId"] = context["streamId"]
+            channel = ResultChannel.run(self._streamInference, job, serverClient, request,
+                                        timeout=RESULT_TIMEOUT, description="pedetect_v1 inference")
+        else:
+            channel = self._runInferenceCommand(context["container"], basename)
+        context["result"] = job.waitFor(channel.future)
+        self.resultCache.put(context["cacheKey"], context["result"])
+
+    def setFocusSlice(self, job, sliceIndex: int) -> None:
+        '''viewport模式: 使用者捲動到其他切片時, 讓執行中的串流接著處理該切片附近的切片 (在背景送出, 不阻塞主執行緒)'''
+        context = job.context
+        if "streamId" not in context or context.get("focusSlice") == sliceIndex:
+            return
+        context["focusSlice"] = sliceIndex
+        serverClient = context.get("serverClient")
+        if serverClient is not None:
+            ResultChannel.run(serverClient.setStreamFocus, PE_MODEL.name, context["streamId"], sliceIndex,
+                              FOCUS_UPDATE_TIMEOUT, description="pedetect_v1 stream focus")
+
+    def _streamInference(self, job, serverClient, request):
+        '''先收到各切片的機率, 最後才是exam level的結果; 每收到一部分就以partial result通知widget'''
+        entries = []
+        for partial in serverClient.inferStream(PE_MODEL.name, request):
+            job.checkCancelled()
+            entries.extend(partial)
+            job.reportPartialResult(partial)
+        return order_pe_result(entries, request["instanceUIDs"])
+
+    def batchItemsFromVolumes(self, volumeNodes) -> list:
+        """Batch inputs for DICOM volumes already loaded in the scene."""
+        return [self._batchItem(sharedDicomIndex().seriesForVolume(node).toDict()) for node in volumeNodes]
+
+    def batchItemsFromFolder(self, folder: str) -> list:
+        """Batch inputs for all DICOM series found in `folder` and its sub folders."""
+        return [self._batchItem(series) for series in find_dicom_series(folder)]
+
+    def batchItemsFromPaths(self, paths) -> list:
+        """Batch inputs for the DICOM series of files and folders, files of one series may be spread over several paths."""
+        return [self._batchItem(series) for series in find_dicom_series(*paths)]
+
+    def batchItemsFromSeriesUIDs(self, seriesInstanceUIDs) -> list:
+        """Batch inputs for series of the Slicer DICOM database."""
+        index = sharedDicomIndex()
+        return [self._batchItem(index.seriesForSeriesUID(uid).toDict()) for uid in seriesInstanceUIDs]
+
+    def batchItemsFromDicomDatabase(self, modalities=("CT",), studyDate=None, patientID=None) -> list:
+        """Batch inputs for the series of the Slicer DICOM database matching the query, e.g. a day's worklist."""
+        index = sharedDicomIndex()
+        return [self._batchItem(index.seriesForSeriesUID(series["seriesInstanceUID"]).toDict())
+                for series in findDicomSeries(slicer.dicomDatabase, list(modalities), studyDate, patientID)]
+
+    def _batchItem(self, series: dict) -> BatchItem:
+        basename = series["studyInstanceUID"] + "_" + series["seriesInstanceUID"]
+        metadata = {key: value for key, value in series.items() if key not in ("files", "instanceUIDs")}
+        return BatchItem(key=basename, source=series, metadata=metadata)
+
+    def createBatchJob(self, inputs, resultStorePath: Optional[str] = None, batchSize: int = PE_BATCH_SIZE,
+                       skipExisting: bool = True, priority: int = PRIORITY_BATCH, workers: int = 1) -> InferenceJob:
+        """
+        Create the job that runs pedetect_v1 on many CT series and writes the probabilities to a result store.
+        :param inputs: DICOM folder path, or list of BatchItem or volume nodes
+        :param batchSize: series sent to the model in one call
+        :param skipExisting: do not run series that already have a result in the store
+        :param priority: scheduler priority of every batch, interactive jobs run between two batches
+        :param workers: batches run at the same time, each in its own container on the GPUs of the model
+        The job result is a summary {"done": n, "failed": n, "skipped": n, "store": path}.
+        """
+        if isinstance(inputs, str):
+            items = self.batchItemsFromFolder(inputs)
+        else:
+            items = [value if isinstance(value, BatchItem) else self.batchItemsFromVolumes([value])[0] for value in inputs]
+        if workers > 1:
+            sharedInferenceScheduler().allowConcurrentRuns(PE_MODEL.name, workers)
+        store = ResultStore(resultStorePath or PE_RESULT_STORE)
+        job = createBatchJob("pedetect_v1 batch inference", PE_MODEL.name, items, store, batchSize,
+                             self._prepareBatch, self._inferBatch, skipExisting=skipExisting, cache=self.resultCache,
+                             transfer=self._stageBatch, transferWorkers=max(2, workers), inferWorkers=workers)
+        job.context["priority"] = priority
+        job.addCleanup(store.close)
+        return job
+
+    def _prepareBatch(self, job, context, batch):
+        for item in batch:
+            series = item.source
+            item.cacheKey = self.seriesCacheKey(series["studyInstanceUID"], series["seriesInstanceUID"], len(series["files"]))
+            item.result = self.resultCache.get(item.cacheKey)
+            if item.result is not None:
+                item.cached = True
+                continue
+            item.request = {"input": item.key}
+            if item.source.get("instanceUIDs"):
+                item.request["instanceUIDs"] = item.source["instanceUIDs"]
+
+    def _stageBatch(self, job, context, batch):
+        '''在背景複製batch的DICOM檔, 與前一個batch的inference同時進行'''
+        exportDir = PE_MODEL.inputFolder
+        for item in batch:
+            job.checkCancelled()
+            try:
+                stageFiles(item.source["files"], os.path.join(
+                    exportDir, item.source["studyInstanceUID"], item.source["seriesInstanceUID"]))
+            except OSError as e:
+                item.error = f"Copying the DICOM files failed: {e}"
+
+    def _inferBatch(self, job, context, batch):
+        '''一次送出整個batch; 沒有inference server時逐一以exec_run執行; 每個batch個別排程, 讓急件可以插隊'''
+        with sharedInferenceScheduler().lease(PE_MODEL.name, context["priority"], cancelled=lambda: job.cancelled) as lease:
+            self._inferLeasedBatch(job, lease, batch)
+
+    def _inferLeasedBatch(self, job, lease, batch):
+        serverClient = lease.serverClient
+        if serverClient is None:
+            for item in batch:
+                channel = self._runInferenceCommand(lease.container, item.key)
+                item.result = job.waitFor(channel.future)
+            return
+        if batch:
+            channel = ResultChannel.run(serverClient.inferBatch, PE_MODEL.name, [item.request for item in batch],
+                                        timeout=RESULT_TIMEOUT * len(batch), description="pedetect_v1 batch inference")
+            for item, result in zip(batch, job.waitFor(channel.future)):
+                item.result = result
+
+    def _runInferenceCommand(self, container, basename):
+        '''沒有inference server時, 以exec_run執行main.py, 結果的json檔出現時立即通知'''
+        command = "python /workfolder/main.py --run-type inference --input " + basename
+
+        result_folder = PE_MODEL.resultFolder
+        resultDir = os.path.join(result_folder, basename + "_result.json")
+        print(resultDir)
+        return execResultChannel(container, command, resultDir, timeout=RESULT_TIMEOUT)
+
     def process(self,
                 inputVolume: vtkMRMLScalarVolumeNode,
                 outputVolume: vtkMRMLScalarVolumeNode,
@@ -597,3 +957,28 @@ class PE_DetectTest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
         self.delayDisplay("Test passed")
+
+
+#
+# Command line
+#
+
+
+def main(argv=None) -> int:
+    '''
+    不開啟GUI執行batch inference, 結果寫入JSON檔, 例如:
+    Slicer --no-main-window --python-script PE_Detect/PE_Detect.py --study-date 20240131 --output results.json
+    '''
+    parser = Headless.argumentParser("Run pedetect_v1 on CT series without the Slicer GUI.", PE_BATCH_SIZE, ("CT",))
+    args = parser.parse_args(argv)
+    logic = PE_DetectLogic()
+    items = Headless.collectBatchItems(logic, args)
+    if not items:
+        parser.error("no input found, use --input, --series-uid or a DICOM database query")
+    job = logic.createBatchJob(items, resultStorePath=args.store, batchSize=args.batch_size,
+                               skipExisting=not args.rerun, priority=args.priority, workers=args.workers)
+    return Headless.runBatchJob(job, PE_MODEL.name, items, args.output)
+
+
+if __name__ == "__main__":
+    slicer.util.exit(main(sys.argv[1:]))
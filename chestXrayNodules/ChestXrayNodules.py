@@ -2,6 +2,7 @@ import logging
 import os
 from typing import Annotated, Optional
 
+import qt
 import vtk
 
 import slicer
@@ -26,6 +27,69 @@ import vtk
 from vtk.util import numpy_support
 import time
 import json
+import sys
+
+# The shared InferenceLib package lives next to the module folders
+_repositoryRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _repositoryRoot not in sys.path:
+    sys.path.append(_repositoryRoot)
+from InferenceLib import ContainerSpec, ResultStore, sharedResultCache
+from InferenceLib.BatchInference import BatchItem, createBatchJob, findDicomSeries
+from InferenceLib import ChunkedExport
+from InferenceLib import DetectionGeometry, Headless
+from InferenceLib.DetectionOverlay import DetectionOverlay
+from InferenceLib.DetectionRegistry import DetectionRegistry
+from InferenceLib.InferenceJob import InferenceJob, Stage, sharedJobRunner
+from InferenceLib.InferenceScheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, sharedInferenceScheduler
+from InferenceLib.ModelRegistry import INPUT_ARRAY, INPUT_NRRD, INPUT_SHARED_MEMORY, ModelSpec, sharedModelRegistry
+from InferenceLib.ResultCache import cacheKey, hashVolume
+from InferenceLib.ResultChannel import ResultChannel, execResultChannel
+from InferenceLib.SharedMemoryTransfer import SharedArray, sharedSegmentPool
+from InferenceLib.Timing import span
+from InferenceLib.TimingPanel import TimingPanel
+from InferenceLib.VolumeTransfer import TransferStats
+
+# Seconds to wait for an inference result before reporting a failure
+RESULT_TIMEOUT = 300
+
+# INPUT_ARRAY sends the voxels directly to the inference server, INPUT_NRRD exports them to the shared folder,
+# INPUT_SHARED_MEMORY hands them to a server on the same machine in shared memory (container with ipcMode="host")
+VOLUME_TRANSFER_MODE = INPUT_ARRAY
+# None or "zlib"
+VOLUME_TRANSFER_COMPRESSION = None
+# Volumes larger than this are written to the shared folder slab by slab within the shared memory budget
+# (ChunkedExport), instead of being copied for the array transfer or saved with saveNode
+CHUNKED_EXPORT_MIN_BYTES = 256 * 1024 * 1024
+
+# All detections down to this confidence are requested once, the confidence slider only filters them
+CONFIDENCE_FLOOR = 0.05
+
+# Images sent to chestyolov5 in one call in batch mode
+CHEST_BATCH_SIZE = 16
+CHEST_IMAGE_EXTENSIONS = (".nrrd", ".nhdr", ".nii", ".nii.gz", ".mha", ".mhd", ".png", ".jpg", ".jpeg", ".dcm")
+# Consolidated results of the batch runs
+CHEST_RESULT_STORE = r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\result\batch_results.sqlite"
+
+CHEST_CONTAINER_SPEC = ContainerSpec(
+    image="chestyolov5",
+    serverPort=18080,
+    serverCommand="python /workfolder/InferenceServer.py --handler main:InferenceHandler --host 0.0.0.0 --port 8000",
+    volumes={
+        r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\nrrd": {'bind': '/workfolder/nrrd', 'mode': 'rw'},
+        r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\png": {'bind': '/workfolder/png', 'mode': 'rw'},
+        r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\result": {'bind': '/workfolder/result', 'mode': 'rw'}
+    },
+)
+
+# 在共用的model registry登錄chestyolov5, 由共用的scheduler與其他模型(例如pedetect_v1)排程
+CHEST_MODEL = sharedModelRegistry().register(ModelSpec(
+    name="chestyolov5",
+    container=CHEST_CONTAINER_SPEC,
+    inputFormats=[INPUT_ARRAY, INPUT_SHARED_MEMORY, INPUT_NRRD],
+    inputFolder=r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\nrrd",
+    resultFolder=r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\result",
+))
+
 #
 # ChestXrayNodules
 #
@@ -124,6 +188,7 @@ class ChestXrayNodulesParameterNode:
     invertThreshold - If true, will invert the threshold.
     thresholdedVolume - The output volume that will contain the thresholded volume.
     invertedVolume - The output volume that will contain the inverted thresholded volume.
+    detectionRegistry - JSON of the DetectionRegistry: detection runs, their model nodes and box states.
     """
 
     inputVolume: vtkMRMLScalarVolumeNode
@@ -131,6 +196,7 @@ class ChestXrayNodulesParameterNode:
     invertThreshold: bool = False
     thresholdedVolume: vtkMRMLScalarVolumeNode
     invertedVolume: vtkMRMLScalarVolumeNode
+    detectionRegistry: str = ""
 
 
 #
@@ -151,6 +217,7 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._parameterNode = None
         self._parameterNodeGuiTag = None
         self.confidence_score = None
+        self._inferenceJob = None
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -161,6 +228,9 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         uiWidget = slicer.util.loadUI(self.resourcePath("UI/ChestXrayNodules.ui"))
         self.layout.addWidget(uiWidget)
         self.ui = slicer.util.childWidgetVariables(uiWidget)
+        # 各階段耗時的統計與匯出, 預設收合
+        self.timingPanel = TimingPanel()
+        self.layout.addWidget(self.timingPanel.widget)
 
         # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
         # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
@@ -179,11 +249,14 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # Buttons
         self.ui.InferencePushButton.connect('clicked(bool)', self.onInferencePushButton) # inference push button
+        self.ui.CancelInferencePushButton.connect('clicked(bool)', self.onCancelInferencePushButton) # cancel inference push button
         self.ui.HomePagePushButton.connect('clicked(bool)', self.onHomePagePushButton) # home page push button
         self.ui.ClearBbxPushButton.connect('clicked(bool)', self.onClearBbxPushButton) # clear bounding box push button
         # slider
         confidenceScoreSlider = self.ui.ConfidenceScoreSlider  # 根据你的objectName获取滑动条
         confidenceScoreSlider.connect('valueChanged(double)', self.onConfidenceScoreSliderValueChanged)
+        self.confidence_score = confidenceScoreSlider.value
+        self.logic.displayConfidence = confidenceScoreSlider.value
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
@@ -191,6 +264,9 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        if self._inferenceJob is not None:
+            self._inferenceJob.cancel()
+        # 共用的container pool由兩個模組使用, 在slicer結束時才停止, 模組關閉或reload時保持container運作
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
@@ -222,6 +298,7 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # so that when the scene is saved and reloaded, these settings are restored.
 
         self.setParameterNode(self.logic.getParameterNode())
+        self.logic.loadDetectionRegistry()
 
         # Select default input nodes if nothing is selected yet to save a few clicks for the user
         if not self._parameterNode.inputVolume:
@@ -250,141 +327,58 @@ class ChestXrayNodulesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # confidence slider
     def onConfidenceScoreSliderValueChanged(self, value):
         self.confidence_score = value
+        # 只在本地重新篩選已顯示的box, 不需重新inference; 執行中的inference完成時也以此值篩選
+        self.logic.displayConfidence = value
+        self.logic.detectionRegistry.filterByConfidence(value)
 
     # inference button
     def onInferencePushButton(self):
-        # 創建 Docker 客戶端
-        client = docker.from_env()
-
-        # 定義容器參數
-        image = "chestyolov5" # 指定映像檔名稱
-        container_name = image + "_container"  # 給定容器指定名字
-
-        # 獲取所有容器名稱
-        all_containers = client.containers.list(all=True)
-
-        # 搜尋名稱相同的容器
-        matching_containers = [container for container in all_containers if container_name in container.name]
-        if matching_containers:
-            print("Container already exists and will be reused.")
-            container = matching_containers[0]  # 重新啟用現有容器
-            if container.status != "running":
-                container.start()
-        else:
-            # 若容器不存在，則串建新容器
-            volumes = {
-                r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\nrrd": {'bind': '/workfolder/nrrd', 'mode': 'rw'},
-                r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\png": {'bind': '/workfolder/png', 'mode': 'rw'},
-                r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\result": {'bind': '/workfolder/result', 'mode': 'rw'}
-            }
-            container = client.containers.run(image, detach=True, name=container_name, volumes=volumes, auto_remove=False, device_requests=[docker.types.DeviceRequest(device_ids=['0'], capabilities=[['gpu']])])
-
-        '''將slicer當前開啟的dcm檔案複製到local資料夾'''
-        # 設定輸出資料夾路徑
-        exportDir = r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\nrrd"
-
-        # 檢查資料夾是否存在
-        if not os.path.exists(exportDir):
-            print("no such directory")
+        if self._inferenceJob is not None:
+            print("Inference is already running.")
+            return
 
         # 獲取當前volume
         activeVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
-        if activeVolumeNode is not None:
-            # 生成隨機五位數字
-            randomFileName = f"{random.randint(10000, 99999)}"
-            
-            # 使用隨機五位數字作為檔案名稱
-            exportFilePath = os.path.join(exportDir, f"{randomFileName}.nrrd")
-            
-            # 將當前volume保存至nrrd資料夾
-            result = slicer.util.saveNode(activeVolumeNode, exportFilePath)
-            if result:
-                print(f"Volume exported to {exportFilePath}")
-            else:
-                print("Failed to export volume.")
-        else:
+        if activeVolumeNode is None:
             print("No active volume node found.")
-
-        '''對container下指令'''
-        basename = randomFileName + '.nrrd'
-        command = "python /workfolder/main.py --run-type inference --input " + basename + ' --confidence ' + str(self.confidence_score)
-        execute = container.exec_run(cmd=command)
-
-        '''抓到result的json檔案，並呈現在3d slicer'''
-        ResultFolderPath = r"D:\Jonathan\AI_on_3Dslicer\Chest_YOLO_v4\chestxray\docker\result"
-        result_name = basename + '_result.json'
-        jsonPath = os.path.join(ResultFolderPath, result_name)
-
-        imageNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLScalarVolumeNode')
-        imageToRAS = vtk.vtkMatrix4x4()
-        imageNode.GetIJKToRASMatrix(imageToRAS)
-
-        def create_line_node(start_point, end_point, index):
-            lineNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsLineNode', f"{index}")
-            lineNode.AddControlPointWorld(vtk.vtkVector3d(start_point))
-            lineNode.AddControlPointWorld(vtk.vtkVector3d(end_point))
-            displayNode = lineNode.GetDisplayNode()
-            if displayNode:
-                displayNode.SetColor(1.0, 0.0, 0.0)  # 红色
-                displayNode.SetLineWidth(4)
-
-        ### 等待運算結果出現 ###
-        while not os.path.exists(jsonPath):
-            time.sleep(1)
-
-        ### 抓取json檔案，並成現在slicer ###
-        if os.path.exists(jsonPath):
-            # 讀取json檔案
-            with open(jsonPath, 'r') as f:
-                data = json.load(f)
-
-            # 獲得當前紅色視窗node名稱
-            compositeNode = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode()
-            volumeNodeID = compositeNode.GetBackgroundVolumeID()
-            volumeNode = slicer.mrmlScene.GetNodeByID(volumeNodeID)
-            if volumeNode is not None:
-                nodeName = volumeNode.GetName()
-                print("當前圖像節點名稱: ", nodeName)
-            else:
-                print("沒有圖現節點被選中")
-                
-            bounding_boxes = data['bounding_boxes']
-            
-            for index, bbox in enumerate(bounding_boxes):
-                # 计算矩形的四个角点并进行坐标转换
-                corners = [
-                    (bbox['left'], bbox['bottom']), # 左下
-                    (bbox['left'], bbox['top']),    # 左上
-                    (bbox['right'], bbox['top']),   # 右上
-                    (bbox['right'], bbox['bottom']) # 右下
-                ]
-                ras_corners = []
-                for corner in corners:
-                    ijk = [corner[0], corner[1], 0, 1]  # 假设Z坐标为0，添加1以适应齐次坐标
-                    ras = imageToRAS.MultiplyPoint(ijk)[:3]  # 转换坐标并去除齐次坐标的部分
-                    ras_corners.append(ras)
-                
-                # 创建四个线段
-                create_line_node(ras_corners[0], ras_corners[1], index) # bottom_left_to_top_left
-                create_line_node(ras_corners[1], ras_corners[2], index) # top_left_to_top_right
-                create_line_node(ras_corners[2], ras_corners[3], index) # top_right_to_bottom_right
-                create_line_node(ras_corners[3], ras_corners[0], index) # bottom_right_to_bottom_left
+            return
+
+        # 在背景執行inference, 執行期間slicer仍可操作
+        job = self.logic.createInferenceJob(activeVolumeNode, self.confidence_score)
+        self._inferenceJob = sharedJobRunner().submit(job, self.onInferenceProgress, self.onInferenceFinished)
+        self.ui.InferencePushButton.enabled = False
+        self.ui.CancelInferencePushButton.enabled = True
+
+    # cancel inference button
+    def onCancelInferencePushButton(self):
+        if self._inferenceJob is not None:
+            self._inferenceJob.cancel()
+
+    def onInferenceProgress(self, job, fraction, message):
+        self.ui.InferenceProgressBar.value = int(fraction * 100)
+        self.ui.InferenceProgressBar.format = f"{message} %p%"
+
+    def onInferenceFinished(self, job):
+        self._inferenceJob = None
+        self.ui.InferencePushButton.enabled = True
+        self.ui.CancelInferencePushButton.enabled = False
+        if job.state == "done":
+            self.ui.InferenceProgressBar.value = 100
+            self.ui.InferenceProgressBar.format = _("Done")
+        elif job.state == "cancelled":
+            self.ui.InferenceProgressBar.format = _("Cancelled")
         else:
-            print(f"File does not exist: {jsonPath}")
+            self.ui.InferenceProgressBar.format = _("Failed")
+            slicer.util.errorDisplay(f"Inference failed: {job.error}")
+        self.timingPanel.showRequest(job.requestId, job.name)
 
-        container.stop()
-        print("container is stopped")
-        
     # clear bounding box
     def onClearBbxPushButton(self):
         bbxNumber = self.ui.BbxNumberSpinBox.value  # 獲取spin box 的值
-        # 建立搜尋關鍵字"Line_{bbxNumber}_"
-        searchKeyword = f"{bbxNumber}"
-        # 查找並刪除符合關鍵字之項目
-        allLineNodes = slicer.util.getNodesByClass('vtkMRMLMarkupsLineNode')
-        for lineNode in allLineNodes:
-            if searchKeyword in lineNode.GetName():
-                slicer.mrmlScene.RemoveNode(lineNode) # 刪除node
+        # 清除每次inference中編號恰好為bbxNumber的box
+        registry = self.logic.detectionRegistry
+        for runId in registry.runIds():
+            registry.clearBox(runId, bbxNumber)
 
     # back to home page button
     def onHomePagePushButton(self):
@@ -407,10 +401,394 @@ class ChestXrayNodulesLogic(ScriptedLoadableModuleLogic):
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
+        # 相同影像, 模型版本與confidence的結果直接從cache讀取, 不重新inference
+        self.resultCache = sharedResultCache(os.path.join(slicer.app.cachePath, "InferenceResultCache.sqlite"))
+        self.detectionOverlay = DetectionOverlay("ChestXrayNodules detections")
+        # run/box -> model node, 保存在parameter node中, 清除與隱藏box不需搜尋整個scene
+        self.detectionRegistry = DetectionRegistry(self.detectionOverlay, onChanged=self._scheduleRegistrySave)
+        self._registrySavePending = False
+        # 目前顯示box的最低confidence, 由widget的slider更新; None時使用建立job時的confidence
+        self.displayConfidence = None
 
     def getParameterNode(self):
         return ChestXrayNodulesParameterNode(super().getParameterNode())
 
+    def loadDetectionRegistry(self) -> None:
+        """Restore the detection registry from the parameter node, e.g. after loading a scene."""
+        self.detectionRegistry.loadJson(self.getParameterNode().detectionRegistry)
+
+    def _scheduleRegistrySave(self, registry) -> None:
+        # 同一個事件中的多次修改只寫入parameter node一次
+        if not self._registrySavePending:
+            self._registrySavePending = True
+            qt.QTimer.singleShot(0, self._saveDetectionRegistry)
+
+    def _saveDetectionRegistry(self) -> None:
+        self._registrySavePending = False
+        self.getParameterNode().detectionRegistry = self.detectionRegistry.toJson()
+
+    def createInferenceJob(self, volumeNode: vtkMRMLScalarVolumeNode, confidence: float,
+                           priority: int = PRIORITY_INTERACTIVE) -> InferenceJob:
+        """
+        Create the job that exports `volumeNode`, runs chestyolov5 in its container and draws the detected
+        bounding boxes. Submit it to a JobRunner, or call `runSynchronously` when there is no event loop.
+        All detections down to CONFIDENCE_FLOOR are requested and cached, `confidence` only selects the boxes
+        that are shown, so it can be changed afterwards without running the model again. When
+        `displayConfidence` is set (by the confidence slider), the boxes are filtered with its value at the
+        time they are drawn instead.
+        Images that were already processed with the same model version are not run again.
+        `priority` orders the job against the other jobs waiting for the GPU in the shared scheduler.
+        """
+        context = {"volumeNode": volumeNode, "confidence": confidence, "priority": priority}
+        return InferenceJob("chestyolov5 inference", [
+            Stage(_("Checking result cache"), self._checkResultCache, mainThread=True),
+            Stage(_("Starting container"), self._acquireContainer),
+            Stage(_("Exporting volume"), self._exportVolume, mainThread=True),
+            Stage(_("Running inference"), self._runInference, weight=5.0),
+            Stage(_("Drawing bounding boxes"), self._showDetections, mainThread=True),
+        ], context)
+
+    def imageCacheKey(self, volumeNode: vtkMRMLScalarVolumeNode) -> str:
+        """Result cache key of `volumeNode`, from a hash of its voxels and geometry."""
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        identity = hashVolume(slicer.util.arrayFromVolume(volumeNode), slicer.util.arrayFromVTKMatrix(ijkToRas))
+        return cacheKey(CHEST_MODEL.name, CHEST_MODEL.modelVersion, identity,
+                        {"confidence": CONFIDENCE_FLOOR})
+
+    def _checkResultCache(self, job, context):
+        context["cacheKey"] = self.imageCacheKey(context["volumeNode"])
+        data = self.resultCache.get(context["cacheKey"])
+        if data is not None:
+            logging.info("chestyolov5 result found in the result cache")
+            context["result"] = data
+            context["cached"] = True
+
+    def _acquireContainer(self, job, context):
+        if context.get("cached"):
+            return
+        # 由共用的scheduler依優先順序分配GPU與已啟動的容器, 避免每次點擊都重新啟動/停止容器
+        lease = sharedInferenceScheduler().leaseForJob(job, CHEST_MODEL.name, context["priority"])
+        context["container"] = lease.container
+        context["serverClient"] = lease.serverClient
+
+    def _startBatchContainer(self, job, context):
+        '''batch開始前啟動容器並確認inference server是否可用, 每個batch再個別向scheduler取得容器'''
+        with sharedInferenceScheduler().lease(CHEST_MODEL.name, context["priority"], cancelled=lambda: job.cancelled) as lease:
+            context["serverAvailable"] = lease.serverClient is not None
+
+    def _exportVolume(self, job, context):
+        if context.get("cached"):
+            return
+        volumeNode = context["volumeNode"]
+        transferMode = self.volumeTransferMode(volumeNode, context["serverClient"] is not None)
+        if transferMode == INPUT_SHARED_MEMORY:
+            # 只複製一次到shared memory, 送給inference server的只有segment的名稱; job結束時刪除segment
+            ijkToRas = vtk.vtkMatrix4x4()
+            volumeNode.GetIJKToRASMatrix(ijkToRas)
+            context["sharedVolume"] = SharedArray.create(ChunkedExport.volumeArrayView(volumeNode), pool=sharedSegmentPool())
+            job.addCleanup(context["sharedVolume"].unlink)
+            context["ijkToRas"] = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        elif transferMode == INPUT_ARRAY:
+            # 直接傳送voxel array與IJK to RAS矩陣, 不經過共用資料夾的nrrd檔
+            ijkToRas = vtk.vtkMatrix4x4()
+            volumeNode.GetIJKToRASMatrix(ijkToRas)
+            context["array"] = slicer.util.arrayFromVolume(volumeNode).copy()
+            context["ijkToRas"] = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        else:
+            context["basename"], context["transferStats"] = self.exportVolume(volumeNode)
+
+    def _runInference(self, job, context):
+        '''對container下指令'''
+        if context.get("cached"):
+            return
+        serverClient = context["serverClient"]
+        request = {"confidence": CONFIDENCE_FLOOR}
+        if "sharedVolume" in context:
+            channel = ResultChannel.run(serverClient.inferShared, CHEST_MODEL.name, context["sharedVolume"],
+                                        context["ijkToRas"], request,
+                                        timeout=RESULT_TIMEOUT, description="chestyolov5 inference")
+            data, transferStats = job.waitFor(channel.future)
+        elif "array" in context:
+            channel = ResultChannel.run(serverClient.inferVolume, CHEST_MODEL.name, context["array"],
+                                        context["ijkToRas"], request, compression=VOLUME_TRANSFER_COMPRESSION,
+                                        timeout=RESULT_TIMEOUT, description="chestyolov5 inference")
+            data, transferStats = job.waitFor(channel.future)
+        else:
+            basename, transferStats = context["basename"], context["transferStats"]
+            startTime = time.perf_counter()
+            if serverClient is not None:
+                # 常駐的inference server已載入模型, 直接回傳結果
+                request["input"] = basename
+                channel = ResultChannel.run(serverClient.infer, CHEST_MODEL.name, request,
+                                            timeout=RESULT_TIMEOUT, description="chestyolov5 inference")
+            else:
+                channel = self._runInferenceCommand(context["container"], basename, CONFIDENCE_FLOOR)
+            data = job.waitFor(channel.future)
+            transferStats.transferSeconds = time.perf_counter() - startTime
+        logging.info(f"Volume transfer {transferStats.summary()}")
+        self.resultCache.put(context["cacheKey"], data)
+        context["result"] = data
+
+    def _showDetections(self, job, context):
+        context["runId"] = self.showDetections(context["volumeNode"], context["result"])
+        # 在主執行緒讀取目前的confidence, inference期間移動slider也以最新的值篩選
+        confidence = self.displayConfidence if self.displayConfidence is not None else context["confidence"]
+        self.detectionRegistry.filterByConfidence(confidence or 0.0, context["runId"])
+
+    def batchItemsFromVolumes(self, volumeNodes) -> list:
+        """Batch inputs for volumes already loaded in the scene."""
+        return [BatchItem(key=f"{node.GetName()} ({node.GetID()})", source=node, metadata={"name": node.GetName()})
+                for node in volumeNodes]
+
+    def batchItemsFromFolder(self, folder: str) -> list:
+        """Batch inputs for all chest X-ray images of `folder` and its sub folders."""
+        items = []
+        for root, _, files in os.walk(folder):
+            for name in sorted(files):
+                if name.lower().endswith(CHEST_IMAGE_EXTENSIONS):
+                    path = os.path.abspath(os.path.join(root, name))
+                    items.append(BatchItem(key=path, source=path, metadata={"name": name}))
+        return items
+
+    def batchItemsFromPaths(self, paths) -> list:
+        """Batch inputs for image files and for all images of folders."""
+        items = []
+        for path in paths:
+            items += self.batchItemsFromFolder(path) if os.path.isdir(path) else [self._batchItem(path)]
+        return items
+
+    def batchItemsFromSeriesUIDs(self, seriesInstanceUIDs) -> list:
+        """Batch inputs for chest X-ray series of the Slicer DICOM database, loaded when their batch is prepared."""
+        return [BatchItem(key=uid, source=uid, metadata={"seriesInstanceUID": uid}) for uid in seriesInstanceUIDs]
+
+    def batchItemsFromDicomDatabase(self, modalities=("CR", "DX"), studyDate=None, patientID=None) -> list:
+        """Batch inputs for the chest X-ray series of the Slicer DICOM database matching the query."""
+        return [BatchItem(key=series["seriesInstanceUID"], source=series["seriesInstanceUID"],
+                          metadata={key: value for key, value in series.items() if key != "files"})
+                for series in findDicomSeries(slicer.dicomDatabase, list(modalities), studyDate, patientID)]
+
+    def createBatchJob(self, inputs, confidence: float, resultStorePath: Optional[str] = None,
+                       batchSize: int = CHEST_BATCH_SIZE, skipExisting: bool = True,
+                       priority: int = PRIORITY_BATCH, workers: int = 1) -> InferenceJob:
+        """
+        Create the job that runs chestyolov5 on many images and writes the bounding boxes to a result store.
+        The stored results contain all boxes down to CONFIDENCE_FLOOR, `confidence` is kept in their metadata.
+        :param inputs: folder path, or list of BatchItem, volume nodes or image file paths
+        :param batchSize: images sent to the model in one call
+        :param skipExisting: do not run images that already have a result in the store
+        :param priority: scheduler priority of every batch, interactive jobs run between two batches
+        :param workers: batches run at the same time, each in its own container on the GPUs of the model
+        The job result is a summary {"done": n, "failed": n, "skipped": n, "store": path}.
+        """
+        if isinstance(inputs, str):
+            items = self.batchItemsFromFolder(inputs)
+        else:
+            items = [self._batchItem(value) for value in inputs]
+        if workers > 1:
+            sharedInferenceScheduler().allowConcurrentRuns(CHEST_MODEL.name, workers)
+        store = ResultStore(resultStorePath or CHEST_RESULT_STORE)
+        job = createBatchJob("chestyolov5 batch inference", CHEST_MODEL.name, items, store, batchSize,
+                             self._prepareBatch, self._inferBatch, skipExisting=skipExisting, cache=self.resultCache,
+                             setupStages=[Stage(_("Starting container"), self._startBatchContainer)],
+                             inferWorkers=workers)
+        job.context["confidence"] = confidence
+        job.context["priority"] = priority
+        job.addCleanup(store.close)
+        return job
+
+    def _batchItem(self, value) -> BatchItem:
+        if isinstance(value, BatchItem):
+            return value
+        if isinstance(value, str):
+            path = os.path.abspath(value)
+            return BatchItem(key=path, source=path, metadata={"name": os.path.basename(path)})
+        return self.batchItemsFromVolumes([value])[0]
+
+    def _prepareBatch(self, job, context, batch):
+        '''在主執行緒讀取影像, 依傳送方式準備array(直接傳送或經由shared memory)或nrrd檔'''
+        for item in batch:
+            job.checkCancelled()
+            loadedNodes = []
+            try:
+                if isinstance(item.source, str) and os.path.exists(item.source):
+                    volumeNode = slicer.util.loadVolume(item.source, {"show": False})
+                    loadedNodes.append(volumeNode)
+                elif isinstance(item.source, str):
+                    from DICOMLib import DICOMUtils
+                    loadedNodes = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in DICOMUtils.loadSeriesByUID([item.source])]
+                    volumeNode = next((node for node in loadedNodes if node.IsA("vtkMRMLScalarVolumeNode")), None)
+                else:
+                    volumeNode = item.source
+                if volumeNode is None:
+                    item.error = f"Could not load {item.key}"
+                    continue
+                # 結果包含CONFIDENCE_FLOOR以上的所有box, confidence記錄在metadata供之後篩選
+                item.metadata["confidence"] = context["confidence"]
+                item.metadata["confidenceFloor"] = CONFIDENCE_FLOOR
+                item.cacheKey = self.imageCacheKey(volumeNode)
+                item.result = self.resultCache.get(item.cacheKey)
+                if item.result is not None:
+                    item.cached = True
+                    continue
+                item.request = {"confidence": CONFIDENCE_FLOOR}
+                if self.volumeTransferMode(volumeNode, context["serverAvailable"]) in (INPUT_ARRAY, INPUT_SHARED_MEMORY):
+                    ijkToRas = vtk.vtkMatrix4x4()
+                    volumeNode.GetIJKToRASMatrix(ijkToRas)
+                    item.volume = (slicer.util.arrayFromVolume(volumeNode).copy(), slicer.util.arrayFromVTKMatrix(ijkToRas))
+                else:
+                    item.request["input"] = self.exportVolume(volumeNode)[0]
+            except Exception as e:
+                item.error = f"{type(e).__name__}: {e}"
+            finally:
+                for node in loadedNodes:
+                    if node is not None:
+                        slicer.mrmlScene.RemoveNode(node)
+
+    def _inferBatch(self, job, context, batch):
+        '''一次送出整個batch, 沒有inference server時逐張以exec_run執行; 每個batch個別排程, 讓急件可以插隊'''
+        with sharedInferenceScheduler().lease(CHEST_MODEL.name, context["priority"], cancelled=lambda: job.cancelled) as lease:
+            self._inferLeasedBatch(job, lease, batch)
+
+    def _inferLeasedBatch(self, job, lease, batch):
+        serverClient = lease.serverClient
+        model = CHEST_MODEL.name
+        arrayItems = [item for item in batch if item.volume is not None]
+        fileItems = [item for item in batch if item.volume is None]
+        if serverClient is None:
+            # 此batch取得的容器沒有inference server(例如容器重新啟動後): array先存成nrrd檔, 逐張以exec_run執行
+            for item in arrayItems:
+                item.request["input"] = self.exportArray(*item.volume)
+                item.volume = None
+            for item in batch:
+                channel = self._runInferenceCommand(lease.container, item.request["input"], CONFIDENCE_FLOOR)
+                item.result = job.waitFor(channel.future)
+            return
+        if arrayItems and VOLUME_TRANSFER_MODE == INPUT_SHARED_MEMORY:
+            # 逐張經由shared memory交給inference server, segment由共用的pool重複使用
+            for item in arrayItems:
+                channel = ResultChannel.run(serverClient.inferShared, model, item.volume[0], item.volume[1], item.request,
+                                            timeout=RESULT_TIMEOUT, description="chestyolov5 batch inference")
+                item.result, transferStats = job.waitFor(channel.future)
+                logging.info(f"Batch volume transfer {transferStats.summary()}")
+        elif arrayItems:
+            channel = ResultChannel.run(serverClient.inferVolumeBatch, model, [item.volume for item in arrayItems],
+                                        [item.request for item in arrayItems], compression=VOLUME_TRANSFER_COMPRESSION,
+                                        timeout=RESULT_TIMEOUT, description="chestyolov5 batch inference")
+            results, transferStats = job.waitFor(channel.future)
+            logging.info(f"Batch volume transfer {transferStats.summary()}")
+            for item, result in zip(arrayItems, results):
+                item.result = result
+        if fileItems:
+            channel = ResultChannel.run(serverClient.inferBatch, model, [item.request for item in fileItems],
+                                        timeout=RESULT_TIMEOUT, description="chestyolov5 batch inference")
+            for item, result in zip(fileItems, job.waitFor(channel.future)):
+                item.result = result
+
+    def volumeTransferMode(self, volumeNode: vtkMRMLScalarVolumeNode, serverAvailable: bool) -> str:
+        '''傳送volume的方式: 有inference server且模型接受VOLUME_TRANSFER_MODE時使用該方式, 否則(以及大型volume)匯出nrrd檔'''
+        if serverAvailable and CHEST_MODEL.accepts(VOLUME_TRANSFER_MODE) and not self.isLargeVolume(volumeNode):
+            return VOLUME_TRANSFER_MODE
+        return INPUT_NRRD
+
+    @staticmethod
+    def isLargeVolume(volumeNode: vtkMRMLScalarVolumeNode) -> bool:
+        imageData = volumeNode.GetImageData()
+        scalars = imageData.GetPointData().GetScalars() if imageData is not None else None
+        return scalars is not None and scalars.GetDataSize() * scalars.GetDataTypeSize() > CHUNKED_EXPORT_MIN_BYTES
+
+    def exportVolume(self, volumeNode: vtkMRMLScalarVolumeNode):
+        '''將slicer當前開啟的volume存成nrrd檔至共用資料夾'''
+        # 設定輸出資料夾路徑
+        exportDir = CHEST_MODEL.inputFolder
+
+        # 檢查資料夾是否存在
+        if not os.path.exists(exportDir):
+            print("no such directory")
+
+        # 生成隨機五位數字
+        randomFileName = f"{random.randint(10000, 99999)}"
+
+        # 使用隨機五位數字作為檔案名稱
+        exportFilePath = os.path.join(exportDir, f"{randomFileName}.nrrd")
+
+        # 大型volume直接由image data分段寫出, 不另外佔用整個volume大小的記憶體
+        if self.isLargeVolume(volumeNode):
+            transferStats = ChunkedExport.exportVolume(volumeNode, exportFilePath)
+            print(f"Volume exported to {exportFilePath} in chunks")
+            return randomFileName + '.nrrd', transferStats
+
+        # 將當前volume保存至nrrd資料夾
+        startTime = time.perf_counter()
+        with span("saveNode", path=exportFilePath):
+            result = slicer.util.saveNode(volumeNode, exportFilePath)
+        transferStats = TransferStats("nrrd", rawBytes=slicer.util.arrayFromVolume(volumeNode).nbytes,
+                                      encodeSeconds=time.perf_counter() - startTime)
+        if result:
+            transferStats.wireBytes = os.path.getsize(exportFilePath)
+            print(f"Volume exported to {exportFilePath}")
+        else:
+            print("Failed to export volume.")
+        return randomFileName + '.nrrd', transferStats
+
+    def exportArray(self, array, ijkToRas) -> str:
+        '''將batch已讀取的voxel array存成nrrd檔至共用資料夾, 回傳檔名'''
+        basename = f"{random.randint(10000, 99999)}.nrrd"
+        transferStats = ChunkedExport.writeNrrd(os.path.join(CHEST_MODEL.inputFolder, basename), array, ijkToRas)
+        logging.info(f"Volume transfer {transferStats.summary()}")
+        return basename
+
+    def _runInferenceCommand(self, container, basename, confidence):
+        '''沒有inference server時, 以exec_run執行main.py, 結果的json檔出現時立即通知'''
+        command = "python /workfolder/main.py --run-type inference --input " + basename + ' --confidence ' + str(confidence)
+
+        ResultFolderPath = CHEST_MODEL.resultFolder
+        result_name = basename + '_result.json'
+        jsonPath = os.path.join(ResultFolderPath, result_name)
+
+        return execResultChannel(container, command, jsonPath, timeout=RESULT_TIMEOUT)
+
+    def showDetections(self, imageNode: vtkMRMLScalarVolumeNode, data) -> str:
+        '''將YOLO的bounding box以一個model node呈現在slicer, 每個box是一條封閉的折線, 回傳run id'''
+        imageToRAS = vtk.vtkMatrix4x4()
+        imageNode.GetIJKToRASMatrix(imageToRAS)
+
+        ### 將結果呈現在slicer ###
+        # 獲得當前紅色視窗node名稱 (--no-main-window執行時沒有layout manager)
+        if slicer.app.layoutManager() is not None:
+            compositeNode = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode()
+            volumeNodeID = compositeNode.GetBackgroundVolumeID()
+            volumeNode = slicer.mrmlScene.GetNodeByID(volumeNodeID)
+            if volumeNode is not None:
+                nodeName = volumeNode.GetName()
+                print("當前圖像節點名稱: ", nodeName)
+            else:
+                print("沒有圖現節點被選中")
+
+        bounding_boxes = data['bounding_boxes']
+
+        # 一次將所有box的四個角點 (N,4,4) 由IJK轉換至RAS
+        # 沒有指定slice的box畫在紅色視窗目前顯示的切片上 (單張X光為第0張)
+        ras_corners = DetectionGeometry.detectionCorners(bounding_boxes, slicer.util.arrayFromVTKMatrix(imageToRAS),
+                                                         self.currentSliceIndex(imageNode))
+
+        # 所有box共用一個model node, 只產生一次scene更新
+        confidences = DetectionGeometry.confidences(bounding_boxes)
+        modelNode = self.detectionOverlay.addDetectionSet(ras_corners, confidences, name=f"{imageNode.GetName()} detections")
+        return self.detectionRegistry.addRun(modelNode, confidences)
+
+    def currentSliceIndex(self, imageNode: vtkMRMLScalarVolumeNode, viewName: str = "Red") -> int:
+        """K index of `imageNode` shown in the slice view, 0 for single frame images."""
+        dimensions = imageNode.GetImageData().GetDimensions() if imageNode.GetImageData() else (1, 1, 1)
+        if dimensions[2] <= 1 or slicer.app.layoutManager() is None:
+            return 0
+        sliceToRAS = slicer.util.arrayFromVTKMatrix(
+            slicer.app.layoutManager().sliceWidget(viewName).mrmlSliceNode().GetSliceToRAS())
+        rasToIJK = vtk.vtkMatrix4x4()
+        imageNode.GetRASToIJKMatrix(rasToIJK)
+        ijk = slicer.util.arrayFromVTKMatrix(rasToIJK) @ np.append(sliceToRAS[:3, 3], 1.0)
+        return int(np.clip(round(ijk[2]), 0, dimensions[2] - 1))
+
     def process(self,
                 inputVolume: vtkMRMLScalarVolumeNode,
                 outputVolume: vtkMRMLScalarVolumeNode,
@@ -517,3 +895,30 @@ class ChestXrayNodulesTest(ScriptedLoadableModuleTest):
         self.delayDisplay("Test passed")
 
 
+#
+# Command line
+#
+
+
+def main(argv=None) -> int:
+    '''
+    不開啟GUI執行batch inference, 結果寫入JSON檔, 例如:
+    Slicer --no-main-window --python-script chestXrayNodules/ChestXrayNodules.py --input <folder> --output results.json
+    '''
+    parser = Headless.argumentParser("Run chestyolov5 on chest X-ray images without the Slicer GUI.",
+                                     CHEST_BATCH_SIZE, ("CR", "DX"))
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE_FLOOR,
+                        help="confidence to review the boxes with, kept in the metadata (all boxes down to "
+                             f"{CONFIDENCE_FLOOR} are stored)")
+    args = parser.parse_args(argv)
+    logic = ChestXrayNodulesLogic()
+    items = Headless.collectBatchItems(logic, args)
+    if not items:
+        parser.error("no input found, use --input, --series-uid or a DICOM database query")
+    job = logic.createBatchJob(items, args.confidence, resultStorePath=args.store, batchSize=args.batch_size,
+                               skipExisting=not args.rerun, priority=args.priority, workers=args.workers)
+    return Headless.runBatchJob(job, CHEST_MODEL.name, items, args.output)
+
+
+if __name__ == "__main__":
+    slicer.util.exit(main(sys.argv[1:]))